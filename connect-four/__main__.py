@@ -1,11 +1,14 @@
+import os
 import time
 from argparse import ArgumentParser
 
 from alpha_connect import simulate_once, optimize_continuously, optimize_once, \
     simulate_continuously
+from engine import EXPORT_EXTENSION, WEIGHT_DTYPES, NumpyModel, agreement, export_model, sample_states
 from game import TwoPlayerGame
-from observer import GameStatePrinter, AlphaConnectPrinter
-from player import ConsolePlayer, AlphaConnectPlayer
+from observer import GameStatePrinter, AlphaConnectPrinter, Ponderer
+from parallel import speedup_curve
+from player import ConsolePlayer, AlphaConnectPlayer, BACKENDS
 from state import State, Action
 from tournament import tournament_continuously, bayes_tournament_elo
 
@@ -20,11 +23,17 @@ def _play_game(args):
     human_player = ConsolePlayer('You')
     computer_player = AlphaConnectPlayer(args.model_path,
                                          'Computer',
-                                         time_budget=14500)
+                                         time_budget=14500,
+                                         solver=True,
+                                         parallel=args.parallel,
+                                         workers=args.workers,
+                                         backend=args.backend)
     observers = [
         AlphaConnectPrinter(),
         GameStatePrinter(show_action_history=True)
     ]
+    if args.ponder:
+        observers.append(Ponderer(computer_player))
 
     if args.human_first:
         game = TwoPlayerGame(State.empty(), human_player, computer_player,
@@ -41,23 +50,32 @@ def _play_game(args):
 
 
 class AIServicer(ttt_pb2_grpc.AIServicer):
-    def __init__(self, player):
+    def __init__(self, player, ponder=False):
         self.player = player
+        self.ponder = ponder
 
     def Play(self, request, _context):
         board = json.loads(request.board)
         player = request.player
         state = State.from_board(board, player)
         res = self.player.decide(state)
+        if self.ponder:
+            self.player.ponder(state.take_action(res))
         return ttt_pb2.PlayResponse(x=res.x, y=res.y)
 
 
 def _start_grpc_server(args):
+    max_bytes = None if args.max_megabytes is None else args.max_megabytes * 2 ** 20
     computer_player = AlphaConnectPlayer(args.model_path,
                                          'Computer',
-                                         time_budget=args.ms)
+                                         time_budget=args.ms,
+                                         solver=True,
+                                         max_bytes=max_bytes,
+                                         parallel=args.parallel,
+                                         workers=args.workers,
+                                         backend=args.backend)
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
-    ttt_pb2_grpc.add_AIServicer_to_server(AIServicer(computer_player), server)
+    ttt_pb2_grpc.add_AIServicer_to_server(AIServicer(computer_player, args.ponder), server)
     server.add_insecure_port(f'127.0.0.1:{args.port}')
     server.start()
     print(f"Listening on port {args.port}")
@@ -73,19 +91,23 @@ def _optimize_continuously(args):
 
 
 def _simulate_once(args):
-    simulate_once(args.model_path, args.data_path, verbose=True)
+    simulate_once(args.model_path, args.data_path, verbose=True, solver=args.solver)
 
 
 def _simulate_continously(args):
     simulate_continuously(args.model_dir, args.data_dir, args.processes,
-                          args.search_budget)
+                          args.search_budget, args.games_per_process,
+                          args.batch_size, args.inference_server,
+                          args.max_latency / 1000, args.solver)
 
 
 def _timeit_single_search(args):
     print('Preparing player and state')
     player = AlphaConnectPlayer(args.model_path,
                                 start_temperature=None,
-                                search_budget=10000)
+                                search_budget=10000,
+                                transpositions=args.transpositions,
+                                backend=args.backend)
     state = State.empty()
     print('Running search')
     s0 = time.time()
@@ -94,6 +116,33 @@ def _timeit_single_search(args):
     print('Done search')
     print(player.root)
     print('Total running time: %.2f' % duration)
+    stats = player.model.stats()
+    print('Predictions: %d, batch fill rate: %.2f, duplicate leaves: %d, forced flushes: %d' %
+          (stats['predictions'], stats['fill_rate'], stats['duplicates'], stats['flushes']))
+    if args.transpositions:
+        stats = player.root.table.stats()
+        print('Graph nodes: %d, transpositions: %d, saved visits: %d' %
+              (stats['nodes'], stats['transpositions'], stats['saved_visits']))
+
+
+def _export_model(args):
+    export_path = args.export_path
+    if export_path is None:
+        export_path = os.path.splitext(args.model_path)[0] + EXPORT_EXTENSION
+    export_model(args.model_path, export_path, args.weight_dtype)
+    print('Exported %s to %s' % (args.model_path, export_path))
+    if args.weight_dtype != 'float32':
+        report = agreement(NumpyModel.from_export(export_path), NumpyModel.from_h5(args.model_path),
+                           sample_states(args.data_dir, args.report_states))
+        print('Agreement with float32 weights: top-1 action %.1f%%, value MAE %.5f' %
+              (report['top1_agreement'] * 100, report['value_mae']))
+
+
+def _parallel_speedup(args):
+    curve = speedup_curve(args.model_path, args.workers, args.ms, args.mode)
+    print('Workers  Searches/s  Speedup')
+    for workers, searches_per_second in curve:
+        print('%7d  %10.1f  %7.2f' % (workers, searches_per_second, searches_per_second / curve[0][1]))
 
 
 def _tournament_continuously(args):
@@ -101,7 +150,8 @@ def _tournament_continuously(args):
                             args.processes, args.first_player_name_filter,
                             args.first_player_kwargs_filter,
                             args.second_player_name_filter,
-                            args.second_player_kwargs_filter)
+                            args.second_player_kwargs_filter,
+                            args.inference_server, args.max_latency / 1000)
 
 
 def _tournament_elo(args):
@@ -125,6 +175,21 @@ parser_play.add_argument('--human_second',
                          dest='human_first',
                          default=True,
                          action='store_false')
+parser_play.add_argument('--ponder',
+                         help='let the computer search while you think',
+                         action='store_true')
+parser_play.add_argument('--backend',
+                         choices=BACKENDS,
+                         help='evaluate the model with keras or numpy',
+                         default='keras')
+parser_play.add_argument('--parallel',
+                         choices=['root', 'tree'],
+                         help='search with root parallel processes or tree parallel threads (default: no parallel '
+                              'search)')
+parser_play.add_argument('--workers',
+                         type=int,
+                         help='number of parallel workers',
+                         default=os.cpu_count())
 parser_play.set_defaults(func=_play_game)
 
 # grpc server
@@ -139,6 +204,24 @@ parser_grpc.add_argument('--port',
                          type=int,
                          help='port of the server',
                          default=50001)
+parser_grpc.add_argument('--max_megabytes',
+                         type=int,
+                         help='prune the search tree when it takes more memory')
+parser_grpc.add_argument('--ponder',
+                         help='search while the client decides its next move',
+                         action='store_true')
+parser_grpc.add_argument('--backend',
+                         choices=BACKENDS,
+                         help='evaluate the model with keras or numpy',
+                         default='keras')
+parser_grpc.add_argument('--parallel',
+                         choices=['root', 'tree'],
+                         help='search with root parallel processes or tree parallel threads (default: no parallel '
+                              'search)')
+parser_grpc.add_argument('--workers',
+                         type=int,
+                         help='number of parallel workers',
+                         default=os.cpu_count())
 parser_grpc.set_defaults(func=_start_grpc_server)
 
 # optimize-once
@@ -177,6 +260,10 @@ parser_simulate_once.add_argument('model_path',
                                   help='path to a serialized neural network')
 parser_simulate_once.add_argument('data_path',
                                   help='where to save the generated game')
+parser_simulate_once.add_argument(
+    '--solver',
+    action='store_true',
+    help='play proven and forced actions, and save one-hot policies for them')
 parser_simulate_once.set_defaults(func=_simulate_once)
 
 # simulate-continuously
@@ -195,6 +282,29 @@ parser_simulate_continuously.add_argument('--search_budget',
                                           type=int,
                                           help='number of mcts searches',
                                           default=1600)
+parser_simulate_continuously.add_argument(
+    '--games_per_process',
+    type=int,
+    help='number of games that each process plays concurrently',
+    default=1)
+parser_simulate_continuously.add_argument(
+    '--batch_size',
+    type=int,
+    help='batch size of the model evaluations shared by concurrent games',
+    default=256)
+parser_simulate_continuously.add_argument(
+    '--inference_server',
+    action='store_true',
+    help='evaluate the models in a separate process, shared by all workers')
+parser_simulate_continuously.add_argument(
+    '--max_latency',
+    type=float,
+    help='milliseconds that the inference server waits for a full batch',
+    default=5)
+parser_simulate_continuously.add_argument(
+    '--solver',
+    action='store_true',
+    help='play proven and forced actions, and save one-hot policies for them')
 parser_simulate_continuously.set_defaults(func=_simulate_continously)
 
 # timeit
@@ -202,8 +312,62 @@ parser_timeit = subparsers.add_parser('timeit')
 parser_timeit.add_argument('model_path',
                            type=str,
                            help='path to a serialized neural network')
+parser_timeit.add_argument('--transpositions',
+                           action='store_true',
+                           help='share nodes of transposed states in the search')
+parser_timeit.add_argument('--backend',
+                           choices=BACKENDS,
+                           help='evaluate the model with keras or numpy',
+                           default='keras')
 parser_timeit.set_defaults(func=_timeit_single_search)
 
+# export-model
+parser_export_model = subparsers.add_parser(
+    'export-model',
+    help='export a model as a flat file that loads without TensorFlow')
+parser_export_model.add_argument('model_path',
+                                 type=str,
+                                 help='path to a serialized neural network')
+parser_export_model.add_argument('--export_path',
+                                 type=str,
+                                 help='path of the exported model (default: model path with extension %s)' %
+                                 EXPORT_EXTENSION)
+parser_export_model.add_argument('--weight_dtype',
+                                 choices=list(WEIGHT_DTYPES),
+                                 help='precision of the weights in the exported file',
+                                 default='float32')
+parser_export_model.add_argument('--data_dir',
+                                 type=str,
+                                 help='directory with self-play games to compare float16 weights with float32 on, '
+                                      'completed with random games',
+                                 default='data')
+parser_export_model.add_argument('--report_states',
+                                 type=int,
+                                 help='number of states to compare float16 weights with float32 on',
+                                 default=1000)
+parser_export_model.set_defaults(func=_export_model)
+
+# parallel-speedup
+parser_parallel_speedup = subparsers.add_parser(
+    'parallel-speedup',
+    help='measure searches per second of parallel search with 1 up to n workers')
+parser_parallel_speedup.add_argument('model_path',
+                                     type=str,
+                                     help='path to a serialized neural network')
+parser_parallel_speedup.add_argument('--workers',
+                                     type=int,
+                                     help='maximum number of workers',
+                                     default=os.cpu_count())
+parser_parallel_speedup.add_argument('--ms',
+                                     type=int,
+                                     help='milliseconds of search per move',
+                                     default=5000)
+parser_parallel_speedup.add_argument('--mode',
+                                     choices=['root', 'tree'],
+                                     help='root parallel or tree parallel search',
+                                     default='root')
+parser_parallel_speedup.set_defaults(func=_parallel_speedup)
+
 # tournament-continously
 parser_tournament_continuously = subparsers.add_parser(
     'tournament-continously',
@@ -224,6 +388,15 @@ parser_tournament_continuously.add_argument(
     '--second_player_name_filter', help='regex filter for second player name')
 parser_tournament_continuously.add_argument(
     '--second_player_kwargs_filter', help='regex filter for second kwargs')
+parser_tournament_continuously.add_argument(
+    '--inference_server',
+    action='store_true',
+    help='evaluate the models in a separate process, shared by all workers')
+parser_tournament_continuously.add_argument(
+    '--max_latency',
+    type=float,
+    help='milliseconds that the inference server waits for a full batch',
+    default=5)
 parser_tournament_continuously.set_defaults(func=_tournament_continuously)
 
 # tournament-elo
@@ -234,4 +407,6 @@ parser_tournament_elo.add_argument(
 parser.set_defaults(func=_tournament_elo)
 
 args = parser.parse_args()
+if getattr(args, 'ponder', False) and getattr(args, 'parallel', None) == 'root':
+    parser.error('root parallel search does not support pondering')
 args.func(args)
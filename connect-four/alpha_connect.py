@@ -3,21 +3,23 @@ import time
 from itertools import cycle
 from multiprocessing.pool import Pool
 
-from classifier import train_new_model, write_model
+import inference
 from game import TwoPlayerGame
 from observer import GameStatePrinter, AlphaConnectSerializer, AlphaConnectPrinter
-from player import AlphaConnectPlayer
-from state import State
+from player import AlphaConnectPlayer, release_evaluation_caches
+from state import State, Color
 from util import list_files, replace_extension
 
 
 def optimize_once(data_dir, model_path, max_games=None):
+    from classifier import train_new_model
     log_path = replace_extension(model_path, '.csv')
     model = train_new_model(data_dir, log_path, max_games)
     model.save(model_path)
 
 
 def optimize_continuously(model_dir, data_dir, max_games=None, wait=30 * 60):
+    from classifier import train_new_model, write_model
     os.makedirs(model_dir, exist_ok=True)
     if is_first_model(model_dir):
         _, model_path = new_model_path(model_dir)
@@ -32,24 +34,49 @@ def optimize_continuously(model_dir, data_dir, max_games=None, wait=30 * 60):
         time.sleep(wait)
 
 
-def simulate_continuously(model_dir, data_dir, processes, search_budget):
-    with Pool(processes) as p:
-        for _ in p.imap_unordered(simulate_once_with_newest_model, cycle([(model_dir, data_dir, search_budget)])):
-            pass
+def simulate_continuously(model_dir, data_dir, processes, search_budget, games_per_process=1, batch_size=256,
+                          inference_server=False, max_latency=0.005, solver=False):
+    """Generate self-play games with the newest model in multiple processes
+
+    :param inference_server: evaluate the states of all processes in a separate server process, such that the
+        self-play processes do not load TensorFlow
+    :param max_latency: seconds that the inference server waits for a full batch
+    :param solver: play proven and forced actions, whose policy targets are then one-hot instead of the visit counts
+    """
+    initializer, initargs, server = None, (), None
+    if inference_server:
+        channels, server = inference.start_server(processes, batch_size, max_latency)
+        initializer, initargs = inference.connect_worker, (channels,)
+
+    with Pool(processes, initializer, initargs) as p:
+        if games_per_process > 1:
+            args = (model_dir, data_dir, search_budget, games_per_process, batch_size, solver)
+            simulate = simulate_concurrently_with_newest_model
+        else:
+            args = (model_dir, data_dir, search_budget, solver)
+            simulate = simulate_once_with_newest_model
+        try:
+            for _ in p.imap_unordered(simulate, cycle([args])):
+                pass
+        finally:
+            if server is not None:
+                inference.stop_server(channels, server)
 
 
 def simulate_once_with_newest_model(args):
-    model_dir, data_dir, search_budget = args
+    model_dir, data_dir, search_budget, solver = args
     model_iteration, model_path = latest_model_path(model_dir)
     model_data_dir = os.path.join(data_dir, '%6.6d' % model_iteration)
-    simulate_once(model_path, model_data_dir, search_budget=search_budget)
+    release_evaluation_caches(keep_model_path=model_path)
+    simulate_once(model_path, model_data_dir, search_budget=search_budget, solver=solver)
 
 
-def simulate_once(model_path, data_dir=None, exploration=1.0, temperature=1.0, search_budget=1600, verbose=False):
+def simulate_once(model_path, data_dir=None, exploration=1.0, temperature=1.0, search_budget=1600, verbose=False,
+                  cache_size=2 ** 16, solver=False):
     state = State.empty()
     player_name = 'AlphaConnect (%s)' % model_path.split('/')[-1]
     player = AlphaConnectPlayer(model_path, player_name, exploration, temperature, search_budget=search_budget,
-                                self_play=True)
+                                self_play=True, cache_size=cache_size, solver=solver)
     observers = []
     if data_dir is not None:
         observers.append(AlphaConnectSerializer(data_dir))
@@ -62,6 +89,42 @@ def simulate_once(model_path, data_dir=None, exploration=1.0, temperature=1.0, s
     return game
 
 
+def simulate_concurrently_with_newest_model(args):
+    model_dir, data_dir, search_budget, number_of_games, batch_size, solver = args
+    model_iteration, model_path = latest_model_path(model_dir)
+    model_data_dir = os.path.join(data_dir, '%6.6d' % model_iteration)
+    release_evaluation_caches(keep_model_path=model_path)
+    simulate_concurrently(model_path, model_data_dir, number_of_games, batch_size, search_budget=search_budget,
+                          solver=solver)
+
+
+def simulate_concurrently(model_path, data_dir=None, number_of_games=16, batch_size=256, exploration=1.0,
+                          temperature=1.0, search_budget=1600, cache_size=2 ** 16, solver=False):
+    """Play self-play games concurrently in this process, such that the searches of all games share large batches"""
+    player_name = 'AlphaConnect (%s)' % model_path.split('/')[-1]
+    evaluator = AlphaConnectPlayer.load_model(model_path, batch_size, cache_size)
+    games = []
+    for _ in range(number_of_games):
+        player = AlphaConnectPlayer(model_path, player_name, exploration, temperature, search_budget=search_budget,
+                                    self_play=True, evaluator=evaluator, solver=solver)
+        observers = [] if data_dir is None else [AlphaConnectSerializer(data_dir)]
+        games.append(TwoPlayerGame(State.empty(), player, player, observers))
+
+    plays = [game.play_iter() for game in games]
+    while len(plays) > 0:
+        all_waiting = True
+        for play in list(plays):
+            try:
+                all_waiting &= next(play)
+            except StopIteration:
+                plays.remove(play)
+        if all_waiting:
+            evaluator.flush()
+
+    games[0].players[Color.WHITE].clear_session()
+    return games
+
+
 def is_first_model(model_dir):
     model_files = list(list_files(model_dir, '.h5'))
     return len(model_files) == 0
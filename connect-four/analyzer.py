@@ -1,23 +1,33 @@
 from operator import sub
 
-from state import Color, State, FOUR
+from typing import Dict, Tuple, Union
 
+import numpy as np
 
-def count_lines(state: State):
-    brown_value = [0, 0, 0, 0, 0]
-    white_value = [0, 0, 0, 0, 0]
-    for line_i, brown_count in state.brown_lines.items():
-        white_count = state.white_lines[line_i]
-        if brown_count == 0 and white_count > 0:
-            white_value[FOUR - white_count] += 1
-        elif white_count == 0 and brown_count > 0:
-            brown_value[FOUR - brown_count] += 1
-    return brown_value, white_value
+from state import Action, Color, State, FOUR, SearchBoard
 
 
-def player_value(state: State, color: Color):
-    brown_value, white_value = count_lines(state)
+def player_value(state: Union[State, SearchBoard], color: Color):
+    return _histogram_value(state.line_histogram, color)
+
+
+def child_values(state: Union[State, SearchBoard], color: Color) -> Dict[Action, Tuple[int, ...]]:
+    """`player_value` after each allowed action, without creating the states of the children"""
+    actions, line_histograms = state.child_line_histograms()
+    return dict(zip(actions, map(tuple, _histogram_values(line_histograms, color).tolist())))
+
+
+def _histogram_value(line_histogram: Tuple[int, ...], color: Color):
+    brown_value, white_value = line_histogram[FOUR - 1::-1], line_histogram[:FOUR - 1:-1]
     if color is Color.BROWN:
-        return tuple(map(sub, brown_value, white_value))
+        return tuple(map(sub, brown_value, white_value)) + (0,)
     elif color is Color.WHITE:
-        return tuple(map(sub, white_value, brown_value))
+        return tuple(map(sub, white_value, brown_value)) + (0,)
+
+
+def _histogram_values(line_histograms: np.ndarray, color: Color) -> np.ndarray:
+    line_histograms = line_histograms.astype(np.int64).reshape((-1, 2, FOUR))
+    own_i = 0 if color is Color.BROWN else 1
+    values = np.zeros((len(line_histograms), FOUR + 1), dtype=np.int64)
+    values[:, :FOUR] = line_histograms[:, own_i, ::-1] - line_histograms[:, 1 - own_i, ::-1]
+    return values
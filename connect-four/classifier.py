@@ -13,7 +13,7 @@ from tensorflow.python.keras.optimizers import Adam
 from tqdm import tqdm
 
 from observer import AlphaConnectSerializer
-from state import State, FOUR, Action, Augmentation
+from state import State, FOUR, Action, Augmentation, encode_batch, augment_policy
 from util import list_files, winner_value
 
 
@@ -41,7 +41,8 @@ def read_data(data_path, max_games=None):
         game_files = list(game_files)[-max_games:]
         print('Using game files from %s to %s' % (game_files[0], game_files[-1]))
 
-    x = []
+    x_states = []
+    x_augmentations = []
     y_policy = []
     y_reward = []
 
@@ -61,13 +62,13 @@ def read_data(data_path, max_games=None):
         n_samples = min(len(states), len(augmentations))
         game_samples = sample(list(range(len(states))), n_samples)
         for augmentation, i in zip(augmentations, game_samples):
-            augmentend_action_order = sorted(Action.iter_actions(), key=lambda a: a.augment(augmentation).to_int())
-
-            x.append(states[i].to_numpy(augmentation))
-            y_policy.append([policies[i].get(action, 0.0) for action in augmentend_action_order])
+            x_states.append(states[i])
+            x_augmentations.append(augmentation)
+            y_policy.append([policies[i].get(action, 0.0) for action in Action.iter_actions()])
             y_reward.append(winner_value(final_state.winner, states[i]))
 
-    return np.array(x), np.array(y_policy), np.array(y_reward)
+    x = encode_batch(x_states, x_augmentations)
+    return x, augment_policy(np.array(y_policy), x_augmentations), np.array(y_reward)
 
 
 def create_model(input_size, filters, c=10 ** -4):
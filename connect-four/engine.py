@@ -0,0 +1,309 @@
+"""Forward pass of the AlphaConnect network in NumPy, without TensorFlow
+
+The layers of a Keras model are read from its `model_config` and evaluated in the order of the config. Batch
+normalizations that directly follow a convolution are folded into the kernel and bias of that convolution, other batch
+normalizations are evaluated as a scale and shift per channel. Only the layers of `classifier.create_model` are
+supported.
+
+A model can be exported to a flat file, with a JSON header of the config and the offsets of the weights followed by the
+weights as float32 or float16. The weights of an exported model are memory mapped, such that loading does not need
+h5py and only reads the pages of the weights. Float16 weights halve the file and the bytes that are read, and are
+computed with in float32, as NumPy has no fast matrix product for float16.
+
+Encoded states are small counts, the model takes them as uint8 planes.
+"""
+import json
+import os
+import random
+import tempfile
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from state import State, encode_batch
+from util import list_files
+
+TensorKey = Tuple[str, int]
+Step = Tuple[TensorKey, Callable, List[TensorKey]]
+
+EXPORT_EXTENSION = '.npmodel'
+_EXPORT_MAGIC = b'ACNPMDL1'
+_EXPORT_ALIGNMENT = 64
+
+WEIGHT_DTYPES = {'float32': '<f4', 'float16': '<f2'}
+
+_ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'sigmoid': lambda x: .5 * np.tanh(.5 * x) + .5,
+    'tanh': np.tanh,
+    'softmax': lambda x: _softmax(x, -1),
+}
+
+
+class NumpyModel(object):
+    """Model with the `predict` method of a Keras model, that is evaluated with NumPy"""
+    input_dtype = np.uint8
+
+    def __init__(self, config: Dict, weights: Dict[str, List[np.ndarray]], dtype=np.float32):
+        """
+        :param config: `model_config` of a Keras functional model
+        :param weights: weights of each layer, in the order of the layer's `weights`
+        """
+        self.config = config
+        self.dtype = dtype
+        self.input_key = _tensor_key(config['config']['input_layers'][0])
+        self.output_keys = [_tensor_key(output) for output in config['config']['output_layers']]
+        weights = {name: [np.asarray(weight, dtype=dtype) for weight in layer_weights]
+                   for name, layer_weights in weights.items()}
+        self.steps = _compile(config['config']['layers'], weights)
+
+    @classmethod
+    def from_h5(cls, model_path: str, dtype=np.float32) -> 'NumpyModel':
+        """Read the config and weights of a model that was saved by Keras"""
+        config, weights = _read_h5(model_path)
+        return cls(config, weights, dtype)
+
+    @classmethod
+    def from_export(cls, model_path: str, dtype=np.float32) -> 'NumpyModel':
+        """Memory map a model that was written by `export_model`"""
+        with open(model_path, 'rb') as model_file:
+            magic = model_file.read(len(_EXPORT_MAGIC))
+            if magic != _EXPORT_MAGIC:
+                raise ValueError('Not an exported model: %s' % model_path)
+            header_size = int.from_bytes(model_file.read(8), 'little')
+            header = json.loads(model_file.read(header_size).decode())
+        data = np.memmap(model_path, dtype=WEIGHT_DTYPES[header.get('weight_dtype', 'float32')], mode='r',
+                         offset=_export_data_offset(header_size))
+        weights = {layer_name: [data[offset:offset + int(np.prod(shape))].reshape(shape) for offset, shape in layer]
+                   for layer_name, layer in header['weights'].items()}
+        return cls(header['config'], weights, dtype)
+
+    def predict(self, array: np.ndarray) -> List[np.ndarray]:
+        tensors = {self.input_key: np.asarray(array, dtype=self.dtype)}
+        for output_key, function, input_keys in self.steps:
+            tensors[output_key] = function(*[tensors[input_key] for input_key in input_keys])
+        return [tensors[output_key] for output_key in self.output_keys]
+
+
+def export_model(model_path: str, export_path: str, weight_dtype='float32'):
+    """Write the config and weights of a Keras model file as a flat file that is read by `NumpyModel.from_export`
+
+    :param weight_dtype: 'float32' or 'float16', the precision of the weights in the file
+    """
+    if weight_dtype not in WEIGHT_DTYPES:
+        raise ValueError('Weight dtype should be one of %s, not %r' % (', '.join(WEIGHT_DTYPES), weight_dtype))
+    config, weights = _read_h5(model_path)
+    offsets, offset = {}, 0
+    for layer_name, layer_weights in weights.items():
+        offsets[layer_name] = []
+        for weight in layer_weights:
+            offsets[layer_name].append((offset, list(weight.shape)))
+            offset += weight.size
+    encoded_header = json.dumps({'config': config, 'weights': offsets, 'weight_dtype': weight_dtype}).encode()
+    data_offset = _export_data_offset(len(encoded_header))
+
+    # write to a temporary file first, such that players never load a partial model
+    directory = os.path.dirname(os.path.abspath(export_path))
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=EXPORT_EXTENSION, delete=False) as export_file:
+        export_file.write(_EXPORT_MAGIC)
+        export_file.write(len(encoded_header).to_bytes(8, 'little'))
+        export_file.write(encoded_header)
+        export_file.write(b'\0' * (data_offset - export_file.tell()))
+        for layer_weights in weights.values():
+            for weight in layer_weights:
+                export_file.write(np.ascontiguousarray(weight, dtype=WEIGHT_DTYPES[weight_dtype]).tobytes())
+    os.replace(export_file.name, export_path)
+
+
+def agreement(model, reference, states: List[State]) -> Dict[str, float]:
+    """Fraction of the states where both models have the same best allowed action, and the mean absolute difference
+    of their values
+
+    :param model: model with a `predict` method, e.g. with float16 weights
+    :param reference: model with a `predict` method, e.g. the float32 `NumpyModel`
+    """
+    array = encode_batch(states, dtype=np.uint8)
+    (policy, value), (reference_policy, reference_value) = model.predict(array), reference.predict(array)
+    allowed = np.zeros(policy.shape, dtype=bool)
+    for i, state in enumerate(states):
+        allowed[i, [action.to_int() for action in state.allowed_actions]] = True
+    best = np.where(allowed, policy, -np.inf).argmax(axis=1)
+    reference_best = np.where(allowed, reference_policy, -np.inf).argmax(axis=1)
+    return {'top1_agreement': float(np.mean(best == reference_best)),
+            'value_mae': float(np.mean(np.abs(value - reference_value)))}
+
+
+def sample_states(data_dir: str, number_of_states: int) -> List[State]:
+    """States of the self-play games in a data directory, completed with states of random games if it has too few"""
+    from observer import AlphaConnectSerializer
+
+    states = []
+    game_files = list(list_files(data_dir, '.json')) if os.path.isdir(data_dir) else []
+    for game_path in random.sample(game_files, len(game_files)):
+        with open(game_path, 'r') as fin:
+            _, _, actions, _ = AlphaConnectSerializer.deserialize(json.load(fin))
+        state = State.empty()
+        for action in actions:
+            states.append(state)
+            state = state.take_action(action)
+        if len(states) >= number_of_states:
+            return random.sample(states, number_of_states)
+
+    while len(states) < number_of_states:
+        state = State.empty()
+        while not state.is_end_of_game() and len(states) < number_of_states:
+            states.append(state)
+            state = state.take_action(random.choice(list(state.allowed_actions)))
+    return states
+
+
+def _export_data_offset(header_size: int) -> int:
+    """Weights start at the first aligned offset after the magic, header size and header"""
+    header_end = len(_EXPORT_MAGIC) + 8 + header_size
+    return -(-header_end // _EXPORT_ALIGNMENT) * _EXPORT_ALIGNMENT
+
+
+def _read_h5(model_path: str) -> Tuple[Dict, Dict[str, List[np.ndarray]]]:
+    import h5py
+
+    with h5py.File(model_path, 'r') as model_file:
+        config = json.loads(_decode(model_file.attrs['model_config']))
+        model_weights = model_file['model_weights']
+        weights = {}
+        for layer_name in model_weights.attrs['layer_names']:
+            layer_group = model_weights[_decode(layer_name)]
+            weights[_decode(layer_name)] = [layer_group[_decode(weight_name)][()]
+                                            for weight_name in layer_group.attrs['weight_names']]
+    return config, weights
+
+
+def _decode(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _tensor_key(inbound) -> TensorKey:
+    return inbound[0], inbound[1]
+
+
+def _compile(layers: List[Dict], weights: Dict[str, List[np.ndarray]]) -> List[Step]:
+    """Steps of the forward pass: the key of the output tensor, the function and the keys of the input tensors"""
+    number_of_consumers = {}
+    producers = {}
+    for layer in layers:
+        for node_index, inbound_node in enumerate(layer['inbound_nodes']):
+            producers[(layer['name'], node_index)] = layer
+            for inbound in inbound_node:
+                number_of_consumers[_tensor_key(inbound)] = number_of_consumers.get(_tensor_key(inbound), 0) + 1
+
+    folded = set()
+    for layer in layers:
+        if layer['class_name'] == 'BatchNormalization' and len(layer['inbound_nodes']) == 1:
+            input_key = _tensor_key(layer['inbound_nodes'][0][0])
+            producer = producers.get(input_key)
+            if producer is not None and producer['class_name'] == 'Conv3D' and \
+                    len(producer['inbound_nodes']) == 1 and number_of_consumers[input_key] == 1 and \
+                    producer['config']['activation'] == 'linear':
+                scale, shift = _batch_normalization_affine(layer, weights[layer['name']])
+                kernel, bias = _kernel_and_bias(producer, weights[producer['name']])
+                weights[producer['name']] = [kernel * scale, bias * scale + shift]
+                folded.add(layer['name'])
+
+    steps = []
+    for layer in layers:
+        for node_index, inbound_node in enumerate(layer['inbound_nodes']):
+            input_keys = [_tensor_key(inbound) for inbound in inbound_node]
+            if layer['name'] in folded:
+                function = _identity
+            else:
+                function = _layer_function(layer, weights.get(layer['name'], []))
+            steps.append(((layer['name'], node_index), function, input_keys))
+    return steps
+
+
+def _layer_function(layer: Dict, layer_weights: List[np.ndarray]) -> Callable:
+    class_name, config = layer['class_name'], layer['config']
+    if class_name == 'Conv3D':
+        if config['padding'] != 'valid' or tuple(config['strides']) != (1, 1, 1) or \
+                tuple(config.get('dilation_rate', (1, 1, 1))) != (1, 1, 1):
+            raise ValueError('Only valid convolutions with strides and dilation 1 are supported: %s' % layer['name'])
+        kernel, bias = _kernel_and_bias(layer, layer_weights)
+        activation = _ACTIVATIONS[config['activation']]
+        return lambda x: activation(_convolution(x, kernel, bias))
+    elif class_name == 'Dense':
+        kernel, bias = _kernel_and_bias(layer, layer_weights)
+        activation = _ACTIVATIONS[config['activation']]
+        return lambda x: activation(x @ kernel + bias)
+    elif class_name == 'BatchNormalization':
+        scale, shift = _batch_normalization_affine(layer, layer_weights)
+        return lambda x: x * scale + shift
+    elif class_name == 'ReLU':
+        if config.get('max_value') is not None or config.get('negative_slope', 0.0) != 0.0 or \
+                config.get('threshold', 0.0) != 0.0:
+            raise ValueError('Only ReLU layers without max value, negative slope and threshold are supported')
+        return _ACTIVATIONS['relu']
+    elif class_name == 'Softmax':
+        axis = config.get('axis', -1)
+        return lambda x: _softmax(x, axis)
+    elif class_name == 'Permute':
+        axes = (0,) + tuple(config['dims'])
+        return lambda x: x.transpose(axes)
+    elif class_name == 'Reshape':
+        shape = (-1,) + tuple(config['target_shape'])
+        return lambda x: x.reshape(shape)
+    elif class_name == 'Flatten':
+        return lambda x: x.reshape((len(x), -1))
+    elif class_name == 'RepeatVector':
+        n = config['n']
+        return lambda x: np.broadcast_to(x[:, None, :], (len(x), n, x.shape[1]))
+    elif class_name == 'Concatenate':
+        axis = config.get('axis', -1)
+        return lambda *xs: np.concatenate(xs, axis=axis)
+    raise ValueError('Layer %s of class %s is not supported by the NumPy engine' % (layer['name'], class_name))
+
+
+def _kernel_and_bias(layer: Dict, layer_weights: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    if layer['config'].get('use_bias', True):
+        return layer_weights[0], layer_weights[1]
+    return layer_weights[0], np.zeros(layer_weights[0].shape[-1], dtype=layer_weights[0].dtype)
+
+
+def _batch_normalization_affine(layer: Dict, layer_weights: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    config = layer['config']
+    axis = config['axis']
+    if axis not in (-1, 4, [4], [-1]):
+        raise ValueError('Only batch normalization of the channels is supported: %s' % layer['name'])
+    layer_weights = list(layer_weights)
+    gamma = layer_weights.pop(0) if config.get('scale', True) else 1.0
+    beta = layer_weights.pop(0) if config.get('center', True) else 0.0
+    moving_mean, moving_variance = layer_weights
+    scale = gamma / np.sqrt(moving_variance + config['epsilon'])
+    return scale, beta - moving_mean * scale
+
+
+def _convolution(x: np.ndarray, kernel: np.ndarray, bias: np.ndarray) -> np.ndarray:
+    """Valid 3D convolution of channels last inputs, as a matrix product with the windows of the input"""
+    kernel_size, output_channels = kernel.shape[:3], kernel.shape[4]
+    if kernel_size != (1, 1, 1):
+        x = _windows(x, kernel_size)
+        kernel = kernel.transpose((3, 0, 1, 2, 4))
+    # a single matrix product, matmul of stacked matrices multiplies each position separately
+    output = x.reshape((-1, kernel.size // output_channels)) @ kernel.reshape((-1, output_channels)) + bias
+    return output.reshape(x.shape[:4] + (output_channels,))
+
+
+def _windows(x: np.ndarray, kernel_size: Tuple[int, int, int]) -> np.ndarray:
+    """Read only view of the windows of a channels last input: batch, x, y, z, channel, kernel x, y, z"""
+    shape = x.shape[:1] + tuple(size - k + 1 for size, k in zip(x.shape[1:4], kernel_size)) + x.shape[4:] + \
+        tuple(kernel_size)
+    return as_strided(x, shape, x.strides + x.strides[1:4], writeable=False)
+
+
+def _softmax(x: np.ndarray, axis: int) -> np.ndarray:
+    exponentials = np.exp(x - x.max(axis=axis, keepdims=True))
+    return exponentials / exponentials.sum(axis=axis, keepdims=True)
+
+
+def _identity(x: np.ndarray) -> np.ndarray:
+    return x
@@ -29,6 +29,17 @@ class TwoPlayerGame(object):
         self.datetime_end = datetime.datetime.utcnow()
         self._notify_end_game()
 
+    def play_iter(self):
+        """Play as a generator, that yields whenever a player yields while deciding, see `Player.decide_iter`"""
+        self.datetime_start = datetime.datetime.utcnow()
+        self._notify_new_state(self.current_state)
+        while not self.current_state.is_end_of_game():
+            player = self.next_player()
+            action = yield from player.decide_iter(self.current_state)
+            self.play_action(player, action)
+        self.datetime_end = datetime.datetime.utcnow()
+        self._notify_end_game()
+
     def _turn(self):
         player = self.next_player()
         action = player.decide(self.current_state)
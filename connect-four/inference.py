@@ -0,0 +1,240 @@
+"""Inference server that evaluates the states of search workers in shared batches
+
+The server process owns the models, such that search workers do not need to import TensorFlow. Each worker has a ring
+buffer of request slots in shared memory. A worker writes the encoded states of a request into a slot and waits until
+the server has written the policies and values into the same slot. The server batches the requests of all workers,
+until the batch is full or the first request has waited for the maximum latency.
+"""
+import ctypes
+import multiprocessing
+import time
+from collections import OrderedDict
+from multiprocessing.sharedctypes import RawArray
+from multiprocessing.util import Finalize
+from typing import List, Tuple, Union
+
+import numpy as np
+
+from state import FOUR, NUMBER_OF_FEATURES
+
+MAX_PATH_LENGTH = 1024
+
+_CLIENT = None  # type: Union[None, InferenceClient]
+
+
+class InferenceChannels(object):
+    """Shared memory and semaphores between the server and the workers
+
+    Channels are created before the server and worker processes are started, such that they inherit them.
+    """
+
+    def __init__(self, number_of_workers: int, slots_per_worker=2, slot_size=256):
+        self.number_of_workers = number_of_workers
+        self.slots_per_worker = slots_per_worker
+        self.slot_size = slot_size
+
+        number_of_slots = number_of_workers * slots_per_worker
+        self._features = RawArray(ctypes.c_uint8, number_of_slots * slot_size * FOUR ** 3 * NUMBER_OF_FEATURES)
+        self._policies = RawArray(ctypes.c_float, number_of_slots * slot_size * FOUR ** 2)
+        self._values = RawArray(ctypes.c_float, number_of_slots * slot_size)
+        self._sizes = RawArray(ctypes.c_int64, number_of_slots)
+        self._paths = RawArray(ctypes.c_char, number_of_slots * MAX_PATH_LENGTH)
+        self._counters = RawArray(ctypes.c_int64, number_of_workers * 2)
+        self._arrays = None
+
+        self.requests = multiprocessing.Semaphore(0)
+        self.responses = [multiprocessing.Semaphore(0) for _ in range(number_of_workers)]
+        self.free_workers = multiprocessing.Queue()
+        for worker_i in range(number_of_workers):
+            self.free_workers.put(worker_i)
+        self.stop = multiprocessing.Event()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def arrays(self):
+        """Numpy views on the shared memory: features, policies, values and sizes of each slot, and the number of
+        submitted and answered requests of each worker"""
+        if self._arrays is None:
+            slots = (self.number_of_workers, self.slots_per_worker)
+            self._arrays = (
+                np.frombuffer(self._features, dtype=np.uint8).reshape(
+                    slots + (self.slot_size, FOUR, FOUR, FOUR, NUMBER_OF_FEATURES)),
+                np.frombuffer(self._policies, dtype=np.float32).reshape(slots + (self.slot_size, -1)),
+                np.frombuffer(self._values, dtype=np.float32).reshape(slots + (self.slot_size,)),
+                np.frombuffer(self._sizes, dtype=np.int64).reshape(slots),
+                np.frombuffer(self._counters, dtype=np.int64).reshape((self.number_of_workers, 2)),
+            )
+        return self._arrays
+
+    def slot_path(self, worker_i: int, slot_i: int) -> str:
+        start = (worker_i * self.slots_per_worker + slot_i) * MAX_PATH_LENGTH
+        return self._paths[start:start + MAX_PATH_LENGTH].rstrip(b'\0').decode()
+
+    def set_slot_path(self, worker_i: int, slot_i: int, model_path: str):
+        encoded_path = model_path.encode()
+        if len(encoded_path) > MAX_PATH_LENGTH:
+            raise ValueError('Model path is longer than %d bytes: %s' % (MAX_PATH_LENGTH, model_path))
+        start = (worker_i * self.slots_per_worker + slot_i) * MAX_PATH_LENGTH
+        self._paths[start:start + MAX_PATH_LENGTH] = encoded_path.ljust(MAX_PATH_LENGTH, b'\0')
+
+
+class InferenceClient(object):
+    """Worker side of the channels, sends requests through the ring buffer of one worker"""
+
+    def __init__(self, channels: InferenceChannels, worker_i: int):
+        self.channels = channels
+        self.worker_i = worker_i
+        _, _, _, _, counters = channels.arrays()
+        self.number_of_received = int(counters[worker_i, 1])
+
+    def model(self, model_path: str) -> 'RemoteModel':
+        return RemoteModel(self, model_path)
+
+    def submit(self, model_path: str, features: np.ndarray):
+        features_slots, _, _, sizes, counters = self.channels.arrays()
+        number_of_submitted = int(counters[self.worker_i, 0])
+        assert number_of_submitted - self.number_of_received < self.channels.slots_per_worker, 'ring buffer is full'
+
+        slot_i = number_of_submitted % self.channels.slots_per_worker
+        features_slots[self.worker_i, slot_i, :len(features)] = features
+        sizes[self.worker_i, slot_i] = len(features)
+        self.channels.set_slot_path(self.worker_i, slot_i, model_path)
+        counters[self.worker_i, 0] = number_of_submitted + 1
+        self.channels.requests.release()
+
+    def receive(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Policies and values of the oldest request that was not received yet"""
+        self.channels.responses[self.worker_i].acquire()
+        _, policies, values, sizes, _ = self.channels.arrays()
+        slot_i = self.number_of_received % self.channels.slots_per_worker
+        size = sizes[self.worker_i, slot_i]
+        self.number_of_received += 1
+        return policies[self.worker_i, slot_i, :size].copy(), values[self.worker_i, slot_i, :size, None].copy()
+
+    def predict(self, model_path: str, array: np.ndarray) -> List[np.ndarray]:
+        """Evaluate the encoded states, requests of at most one slot size fill the ring buffer of this worker"""
+        slot_size, slots_per_worker = self.channels.slot_size, self.channels.slots_per_worker
+        chunks = [array[start:start + slot_size] for start in range(0, len(array), slot_size)]
+        results = []
+        for i, chunk in enumerate(chunks):
+            if i >= slots_per_worker:
+                results.append(self.receive())
+            self.submit(model_path, chunk)
+        while len(results) < len(chunks):
+            results.append(self.receive())
+        policies, values = zip(*results)
+        return [np.concatenate(policies), np.concatenate(values)]
+
+
+class RemoteModel(object):
+    """Model with the `predict` method of a Keras model, that is evaluated by the inference server"""
+    input_dtype = np.uint8
+
+    def __init__(self, client: InferenceClient, model_path: str):
+        self.client = client
+        self.model_path = model_path
+
+    def predict(self, array: np.ndarray) -> List[np.ndarray]:
+        return self.client.predict(self.model_path, array)
+
+
+def connect_worker(channels: InferenceChannels):
+    """Claim a ring buffer for this process, used as initializer of a worker pool
+
+    The ring buffer is released when the process exits, such that pools with `maxtasksperchild` can reuse it.
+    """
+    global _CLIENT
+    worker_i = channels.free_workers.get()
+    _CLIENT = InferenceClient(channels, worker_i)
+    Finalize(_CLIENT, channels.free_workers.put, args=(worker_i,), exitpriority=10)
+
+
+def worker_client() -> Union[None, InferenceClient]:
+    """Client of this process, if it is a worker of an inference server"""
+    return _CLIENT
+
+
+def serve(channels: InferenceChannels, max_batch_size=256, max_latency=0.005, load_model=None, max_models=2):
+    """Evaluate the requests of workers until the channels are stopped
+
+    :param max_latency: seconds that the first request of a batch waits for other requests to fill the batch
+    :param load_model: function that loads a model from a path, by default a Keras model
+    :param max_models: number of most recently used models that are kept in memory
+    """
+    if load_model is None:
+        from player import load_model
+    models = OrderedDict()
+    _, _, _, sizes, counters = channels.arrays()
+    number_of_answered = counters[:, 1].copy()
+
+    while not channels.stop.is_set():
+        channels.requests.acquire(timeout=0.1)
+        requests = _pending_requests(channels, number_of_answered)
+        if len(requests) == 0:
+            continue
+
+        deadline = time.monotonic() + max_latency
+        while sum(sizes[worker_i, slot_i] for worker_i, slot_i in requests) < max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not channels.requests.acquire(timeout=remaining):
+                break
+            requests = _pending_requests(channels, number_of_answered)
+
+        for model_path, model_requests in _group_by_model(channels, requests).items():
+            if model_path not in models:
+                models[model_path] = load_model(model_path)
+                if len(models) > max_models:
+                    models.popitem(last=False)
+            models.move_to_end(model_path)
+            _evaluate(channels, models[model_path], model_requests)
+
+        for worker_i, slot_i in requests:
+            number_of_answered[worker_i] += 1
+            counters[worker_i, 1] = number_of_answered[worker_i]
+            channels.responses[worker_i].release()
+
+
+def _pending_requests(channels: InferenceChannels, number_of_answered: np.ndarray) -> List[Tuple[int, int]]:
+    _, _, _, _, counters = channels.arrays()
+    return [(worker_i, request_i % channels.slots_per_worker)
+            for worker_i in range(channels.number_of_workers)
+            for request_i in range(number_of_answered[worker_i], counters[worker_i, 0])]
+
+
+def _group_by_model(channels: InferenceChannels, requests: List[Tuple[int, int]]):
+    grouped = OrderedDict()
+    for worker_i, slot_i in requests:
+        grouped.setdefault(channels.slot_path(worker_i, slot_i), []).append((worker_i, slot_i))
+    return grouped
+
+
+def _evaluate(channels: InferenceChannels, model, requests: List[Tuple[int, int]]):
+    features, policies, values, sizes, _ = channels.arrays()
+    array = np.concatenate([features[worker_i, slot_i, :sizes[worker_i, slot_i]] for worker_i, slot_i in requests])
+    pred_policies, pred_values = model.predict(array.astype(getattr(model, 'input_dtype', np.float32)))
+
+    start = 0
+    for worker_i, slot_i in requests:
+        size = sizes[worker_i, slot_i]
+        policies[worker_i, slot_i, :size] = pred_policies[start:start + size]
+        values[worker_i, slot_i, :size] = pred_values[start:start + size, 0]
+        start += size
+
+
+def start_server(number_of_workers: int, max_batch_size=256, max_latency=0.005, load_model=None) \
+        -> Tuple[InferenceChannels, multiprocessing.Process]:
+    """Start a server process for a number of workers, connect the workers with `connect_worker`"""
+    channels = InferenceChannels(number_of_workers, slot_size=max_batch_size)
+    process = multiprocessing.Process(target=serve, args=(channels, max_batch_size, max_latency, load_model),
+                                      daemon=True)
+    process.start()
+    return channels, process
+
+
+def stop_server(channels: InferenceChannels, process: multiprocessing.Process):
+    channels.stop.set()
+    channels.requests.release()
+    process.join()
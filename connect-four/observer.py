@@ -122,12 +122,18 @@ class AlphaConnectPrinter(Observer):
             mcts_policy = player.root.policy(1.0)
             mcts_value = player.root.average_value
             mcts_emotion = self.express_evaluation_as_emotion(mcts_value)
-            raw_policy, raw_value = self.raw_predictions(player, game.current_state)
+            # root parallel players evaluate the model in their workers
+            raw_policy, raw_value = None, None
+            if player.model is not None:
+                raw_policy, raw_value = self.raw_predictions(player, game.current_state)
 
             print('%s is done' % player)
             print('It looked at %d states' % player.root.visit_count)
-            print('At first, it values the current state as %.2f' % raw_value)
-            print('At first, it wants to play:\n%s' % format_in_action_grid(raw_policy))
+            if player.ponder_stats['reused_visits'] > 0:
+                print('It looked at %d of them while you were thinking' % player.ponder_stats['reused_visits'])
+            if raw_policy is not None:
+                print('At first, it values the current state as %.2f' % raw_value)
+                print('At first, it wants to play:\n%s' % format_in_action_grid(raw_policy))
             print('After searching, it values the current state as %.2f' % mcts_value)
             print('After searching, it wants to play:\n%s' % format_in_action_grid(mcts_policy))
             print('It feels %s' % mcts_emotion, end='\n\n')
@@ -151,3 +157,17 @@ class AlphaConnectPrinter(Observer):
         pred_actions, pred_value = player.model.model.predict(state.to_numpy(batch=True))
         action_probs = dict(zip(Action.iter_actions(), pred_actions[0]))
         return action_probs, pred_value[0].item()
+
+
+class Ponderer(Observer):
+    """Lets the player search while the opponent decides"""
+
+    def __init__(self, player: AlphaConnectPlayer):
+        self.player = player
+
+    def notify_new_state(self, game: TwoPlayerGame, state: State):
+        if game.players[state.next_color] is not self.player:
+            self.player.ponder(state)
+
+    def notify_end_game(self, game: TwoPlayerGame):
+        self.player.stop_pondering()
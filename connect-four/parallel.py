@@ -0,0 +1,157 @@
+"""Parallel search from a single root
+
+Root parallel search runs a process per worker, each with its own tree, and merges the visit counts of the actions of
+the root. Tree parallel search runs a thread per worker on the same tree. The tree is locked while selecting, expanding
+and backing up, and virtual loss steers the threads to different leaves. Due to the global interpreter lock the threads
+only overlap the model predictions with each other and with the tree operations.
+"""
+import multiprocessing
+import os
+import random
+import threading
+import time
+from multiprocessing.pool import Pool
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from state import Action, State
+from tree import AlphaConnectNode, BatchEvaluator, EvaluatorClient
+
+_WORKER_PLAYER = None
+
+
+class RootParallelSearch(object):
+    """Pool of processes that each search from the root with their own player
+
+    The pool is created when the players of all workers are loaded, such that searches are not delayed by the start of
+    the processes and the loading of the models.
+    """
+
+    def __init__(self, workers: int, player_kwargs: Dict):
+        self.workers = workers
+        ready = multiprocessing.Semaphore(0)
+        self.pool = Pool(workers, _initialize_worker, (player_kwargs, ready))
+        for _ in range(workers):
+            ready.acquire()
+
+    def search(self, state: State) -> Tuple[AlphaConnectNode, int, Union[None, Action]]:
+        """Root with the merged visit counts and total values of the workers, the number of searches, and the proven or
+        forced action of the solver if a worker found one
+
+        The root and its children only count the searches of this call. A worker may run more than one of the tasks,
+        and its tree keeps the visits of its earlier tasks. Workers stop searching a solved root, such that its children
+        may have no visits.
+        """
+        results = self.pool.map(_search_root, [state] * self.workers, chunksize=1)
+        searches = sum(worker_searches for _, _, worker_searches, _ in results)
+        proven_action = next((action for _, _, _, action in results if action is not None), None)
+        root = AlphaConnectNode(state, action_prob=1.0)
+        root.total_value = sum(total_value for _, total_value, _, _ in results)
+        root.visit_count = 1 + searches
+        root.is_played = True
+        for worker_children, _, _, _ in results:
+            for action, (visit_count, total_value, action_prob) in worker_children.items():
+                if action not in root.children:
+                    root.children[action] = AlphaConnectNode(None, action_prob, parent=root, action=action)
+                    root.children[action].visit_count, root.children[action].total_value = 0, 0.0
+                root.children[action].visit_count += visit_count
+                root.children[action].total_value += total_value
+        # actions that no worker visited in this call have no statistics
+        root.children = {action: child for action, child in root.children.items() if child.visit_count > 0}
+        return root, searches, proven_action
+
+    def close(self):
+        self.pool.terminate()
+
+
+def _initialize_worker(player_kwargs: Dict, ready):
+    global _WORKER_PLAYER
+    from player import AlphaConnectPlayer
+    # forked workers inherit the random state, searches would be the same without reseeding
+    seed = int.from_bytes(os.urandom(4), 'little')
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        _WORKER_PLAYER = AlphaConnectPlayer(**player_kwargs)
+    finally:
+        # also when loading fails, such that the pool does not wait forever
+        ready.release()
+
+
+def _search_root(state: State):
+    """Visit count, total value and prior of each action, and total value and visit count of the root, added by this
+    search, and the proven or forced action of the solver"""
+    player = _WORKER_PLAYER
+    player.set_root_node(state)
+    children = {action: (child.visit_count, child.total_value) for action, child in player.root.children.items()}
+    total_value, visit_count = player.root.total_value, player.root.visit_count
+    player.run(player.search_iter())
+    children = {action: (child.visit_count - children.get(action, (0, 0.0))[0],
+                         child.total_value - children.get(action, (0, 0.0))[1], child.action_prob)
+                for action, child in player.root.children.items()}
+    proven_action = player.root.proven_action() if player.solver else None
+    return children, player.root.total_value - total_value, player.root.visit_count - visit_count, proven_action
+
+
+def tree_parallel_search(root, model: Union[BatchEvaluator, EvaluatorClient], c_puct: float, virtual_loss: float,
+                         workers: int, budget_type: str, budget: int) -> int:
+    """Search a shared tree with threads, and return the number of searches
+
+    Each thread collects a batch of leaves with its own queue while holding the lock of the tree, predicts the batch
+    without the lock, and backs up the evaluations while holding the lock again.
+    """
+    lock = threading.Lock()
+    t0 = time.time()
+    searches = [0]
+    # an `EvaluatorClient` of a shared evaluator only queues nodes, the threads predict with the evaluator behind it
+    model = getattr(model, 'evaluator', model)
+
+    def has_budget():
+        if budget_type == 'time':
+            return time.time() - t0 < budget / 1000
+        return searches[0] < budget
+
+    def search():
+        # one more than the number of searches per batch, such that the queue is never evaluated while locked
+        evaluator = BatchEvaluator(model.model, model.batch_size + 1, getattr(model, 'cache', None))
+        while True:
+            with lock:
+                for _ in range(model.batch_size):
+                    if not has_budget():
+                        break
+                    root.search(evaluator, c_puct, virtual_loss)
+                    searches[0] += 1
+                queue = evaluator.take_queue()
+            if len(queue) > 0:
+                predictions = evaluator.predict_queue(queue)
+                with lock:
+                    evaluator.backup_queue(queue, predictions)
+            with lock:
+                if not has_budget():
+                    break
+
+    threads = [threading.Thread(target=search) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return searches[0]
+
+
+def speedup_curve(model_path: str, max_workers: int, time_budget: int, mode: str) -> List[Tuple[int, float]]:
+    """Searches per second of a move from the empty state, with 1 up to `max_workers` workers
+
+    The players are created before timing, root parallel players only return when their workers are loaded.
+    """
+    from player import AlphaConnectPlayer
+
+    curve = []
+    for workers in range(1, max_workers + 1):
+        player = AlphaConnectPlayer(model_path, start_temperature=None, time_budget=time_budget, parallel=mode,
+                                    workers=workers)
+        t0 = time.time()
+        player.decide(State.empty())
+        curve.append((workers, player.last_number_of_searches / (time.time() - t0)))
+        player.close()
+    return curve
@@ -1,17 +1,72 @@
+import os
+import sys
+import threading
 import time
 from abc import ABCMeta, abstractmethod
 from operator import itemgetter
 from random import choice
-from typing import Union
+from typing import Union, Dict
+
+from analyzer import child_values
+from engine import EXPORT_EXTENSION, NumpyModel
+from inference import worker_client
+from parallel import RootParallelSearch, tree_parallel_search
+from state import State, FOUR, Action, encode_batch
+from tree import AlphaBetaSearch, MonteCarloNode, AlphaConnectNode, BatchEvaluator, AlphaConnectArrayTree, \
+    EvaluationCache, AlphaConnectGraphNode, EvaluatorClient, AlphaConnectSolverNode, is_decided
+from util import format_in_action_grid
 
-import numpy as np
-from tensorflow.python.keras import backend as K
-from tensorflow.python.keras.engine.saving import load_model
 
-from analyzer import player_value
-from state import State, FOUR, Action
-from tree import MiniMaxNode, MonteCarloNode, AlphaConnectNode, BatchEvaluator
-from util import format_in_action_grid
+BACKENDS = ('keras', 'numpy')
+
+
+def load_model(model_path, backend='keras'):
+    """Load a model with the `predict` method of a Keras model
+
+    Models that were exported with `engine.export_model` are always evaluated with NumPy, the backend only applies to
+    Keras model files.
+
+    :param backend: 'keras' for a Keras model, TensorFlow is only imported by processes that load such a model, or
+        'numpy' for a `NumpyModel` that does not need TensorFlow
+    """
+    if model_path.endswith(EXPORT_EXTENSION):
+        return NumpyModel.from_export(model_path)
+    elif backend == 'numpy':
+        return NumpyModel.from_h5(model_path)
+    elif backend == 'keras':
+        from tensorflow.python.keras.engine.saving import load_model as load_keras_model
+        return load_keras_model(model_path)
+    raise ValueError('Backend should be one of %s, not %r' % (', '.join(BACKENDS), backend))
+
+
+_EVALUATION_CACHES = {}  # type: Dict[str, EvaluationCache]
+
+
+def evaluation_cache(model_path, max_size) -> EvaluationCache:
+    """Evaluation cache of a model, shared by all players in this process and cleared when the model file changes"""
+    model_path = os.path.abspath(model_path)
+    if model_path not in _EVALUATION_CACHES:
+        _EVALUATION_CACHES[model_path] = EvaluationCache(max_size)
+    cache = _EVALUATION_CACHES[model_path]
+    cache.set_model(os.path.getmtime(model_path))
+    return cache
+
+
+def release_evaluation_caches(keep_model_path=None):
+    """Drop the evaluation caches of all models, except the model that is still in use"""
+    keep_model_path = None if keep_model_path is None else os.path.abspath(keep_model_path)
+    for model_path in list(_EVALUATION_CACHES.keys()):
+        if model_path != keep_model_path:
+            del _EVALUATION_CACHES[model_path]
+
+
+def reuse_node(root, state: State):
+    """Node of the state, found by following the actions that were taken since the state of the root"""
+    actions = state.actions_since(root.state)
+    node = None if actions is None else root.follow(actions)
+    if node is None or node.state != state:
+        return None
+    return node
 
 
 class Player(metaclass=ABCMeta):
@@ -31,6 +86,15 @@ class Player(metaclass=ABCMeta):
     def decide(self, state: State):
         pass
 
+    def decide_iter(self, state: State):
+        """Decide as a generator, that yields whether it waits for the evaluation of queued nodes and returns the
+        action
+
+        Games can interleave the decisions of their players, such that their searches share batches of evaluations.
+        """
+        yield from ()
+        return self.decide(state)
+
 
 class ConsolePlayer(Player):
     def decide(self, state: State):
@@ -60,34 +124,34 @@ class RandomPlayer(Player):
 
 class GreedyPlayer(Player):
     def decide(self, state: State):
-        action_values = {}
-        for action in state.allowed_actions:
-            new_state = state.take_action(action)
-            action_values[action] = player_value(new_state, state.next_color)
-        _, max_value = max(action_values.items(), key=itemgetter(1))
+        action_values = child_values(state, state.next_color)
+        max_value = max(action_values.values())
         best_actions = [action for action, value in action_values.items() if value == max_value]
         random_best_action = choice(best_actions)
         return random_best_action
 
 
 class MiniMaxPlayer(Player):
-    def __init__(self, name: str = None, depth=2):
+    def __init__(self, name: str = None, depth=2, time_budget=None):
+        """
+        :param depth: number of moves after the first move that are searched
+        :param time_budget: milliseconds of search, after which the result of the deepest completed iteration is used
+        """
         super().__init__(name)
         self._depth = depth
-        self.expands = sum(((FOUR * FOUR) ** d for d in range(depth + 1)))
+        self.time_budget = time_budget
+        self.search_stats = {'nodes': 0, 'depth': 0, 'table': 0}
 
     def __repr__(self):
-        return '%s(depth=%d)' % (self.__class__.__name__, self._depth)
+        if self.time_budget is None:
+            return '%s(depth=%d)' % (self.__class__.__name__, self._depth)
+        return '%s(depth=%d, time_budget=%d)' % (self.__class__.__name__, self._depth, self.time_budget)
 
     def decide(self, state: State):
-        root = MiniMaxNode(state, state.next_color)
-        frontier = [root]
-        for i in range(self.expands):
-            if len(frontier) > 0:
-                next_node = frontier.pop(0)
-                frontier.extend(next_node.expand())
-
-        action_values = {action: node.value for action, node in root.children.items()}
+        search = AlphaBetaSearch(state, self.time_budget)
+        action_values = search.search(self._depth + 1)
+        self.search_stats = {'nodes': search.number_of_nodes, 'depth': search.depth, 'table': len(search.table)}
+
         _, max_value = max(action_values.items(), key=itemgetter(1))
         best_actions = [action for action, value in action_values.items() if value == max_value]
         random_best_action = choice(best_actions)
@@ -95,35 +159,124 @@ class MiniMaxPlayer(Player):
 
 
 class MonteCarloPlayer(Player):
-    def __init__(self, name: str = None, exploration=1.0, budget=1000):
+    def __init__(self, name: str = None, exploration=1.0, budget=1000, rollouts=1):
+        """
+        :param budget: milliseconds of search per move
+        :param rollouts: number of random games played at once for each search
+        """
         self.root = MonteCarloNode(State.empty(), exploration=exploration)
         self.exploration = exploration
         self.budget = budget
+        self.rollouts = rollouts
+        self.reuse_stats = {'nodes': 0, 'visits': 0}
         super().__init__(name)
 
     def __repr__(self):
-        return '%s(exploration=%.3f, budget=%d)' % (self.__class__.__name__, self.exploration, self.budget)
+        if self.rollouts == 1:
+            return '%s(exploration=%.3f, budget=%d)' % (self.__class__.__name__, self.exploration, self.budget)
+        return '%s(exploration=%.3f, budget=%d, rollouts=%d)' % (self.__class__.__name__, self.exploration,
+                                                                 self.budget, self.rollouts)
 
     def decide(self, state: State):
         t0 = time.time()
-        self.root = self.root.find_state(state)
+        self.root = reuse_node(self.root, state)
         if self.root is None:
             self.root = MonteCarloNode(state, exploration=self.exploration)
+            self.reuse_stats = {'nodes': 0, 'visits': 0}
+        else:
+            self.reuse_stats = {'nodes': self.root.number_of_nodes(), 'visits': self.root.visit_count}
         self.root.parent = None
         while time.time() - t0 < self.budget / 1000:
-            self.root.search()
+            self.root.search(self.rollouts)
         return self.root.best_action()
 
 
 class AlphaConnectPlayer(Player):
     def __init__(self, model_path, name: str = None, exploration=1.0, start_temperature=1.0, time_budget=None,
-                 search_budget=None, self_play=False, batch_size=16):
+                 search_budget=None, self_play=False, batch_size=16, array_tree=False, virtual_loss=1.0,
+                 cache_size=None, transpositions=False, evaluator: BatchEvaluator = None, parallel=None, workers=1,
+                 early_stop=None, value_gap=None, solver=False, max_nodes=None, max_bytes=None, backend='keras',
+                 max_ponder_nodes=2 ** 20):
+        """
+        :param array_tree: search with an `AlphaConnectArrayTree` instead of a tree of `AlphaConnectNode` objects, the
+            searches and resulting policies are the same
+        :param virtual_loss: value lost by nodes that wait for evaluation, steers the searches in one batch to different
+            leaves
+        :param cache_size: reuse model evaluations of up to this many (symmetric) states, shared with the other players
+            of the same model in this process
+        :param transpositions: search a graph of `AlphaConnectGraphNode` objects, in which move orders that lead to the
+            same state share their visits and evaluations
+        :param evaluator: evaluator that is shared with other players, instead of loading the model for this player
+        :param parallel: search with multiple workers, either 'root' for processes that each search their own tree and
+            merge the visit counts of the root, or 'tree' for threads that search the same tree
+        :param workers: number of parallel workers
+        :param early_stop: stop searching when the remaining searches cannot change the most visited action, only when
+            the action is chosen without temperature, such that the chosen action does not change. By default only
+            without self play, as the visit counts of self play are the policy targets. Workers of root parallel search
+            never stop early, as their visit counts are merged.
+        :param value_gap: also stop searching when the most visited action has at least half of the visits and a value
+            that exceeds the values of the other actions by this gap, which can change the chosen action
+        :param solver: search a tree of `AlphaConnectSolverNode` objects, that proves wins and losses and plays proven
+            and forced actions without searching
+        :param max_nodes: prune the least visited subtrees when the tree has more nodes, to three quarters of this cap
+        :param max_bytes: prune the least visited subtrees when the tree takes approximately more memory
+        :param backend: evaluate the model with 'keras', or with 'numpy' which has less overhead per batch on a CPU
+        :param max_ponder_nodes: stop pondering when the tree has more nodes, unless the tree is pruned by `max_nodes`
+            or `max_bytes`, such that a slow opponent does not let the tree grow without bound
+        """
+        if array_tree and transpositions:
+            raise ValueError('The array tree does not support transpositions')
+        if solver and (array_tree or transpositions):
+            raise ValueError('The solver does not support the array tree or transpositions')
+        if (max_nodes is not None or max_bytes is not None) and (array_tree or transpositions):
+            raise ValueError('Only trees of nodes can be pruned, not the array tree or transpositions')
+        if parallel not in (None, 'root', 'tree'):
+            raise ValueError('Parallel search should be None, \'root\' or \'tree\', not %r' % parallel)
+        if backend not in BACKENDS:
+            raise ValueError('Backend should be one of %s, not %r' % (', '.join(BACKENDS), backend))
+
         self._model_path = model_path
-        self.model = self.load_model(model_path, batch_size)
+        self._batch_size = batch_size if evaluator is None else evaluator.batch_size
+        self.parallel = parallel
+        self.workers = workers
+        self.root_parallel_search = None
+        self.last_number_of_searches = 0
+        if parallel == 'root':
+            self.model = None
+            worker_budget = {'time_budget': time_budget} if search_budget is None else \
+                {'search_budget': -(-search_budget // workers)}
+            self.root_parallel_search = RootParallelSearch(workers, dict(
+                model_path=model_path, exploration=exploration, start_temperature=None, batch_size=batch_size,
+                array_tree=array_tree, virtual_loss=virtual_loss, cache_size=cache_size, transpositions=transpositions,
+                early_stop=False, solver=solver, max_nodes=max_nodes, max_bytes=max_bytes, backend=backend,
+                **worker_budget))
+        elif evaluator is None:
+            self.model = self.load_model(model_path, batch_size, cache_size, backend)
+        else:
+            self.model = EvaluatorClient(evaluator)
         self.exploration = exploration
         self._temperature = start_temperature
         self.is_self_play = self_play
+        self.virtual_loss = virtual_loss
+        self.tree = AlphaConnectArrayTree() if array_tree else None
+        self.transpositions = transpositions
+        self.early_stop = not self_play if early_stop is None else early_stop
+        self.value_gap = value_gap
+        self.solver = solver
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        self.max_ponder_nodes = max_ponder_nodes
+        self._estimated_number_of_nodes = 0
+        self.number_of_pruned_nodes = 0
+        self._bytes_per_node = 1000.0
         self.root = None  # type: Union[None, AlphaConnectNode]
+        self.reuse_stats = {'nodes': 0, 'visits': 0}
+        self.ponder_stats = {'searches': 0, 'reused_visits': 0}
+        self._ponder_thread = None  # type: Union[None, threading.Thread]
+        self._ponder_stop = threading.Event()
+        self._ponder_state = None  # type: Union[None, State]
+        self._ponder_visits = {}  # type: Dict[Action, int]
+        self._ponder_error = None
         self.set_root_node()
 
         if search_budget is None and time_budget is not None:
@@ -147,24 +300,38 @@ class AlphaConnectPlayer(Player):
         return '%s(model_path=%r, exploration=%r, start_temperature=%r, time_budget=%r, search_budget=%r, ' \
                'self_play=%r, batch_size=%r)' % (self.__class__.__name__, self._model_path, self.exploration,
                                                  self._temperature, args[0], args[1], self.is_self_play,
-                                                 self.model.batch_size)
+                                                 self._batch_size)
 
     @staticmethod
-    def load_model(model_path, batch_size):
-        model = load_model(model_path)
-        # first prediction takes more time
-        model.predict(np.array([State.empty().to_numpy()]).astype(float))
-        return BatchEvaluator(model, batch_size)
+    def load_model(model_path, batch_size, cache_size=None, backend='keras'):
+        client = worker_client()
+        if client is not None:
+            model = client.model(model_path)
+        else:
+            model = load_model(model_path, backend)
+            if backend == 'keras' and not model_path.endswith(EXPORT_EXTENSION):
+                # first prediction of a Keras model takes more time
+                model.predict(encode_batch([State.empty()]))
+        cache = None if cache_size is None else evaluation_cache(model_path, cache_size)
+        return BatchEvaluator(model, batch_size, cache)
 
     def set_root_node(self, state: State = None):
         if state is None:
             state = State.empty()
 
         if self.root is not None:
-            self.root = self.root.find_state(state)
+            self.root = reuse_node(self.root, state)
+        is_reused = self.root is not None
 
         if self.root is None:
-            self.root = AlphaConnectNode(state, action_prob=1.0)
+            if self.tree is not None:
+                self.root = self.tree.new_root(state)
+            elif self.transpositions:
+                self.root = AlphaConnectGraphNode.new_root(state)
+            elif self.solver:
+                self.root = AlphaConnectSolverNode(state, action_prob=1.0)
+            else:
+                self.root = AlphaConnectNode(state, action_prob=1.0)
 
         if self.is_self_play:
             self.root.add_dirichlet_noise = True
@@ -172,24 +339,197 @@ class AlphaConnectPlayer(Player):
             if self.root.is_played:
                 self.root.add_dirichlet_noise_to_action_probs()
 
-        self.root.parent = None
+        self.root.make_root()
+        if is_reused:
+            self.reuse_stats = {'nodes': self.root.number_of_nodes(), 'visits': self.root.visit_count}
+        else:
+            self.reuse_stats = {'nodes': 0, 'visits': 0}
+        self._estimated_number_of_nodes = max(1, self.reuse_stats['nodes'])
+
+        if self._ponder_state is not None:
+            actions = state.actions_since(self._ponder_state)
+            if is_reused and actions is not None and len(actions) == 1:
+                self.ponder_stats['reused_visits'] = self.root.visit_count - self._ponder_visits.get(actions[0], 0)
+            self._ponder_state = None
+
+    def ponder(self, state: State):
+        """Search from the state in a background thread while the opponent decides, until `stop_pondering`
+
+        The next decision reuses the subtree of the action of the opponent, `ponder_stats` counts the searches while
+        pondering and the visits of that subtree that were added while pondering.
+        """
+        if self.parallel == 'root':
+            raise ValueError('Root parallel search does not support pondering')
+        self.stop_pondering()
+        if state.is_end_of_game():
+            return
+
+        self._ponder_state = None
+        self.set_root_node(state)
+        self._ponder_state = state
+        self._ponder_visits = {action: child.visit_count for action, child in self.root.children.items()}
+        self.ponder_stats = {'searches': 0, 'reused_visits': 0}
+        self._ponder_stop.clear()
+        self._ponder_thread = threading.Thread(target=self._ponder, daemon=True)
+        self._ponder_thread.start()
+
+    def _ponder(self):
+        # upper bound of the number of nodes, each search adds at most a node for each action
+        number_of_nodes = self.root.number_of_nodes()
+        is_pruned = self.max_nodes is not None or self.max_bytes is not None
+        try:
+            while not self._ponder_stop.is_set() and not self.is_solved():
+                if not is_pruned and number_of_nodes > self.max_ponder_nodes:
+                    number_of_nodes = self.root.number_of_nodes()
+                    if number_of_nodes > self.max_ponder_nodes:
+                        break
+                number_of_nodes += FOUR ** 2
+                self.root.search(self.model, self.exploration, self.virtual_loss)
+                self.limit_memory()
+                self.ponder_stats['searches'] += 1
+            if self.model.number_of_pending > 0:
+                self.model.flush()
+        except BaseException as error:
+            self._ponder_error = error
+
+    def stop_pondering(self):
+        """Cancel pondering, returns when the queued nodes of the background search are evaluated"""
+        if self._ponder_thread is None:
+            return
+        self._ponder_stop.set()
+        self._ponder_thread.join()
+        self._ponder_thread = None
+        if self._ponder_error is not None:
+            error, self._ponder_error = self._ponder_error, None
+            raise error
 
     def clear_session(self):
-        K.clear_session()
+        if 'tensorflow' in sys.modules:
+            from tensorflow.python.keras import backend as K
+            K.clear_session()
+
+    def close(self):
+        """Stop pondering and the workers of root parallel search"""
+        self.stop_pondering()
+        if self.root_parallel_search is not None:
+            self.root_parallel_search.close()
 
     def decide(self, state: State):
-        t0 = time.time()
+        self.stop_pondering()
+        if self.parallel == 'root':
+            return self.decide_root_parallel(state)
+        if self.parallel == 'tree':
+            return self.decide_tree_parallel(state)
+        return self.run(self.decide_iter(state))
+
+    def run(self, generator):
+        """Run a generator of `decide_iter` or `search_iter`, and evaluate the queued nodes when it waits for them"""
+        while True:
+            try:
+                is_waiting = next(generator)
+            except StopIteration as stop:
+                return stop.value
+            if is_waiting:
+                self.model.flush()
+
+    def decide_iter(self, state: State):
+        self.stop_pondering()
         self.set_root_node(state)
+        yield from self.search_iter()
+        self.save_policy()
+        return self.choose_action(state)
+
+    def choose_action(self, state: State) -> Action:
+        """Proven or forced action of the root, otherwise an action sampled from the visit counts"""
+        action = self.root.proven_action() if self.solver else None
+        if action is None:
+            action = self.root.sample_action(self.temperature(state))
+        return action
+
+    def is_solved(self) -> bool:
+        """Whether the root is proven or has a forced action, such that searching cannot change the action"""
+        return self.solver and (self.root.proven is not None or self.root.proven_action() is not None)
 
+    def search_iter(self):
+        """Search from the root as a generator, that yields whether it waits for the evaluation of queued nodes"""
+        t0 = time.time()
+        visit_count = self.root.visit_count
+        can_stop_early = self.early_stop and self.temperature(self.root.state) is None
         if self.budget_type == 'time':
-            while time.time() - t0 < self.budget / 1000:
-                self.root.search(self.model, self.exploration)
+            searches = 0
+            while time.time() - t0 < self.budget / 1000 and not self.is_solved():
+                elapsed = time.time() - t0
+                if can_stop_early and searches > 0 and elapsed > 0:
+                    remaining_searches = searches / elapsed * (self.budget / 1000 - elapsed)
+                    if is_decided(self.root.action_statistics(), remaining_searches, self.value_gap):
+                        break
+                self.root.search(self.model, self.exploration, self.virtual_loss)
+                self.limit_memory()
+                searches += 1
+                yield False
         else:
-            for _ in range(self.budget):
-                self.root.search(self.model, self.exploration)
-
+            for searches in range(self.budget):
+                if self.is_solved():
+                    break
+                if can_stop_early and is_decided(self.root.action_statistics(), self.budget - searches,
+                                                 self.value_gap):
+                    break
+                self.root.search(self.model, self.exploration, self.virtual_loss)
+                self.limit_memory()
+                yield False
+        while self.model.number_of_pending > 0:
+            yield True
+        self.last_number_of_searches = self.root.visit_count - visit_count
+
+    def limit_memory(self):
+        """Prune the tree when it exceeds the node or memory cap
+
+        Each search adds at most a node for each action, and the tree is only counted when that upper bound exceeds the
+        cap. Trees are pruned when no nodes wait for evaluation.
+        """
+        if self.max_nodes is None and self.max_bytes is None:
+            return
+        self._estimated_number_of_nodes += FOUR ** 2
+        if self.model.number_of_pending > 0 or self._estimated_number_of_nodes <= self._node_cap():
+            return
+
+        self._estimated_number_of_nodes = self.root.number_of_nodes()
+        if self._estimated_number_of_nodes > self._node_cap(measure=True):
+            number_of_pruned = self.root.prune(self._node_cap() * 3 // 4)
+            self._estimated_number_of_nodes -= number_of_pruned
+            self.number_of_pruned_nodes += number_of_pruned
+
+    def _node_cap(self, measure=False) -> int:
+        if measure and self.max_bytes is not None:
+            self._bytes_per_node = self.root.approximate_bytes() / self._estimated_number_of_nodes
+        node_cap = self.max_nodes if self.max_nodes is not None else float('inf')
+        if self.max_bytes is not None:
+            node_cap = min(node_cap, int(self.max_bytes / self._bytes_per_node))
+        return node_cap
+
+    def tree_stats(self) -> Dict[str, int]:
+        """Number of nodes, number of nodes with a built state, approximate memory and number of pruned nodes of the
+        search tree"""
+        return {'nodes': self.root.number_of_nodes(), 'states': self.root.number_of_states(),
+                'bytes': self.root.approximate_bytes(), 'pruned_nodes': self.number_of_pruned_nodes}
+
+    def decide_tree_parallel(self, state: State):
+        self.set_root_node(state)
+        self.last_number_of_searches = tree_parallel_search(self.root, self.model, self.exploration, self.virtual_loss,
+                                                            self.workers, self.budget_type, self.budget)
         self.save_policy()
-        action = self.root.sample_action(self.temperature(state))
+        return self.choose_action(state)
+
+    def decide_root_parallel(self, state: State):
+        """Action from the merged root of the workers, which becomes the root of this player"""
+        self.root, self.last_number_of_searches, action = self.root_parallel_search.search(state)
+        self.history.append({
+            'policy': self.root.policy(1.0) if action is None else {action: 1.0},
+            'total_value': self.root.total_value,
+            'visit_count': self.root.visit_count
+        })
+        if action is None:
+            action = self.root.sample_action(self.temperature(state))
         return action
 
     def temperature(self, state: State):
@@ -204,8 +544,9 @@ class AlphaConnectPlayer(Player):
         return None
 
     def save_policy(self):
+        action = self.root.proven_action() if self.solver else None
         self.history.append({
-            'policy': self.root.policy(1.0),
+            'policy': self.root.policy(1.0) if action is None else {action: 1.0},
             'total_value': self.root.total_value,
             'visit_count': self.root.visit_count
         })
@@ -1,7 +1,8 @@
+import random
 from collections import namedtuple
 from enum import Enum
 from itertools import product, permutations
-from typing import Dict, Set, NamedTuple, Union, List
+from typing import Dict, FrozenSet, Iterable, NamedTuple, Union, List, Sequence, Tuple
 
 import numpy as np
 from termcolor import colored
@@ -123,6 +124,15 @@ class Augmentation(_Augmentation):
             for flip_x in [False, True]:
                 yield Augmentation(rotation, flip_x)
 
+    @classmethod
+    def from_int(cls, i):
+        rotation, flip_x = divmod(i, 2)
+        return cls(Rotation(rotation), bool(flip_x))
+
+    def to_int(self):
+        """Index of this augmentation in the augmentation tables, in the order of `iter_augmentations`"""
+        return self.rotation.value * 2 + int(self.flip_x)
+
 
 _Action = namedtuple('Action', ['x', 'y'])
 
@@ -153,17 +163,7 @@ class Action(_Action):
         return self.to_hex()
 
     def augment(self, augmentation: Augmentation) -> 'Action':
-        x, y = self.x, self.y
-
-        for _ in range(augmentation.rotation.value):
-            temp_y = y
-            y = x
-            x = FOUR - 1 - temp_y
-
-        if augmentation.flip_x:
-            x = FOUR - 1 - x
-
-        return Action(x, y)
+        return _AUGMENTED_ACTIONS[augmentation.to_int()][self.to_int()]
 
 
 _Position = namedtuple('Position', ['x', 'y', 'z'])
@@ -186,119 +186,324 @@ class Position(_Position):
     def to_action(self):
         return Action(self.x, self.y)
 
+    @classmethod
+    def from_int(cls, i):
+        action_i, z = divmod(i, FOUR)
+        x, y = divmod(action_i, FOUR)
+        return cls(x, y, z)
+
+    def to_int(self):
+        """Index of this position in a bitboard, positions in the same pin are adjacent bits"""
+        return (self.x * FOUR + self.y) * FOUR + self.z
+
+
+def _rotate_and_flip(x, y, augmentation: Augmentation):
+    for _ in range(augmentation.rotation.value):
+        temp_y = y
+        y = x
+        x = FOUR - 1 - temp_y
+
+    if augmentation.flip_x:
+        x = FOUR - 1 - x
+
+    return x, y
+
+
+def _augmented_actions():
+    return tuple(tuple(Action(*_rotate_and_flip(action.x, action.y, augmentation)) for action in Action.iter_actions())
+                 for augmentation in Augmentation.iter_augmentations())
+
+
+def _augmented_positions():
+    return tuple(tuple(position.augment(augmentation) for position in Position.iter_positions())
+                 for augmentation in Augmentation.iter_augmentations())
+
+
+def _gathers(augmented):
+    """Gather indices per augmentation, such that `augmented_array = array[gather]`"""
+    gathers = np.zeros((len(augmented), len(augmented[0])), dtype=np.intp)
+    for augmentation_i, items in enumerate(augmented):
+        for i, item in enumerate(items):
+            gathers[augmentation_i, item.to_int()] = i
+    return gathers
+
+
+_AUGMENTED_ACTIONS = _augmented_actions()
+_AUGMENTED_POSITIONS = _augmented_positions()
+ACTION_GATHERS = _gathers(_AUGMENTED_ACTIONS)
+POSITION_GATHERS = _gathers(_AUGMENTED_POSITIONS)
+# inverse permutations, such that `array = augmented_array[scatter]`
+ACTION_SCATTERS = np.argsort(ACTION_GATHERS, axis=1)
+
+
+def _augmentation_indices(augmentations: Union[Augmentation, Sequence[Augmentation]]):
+    if isinstance(augmentations, Augmentation):
+        return augmentations.to_int()
+    return np.array([augmentation.to_int() for augmentation in augmentations])
+
+
+def augment_features(features: np.ndarray, augmentations: Union[Augmentation, Sequence[Augmentation]]) -> np.ndarray:
+    """Augment position features of shape (4, 4, 4, ...) with an augmentation, or a batch of shape (N, 4, 4, 4, ...)
+    with an augmentation per sample"""
+    indices = _augmentation_indices(augmentations)
+    if isinstance(augmentations, Augmentation):
+        flat = features.reshape((FOUR ** 3,) + features.shape[3:])
+        return flat[POSITION_GATHERS[indices]].reshape(features.shape)
+    flat = features.reshape((len(features), FOUR ** 3) + features.shape[4:])
+    return flat[np.arange(len(features))[:, None], POSITION_GATHERS[indices]].reshape(features.shape)
+
+
+def augment_policy(policy: np.ndarray, augmentations: Union[Augmentation, Sequence[Augmentation]]) -> np.ndarray:
+    """Augment a policy vector of shape (16,) with an augmentation, or a batch of shape (N, 16) with an augmentation per
+    sample"""
+    indices = _augmentation_indices(augmentations)
+    if isinstance(augmentations, Augmentation):
+        return policy[ACTION_GATHERS[indices]]
+    return policy[np.arange(len(policy))[:, None], ACTION_GATHERS[indices]]
+
+
+def _count_bits(mask: int) -> int:
+    return bin(mask).count('1')
+
 
-_State = NamedTuple('State', [('stones', Dict[Position, Color]),
-                              ('next_color', Color),
-                              ('pin_height', Dict[Action, int]),
-                              ('allowed_actions', Set[Action]),
-                              ('number_of_stones', int),
-                              ('brown_lines', Dict[int, int]),
-                              ('white_lines', Dict[int, int]),
-                              ('brown_lines_free', Dict[Position, int]),
-                              ('white_lines_free', Dict[Position, int]),
-                              ('brown_max_line', Dict[Position, int]),
-                              ('white_max_line', Dict[Position, int]),
-                              ('winner', Union[Color, None])])
+def _bit_indices(mask: int) -> List[int]:
+    indices = []
+    while mask:
+        low_bit = mask & -mask
+        indices.append(low_bit.bit_length() - 1)
+        mask ^= low_bit
+    return indices
 
 
-class State(_State):
+def _zobrist_keys():
+    """Random 64-bit keys for a brown and a white stone on each position, and for brown being the next player
+
+    A fixed seed keeps the keys, and thus the hashes of states, the same across processes.
+    """
+    rng = random.Random(20190825)
+    brown = tuple(rng.getrandbits(64) for _ in range(FOUR ** 3))
+    white = tuple(rng.getrandbits(64) for _ in range(FOUR ** 3))
+    brown_next = rng.getrandbits(64)
+    return brown, white, brown_next
+
+
+ZOBRIST_BROWN, ZOBRIST_WHITE, ZOBRIST_BROWN_NEXT = _zobrist_keys()
+
+
+def _augmented_zobrist_keys():
+    """Keys of a brown stone (first 64 rows) and white stone (last 64 rows) on each position, after every
+    augmentation"""
+    return np.array([[keys[positions[position_i].to_int()] for positions in _AUGMENTED_POSITIONS]
+                     for keys in (ZOBRIST_BROWN, ZOBRIST_WHITE) for position_i in range(FOUR ** 3)], dtype=np.uint64)
+
+
+_AUGMENTED_ZOBRIST_KEYS = _augmented_zobrist_keys()
+
+
+# the line histogram is packed in the bytes of an int, as no more than 76 lines are open: the number of open lines with
+# 1 up to 4 brown stones followed by the same for white stones
+_HISTOGRAM_OFFSETS = {Color.BROWN: 0, Color.WHITE: FOUR}
+_HISTOGRAM_WINS = {color: 0xFF << (8 * (offset + FOUR - 1)) for color, offset in _HISTOGRAM_OFFSETS.items()}
+
+
+def _histogram_unit(color: 'Color', count: int) -> int:
+    return 1 << (8 * (_HISTOGRAM_OFFSETS[color] + count - 1)) if count > 0 else 0
+
+
+def _line_contributions():
+    """Contribution of a line to the packed line histogram, by the number of stones of a color and of the other color"""
+    return {color: [[_histogram_unit(color, own_count) if other_count == 0 else
+                     _histogram_unit(color.other(), other_count) if own_count == 0 else 0
+                     for other_count in range(FOUR + 1)] for own_count in range(FOUR + 1)]
+            for color in _HISTOGRAM_OFFSETS}
+
+
+def _histogram_deltas():
+    """Changes of the packed line histogram when a color extends its open line of a length to the next length, and when
+    it blocks an open line of the other color of a length"""
+    return {color: ([_histogram_unit(color, count) - _histogram_unit(color, count - 1) if count > 0 else 0
+                     for count in range(FOUR + 1)],
+                    [_histogram_unit(color.other(), count) for count in range(FOUR + 1)])
+            for color in _HISTOGRAM_OFFSETS}
+
+
+_LINE_CONTRIBUTIONS = _line_contributions()
+_HISTOGRAM_DELTAS = _histogram_deltas()
+
+
+def _pack_line_histogram(brown: int, white: int) -> int:
+    line_histogram = 0
+    for line_mask in State.LINE_MASKS:
+        brown_count, white_count = _count_bits(brown & line_mask), _count_bits(white & line_mask)
+        line_histogram += _LINE_CONTRIBUTIONS[Color.BROWN][brown_count][white_count]
+    return line_histogram
+
+
+def _unpack_line_histogram(line_histogram: int) -> Tuple[int, ...]:
+    return tuple(line_histogram.to_bytes(2 * FOUR, 'little'))
+
+
+def _line_histogram_after(line_histogram: int, position_i: int, own: int, other: int, color: 'Color') -> int:
+    """Packed line histogram after `color` puts a stone on a position, where `own` already includes the stone
+
+    Only the lines through the position change: an open line of `color` gets one stone longer, and an open line of
+    the other color that had no stone of `color` is blocked.
+    """
+    extend_deltas, block_deltas = _HISTOGRAM_DELTAS[color]
+    bit = 1 << position_i
+    for line_mask in State.POSITION_LINE_MASKS[position_i]:
+        if other & line_mask == 0:
+            line_histogram += extend_deltas[_LINE_BIT_COUNTS[own & line_mask]]
+        elif own & line_mask == bit:
+            line_histogram -= block_deltas[_LINE_BIT_COUNTS[other & line_mask]]
+    return line_histogram
+
+
+def _child_line_histograms(line_histogram: int, own: int, other: int, color: 'Color',
+                           action_positions: Iterable[Tuple['Action', int]]) -> Tuple[List['Action'], np.ndarray]:
+    extend_deltas, block_deltas = _HISTOGRAM_DELTAS[color]
+    actions, child_line_histograms = [], []
+    for action, position_i in action_positions:
+        # the update of `_line_histogram_after`, inlined as it runs for every child
+        bit = 1 << position_i
+        own_after = own | bit
+        child_line_histogram = line_histogram
+        for line_mask in State.POSITION_LINE_MASKS[position_i]:
+            if other & line_mask == 0:
+                child_line_histogram += extend_deltas[_LINE_BIT_COUNTS[own_after & line_mask]]
+            elif own_after & line_mask == bit:
+                child_line_histogram -= block_deltas[_LINE_BIT_COUNTS[other & line_mask]]
+        actions.append(action)
+        child_line_histograms.append(child_line_histogram)
+    return actions, np.array(child_line_histograms, dtype='<u8').view(np.uint8).reshape((-1, 2 * FOUR))
+
+
+def zobrist_hash(brown: int, white: int, next_color: 'Color') -> int:
+    """Zobrist hash of a board, computed from scratch"""
+    key = ZOBRIST_BROWN_NEXT if next_color is Color.BROWN else 0
+    for position_i in range(FOUR ** 3):
+        if brown >> position_i & 1:
+            key ^= ZOBRIST_BROWN[position_i]
+        elif white >> position_i & 1:
+            key ^= ZOBRIST_WHITE[position_i]
+    return key
+
+
+def _line_masks(lines):
+    return tuple(sum(1 << position.to_int() for position in line) for _, line in sorted(lines.items()))
+
+
+def _position_line_masks(line_masks, position_to_lines):
+    return tuple(tuple(line_masks[line_i] for line_i, _ in position_to_lines[Position.from_int(i)])
+                 for i in range(FOUR ** 3))
+
+
+class State(object):
     """State of a 3d connect four game
 
     Uses 3-dimensional coordinate system: x, y, z
+
+    The board is stored as two 64-bit occupancy masks (one per color) and a word with a 4-bit height for each pin. Bit
+    `Position.to_int()` of a mask is set when that position holds a stone of the color. The line and position tables
+    (e.g. `brown_lines`, `white_max_line`) are derived from the masks when they are first needed.
+
+    A Zobrist hash of the board and next player is updated with each action. It is used for hashing and equality, and
+    is available as a stable `key()`.
+
+    The `line_histogram` counts the open lines of each length of both colors. `take_action` updates it from the lines
+    through the new stone when the state has one, otherwise it is counted when it is first needed. States of searches
+    and rollouts from the empty state therefore do not maintain it.
     """
     LINES = _lines()
     POSITION_TO_LINES = _position_to_lines()
+    LINE_MASKS = _line_masks(LINES)
+    POSITION_LINE_MASKS = _position_line_masks(LINE_MASKS, POSITION_TO_LINES)
+
+    __slots__ = ('brown', 'white', 'heights', 'next_color', 'number_of_stones', 'allowed_actions', 'winner', 'zobrist',
+                 '_tables', '_line_histogram')
+
+    def __init__(self, brown: int, white: int, heights: int, next_color: Color, number_of_stones: int,
+                 allowed_actions: FrozenSet[Action], winner: Union[Color, None], zobrist: int = None,
+                 line_histogram: int = None):
+        self.brown = brown
+        self.white = white
+        self.heights = heights
+        self.next_color = next_color
+        self.number_of_stones = number_of_stones
+        self.allowed_actions = allowed_actions
+        self.winner = winner
+        if zobrist is None:
+            zobrist = zobrist_hash(brown, white, next_color)
+        self.zobrist = zobrist
+        self._tables = None
+        self._line_histogram = line_histogram
 
     @classmethod
     def empty(cls) -> 'State':
-        stones = {pos: Color.NONE for pos in Position.iter_positions()}
-        next_color = Color.WHITE
-        pin_height = {action: 0 for action in Action.iter_actions()}
-        allowed_actions = set(pin_height.keys())
-        number_of_stones = 0
-        winner = None
-        brown_lines = {line_i: 0 for line_i in cls.LINES.keys()}
-        white_lines = {line_i: 0 for line_i in cls.LINES.keys()}
-        brown_lines_free = {
-            pos: len(cls.POSITION_TO_LINES[pos])
-            for pos in Position.iter_positions()
-        }
-        white_lines_free = {
-            pos: len(cls.POSITION_TO_LINES[pos])
-            for pos in Position.iter_positions()
-        }
-        brown_max_line = {pos: 0 for pos in Position.iter_positions()}
-        white_max_line = {pos: 0 for pos in Position.iter_positions()}
-        return cls(stones, next_color, pin_height, allowed_actions,
-                   number_of_stones, brown_lines, white_lines,
-                   brown_lines_free, white_lines_free, brown_max_line,
-                   white_max_line, winner)
+        return cls(0, 0, 0, Color.WHITE, 0, frozenset(Action.iter_actions()), None, 0)
 
     @classmethod
     def from_board(cls, board, player) -> 'State':
-        s = cls.empty()
+        brown, white, heights = 0, 0, 0
         for x in range(FOUR):
             for y in range(FOUR):
+                action_i = Action(x, y).to_int()
                 for z in range(len(board[x][y])):
-                    s = s._replace(next_color=Color.WHITE if board[x][y][z] ==
-                                   0 else Color.BROWN)
-                    s = s.take_action(Action(x, y))
-        s = s._replace(next_color=Color.WHITE if player == 0 else Color.BROWN)
-        return s
+                    bit = 1 << Position(x, y, z).to_int()
+                    if board[x][y][z] == 0:
+                        white |= bit
+                    else:
+                        brown |= bit
+                heights += len(board[x][y]) << (FOUR * action_i)
+
+        allowed_actions = frozenset(action for action in Action.iter_actions() if len(board[action.x][action.y]) < FOUR)
+        winner = None
+        for line_mask in cls.LINE_MASKS:
+            if white & line_mask == line_mask:
+                winner = Color.WHITE
+            elif brown & line_mask == line_mask:
+                winner = Color.BROWN
+        next_color = Color.WHITE if player == 0 else Color.BROWN
+        return cls(brown, white, heights, next_color, _count_bits(brown | white), allowed_actions, winner)
 
     def take_action(self, action: Action) -> 'State':
         assert action in self.allowed_actions
         assert not self.has_winner()
 
-        stones = self.stones.copy(
-        )  # does not deepcopy keys, but these never have to change
-        next_color = self.next_color
-        pin_height = self.pin_height.copy(
-        )  # does not deepcopy keys, but these never have to change
-        allowed_actions = self.allowed_actions.copy(
-        )  # does not deepcopy items, but these never have to change
-        number_of_stones = self.number_of_stones
-        brown_lines = self.brown_lines.copy()
-        white_lines = self.white_lines.copy()
-        brown_lines_free = self.brown_lines_free.copy()
-        white_lines_free = self.white_lines_free.copy()
-        brown_max_line = self.brown_max_line.copy()
-        white_max_line = self.white_max_line.copy()
-        winner = self.winner
-
-        position = Position.from_action_and_height(action,
-                                                   self.pin_height[action])
-        stones[position] = self.next_color
-        next_color = next_color.other()
-        pin_height[action] += 1
-        if pin_height[action] == FOUR:
-            allowed_actions.remove(action)
-        number_of_stones += 1
-        affected_lines = self.POSITION_TO_LINES[position]
-        for line_i, _ in affected_lines:
-            if self.next_color == Color.BROWN:
-                brown_lines[line_i] += 1
-                for line_pos in self.LINES[line_i]:
-                    brown_max_line[line_pos] = max(brown_lines[line_i],
-                                                   brown_max_line[line_pos])
-                    if brown_lines[line_i] == 1:
-                        white_lines_free[line_pos] -= 1
-                if brown_lines[line_i] == FOUR:
-                    winner = Color.BROWN
-            else:
-                white_lines[line_i] += 1
-                for line_pos in self.LINES[line_i]:
-                    white_max_line[line_pos] = max(white_lines[line_i],
-                                                   white_max_line[line_pos])
-                    if white_lines[line_i] == 1:
-                        brown_lines_free[line_pos] -= 1
-                if white_lines[line_i] == FOUR:
-                    winner = Color.WHITE
-
-        return State(stones, next_color, pin_height, allowed_actions,
-                     number_of_stones, brown_lines, white_lines,
-                     brown_lines_free, white_lines_free, brown_max_line,
-                     white_max_line, winner)
+        x, y = action
+        shift = FOUR * (x * FOUR + y)
+        height = (self.heights >> shift) & 0xF
+        position_i = shift + height
+        bit = 1 << position_i
+
+        brown, white = self.brown, self.white
+        if self.next_color is Color.WHITE:
+            white |= bit
+            own, other, next_color = white, brown, Color.BROWN
+            zobrist = self.zobrist ^ ZOBRIST_WHITE[position_i] ^ ZOBRIST_BROWN_NEXT
+        else:
+            brown |= bit
+            own, other, next_color = brown, white, Color.WHITE
+            zobrist = self.zobrist ^ ZOBRIST_BROWN[position_i] ^ ZOBRIST_BROWN_NEXT
+
+        winner = None
+        line_histogram = self._line_histogram
+        if line_histogram is None:
+            for line_mask in self.POSITION_LINE_MASKS[position_i]:
+                if own & line_mask == line_mask:
+                    winner = self.next_color
+                    break
+        else:
+            line_histogram = _line_histogram_after(line_histogram, position_i, own, other, self.next_color)
+            if line_histogram & _HISTOGRAM_WINS[self.next_color]:
+                winner = self.next_color
+
+        allowed_actions = self.allowed_actions
+        if height + 1 == FOUR:
+            allowed_actions = allowed_actions - {action}
+
+        return State(brown, white, self.heights + (1 << shift), next_color, self.number_of_stones + 1, allowed_actions,
+                     winner, zobrist, line_histogram)
 
     def take_actions(self, actions: List[Action]) -> 'State':
         state = self
@@ -306,6 +511,58 @@ class State(_State):
             state = state.take_action(action)
         return state
 
+    def actions_since(self, state: 'State') -> Union[None, List[Action]]:
+        """Actions that lead from an earlier state to this state, or None if this state does not follow from it
+
+        The actions of each player are ordered by position, which reaches this state unless a player stacked on a stone
+        that was placed later, so callers should check the state that the actions lead to.
+        """
+        if self.brown & state.brown != state.brown or self.white & state.white != state.white:
+            return None
+        new_brown, new_white = self.brown ^ state.brown, self.white ^ state.white
+        if state.next_color is Color.BROWN:
+            first, second = _bit_indices(new_brown), _bit_indices(new_white)
+        else:
+            first, second = _bit_indices(new_white), _bit_indices(new_brown)
+        if len(first) - len(second) not in (0, 1):
+            return None
+
+        actions = []
+        for i, position_i in enumerate(first):
+            actions.append(Action.from_int(position_i // FOUR))
+            if i < len(second):
+                actions.append(Action.from_int(second[i] // FOUR))
+        return actions
+
+    def key(self) -> int:
+        """64-bit Zobrist hash of the board and next player, the same in every process"""
+        return self.zobrist
+
+    def canonical_key(self) -> Tuple[int, Augmentation]:
+        """Smallest Zobrist hash of the eight augmentations of this state, and the augmentation that gives it
+
+        Symmetric states have the same canonical key.
+        """
+        masks = np.array([self.brown, self.white], dtype='<u8').view(np.uint8)
+        stones = np.unpackbits(masks, bitorder='little').view(bool)
+        keys = np.bitwise_xor.reduce(_AUGMENTED_ZOBRIST_KEYS[stones], axis=0)
+        if self.next_color is Color.BROWN:
+            keys ^= np.uint64(ZOBRIST_BROWN_NEXT)
+        augmentation_i = int(keys.argmin())
+        return int(keys[augmentation_i]), Augmentation.from_int(augmentation_i)
+
+    def __eq__(self, other):
+        if not isinstance(other, State):
+            return NotImplemented
+        return self.zobrist == other.zobrist and self.brown == other.brown and self.white == other.white and \
+            self.next_color is other.next_color
+
+    def __hash__(self):
+        return self.zobrist
+
+    def __repr__(self):
+        return 'State(brown=%#x, white=%#x, next_color=%s)' % (self.brown, self.white, self.next_color.name)
+
     def __str__(self):
         state_array = [[['?' for _ in range(FOUR)] for _ in range(FOUR)]
                        for _ in range(FOUR)]
@@ -330,33 +587,113 @@ class State(_State):
         return board
 
     def is_end_of_game(self):
-        is_full = all(stone is not Color.NONE
-                      for stone in self.stones.values())
-        return self.winner is not None or is_full
+        return self.winner is not None or self.number_of_stones == FOUR ** 3
 
     def has_winner(self):
         return self.winner is not None
 
-    def to_numpy(self, augmentation: Augmentation = None, batch=False):
-        if augmentation is None:
-            arr = [[[
-                self._encode_position(Position(x, y, z)) for z in range(FOUR)
-            ] for y in range(FOUR)] for x in range(FOUR)]
-        else:
-            mapping = {
-                position.augment(augmentation): position
-                for position in Position.iter_positions()
-            }
-            arr = [[[
-                self._encode_position(mapping[Position(x, y, z)])
-                for z in range(FOUR)
-            ] for y in range(FOUR)] for x in range(FOUR)]
+    def winning_actions(self, color: Color) -> List[Action]:
+        """Allowed actions that would complete a line of the color, checked with the line masks of the next position of
+        each pin"""
+        own = self.brown if color is Color.BROWN else self.white
+        actions = []
+        for action in sorted(self.allowed_actions):
+            shift = FOUR * action.to_int()
+            position_i = shift + (self.heights >> shift & 0xF)
+            own_after = own | 1 << position_i
+            if any(own_after & line_mask == line_mask for line_mask in self.POSITION_LINE_MASKS[position_i]):
+                actions.append(action)
+        return actions
 
+    def to_numpy(self, augmentation: Augmentation = None, batch=False):
+        augmentations = None if augmentation is None else [augmentation]
+        arr = encode_batch([self], augmentations, dtype=float)
         if batch:
-            arr = np.array([
-                arr,
-            ])
-        return np.array(arr).astype(float)
+            return arr
+        return arr[0]
+
+    @property
+    def line_histogram(self) -> Tuple[int, ...]:
+        """Number of open lines, without stones of the other color, with 1 up to 4 brown stones followed by the same for
+        white stones"""
+        if self._line_histogram is None:
+            self._line_histogram = _pack_line_histogram(self.brown, self.white)
+        return _unpack_line_histogram(self._line_histogram)
+
+    def child_line_histograms(self) -> Tuple[List[Action], np.ndarray]:
+        """Allowed actions and the `line_histogram` after each of them as an array of shape (N, 8), without creating the
+        states"""
+        self.line_histogram
+        own, other = (self.white, self.brown) if self.next_color is Color.WHITE else (self.brown, self.white)
+        action_positions = ((action, FOUR * action.to_int() + (self.heights >> (FOUR * action.to_int()) & 0xF))
+                            for action in self.allowed_actions)
+        return _child_line_histograms(self._line_histogram, own, other, self.next_color, action_positions)
+
+    def _table(self, name):
+        if self._tables is None:
+            self._tables = self._compute_line_tables()
+        if name not in self._tables:
+            self._tables.update(self._compute_position_tables(self._tables['brown_lines'], self._tables['white_lines']))
+        return self._tables[name]
+
+    def _compute_line_tables(self):
+        return {
+            'brown_lines': {line_i: _count_bits(self.brown & line_mask) for line_i, line_mask in
+                            enumerate(self.LINE_MASKS)},
+            'white_lines': {line_i: _count_bits(self.white & line_mask) for line_i, line_mask in
+                            enumerate(self.LINE_MASKS)},
+        }
+
+    def _compute_position_tables(self, brown_lines, white_lines):
+        tables = {'brown_lines_free': {}, 'white_lines_free': {}, 'brown_max_line': {}, 'white_max_line': {}}
+        for pos in Position.iter_positions():
+            line_indices = [line_i for line_i, _ in self.POSITION_TO_LINES[pos]]
+            tables['brown_lines_free'][pos] = sum(white_lines[line_i] == 0 for line_i in line_indices)
+            tables['white_lines_free'][pos] = sum(brown_lines[line_i] == 0 for line_i in line_indices)
+            tables['brown_max_line'][pos] = max(brown_lines[line_i] for line_i in line_indices)
+            tables['white_max_line'][pos] = max(white_lines[line_i] for line_i in line_indices)
+        return tables
+
+    @property
+    def stones(self) -> Dict[Position, Color]:
+        stones = {}
+        for pos in Position.iter_positions():
+            bit = 1 << pos.to_int()
+            if self.brown & bit:
+                stones[pos] = Color.BROWN
+            elif self.white & bit:
+                stones[pos] = Color.WHITE
+            else:
+                stones[pos] = Color.NONE
+        return stones
+
+    @property
+    def pin_height(self) -> Dict[Action, int]:
+        return {action: (self.heights >> (FOUR * action.to_int())) & 0xF for action in Action.iter_actions()}
+
+    @property
+    def brown_lines(self) -> Dict[int, int]:
+        return self._table('brown_lines')
+
+    @property
+    def white_lines(self) -> Dict[int, int]:
+        return self._table('white_lines')
+
+    @property
+    def brown_lines_free(self) -> Dict[Position, int]:
+        return self._table('brown_lines_free')
+
+    @property
+    def white_lines_free(self) -> Dict[Position, int]:
+        return self._table('white_lines_free')
+
+    @property
+    def brown_max_line(self) -> Dict[Position, int]:
+        return self._table('brown_max_line')
+
+    @property
+    def white_max_line(self) -> Dict[Position, int]:
+        return self._table('white_max_line')
 
     @property
     def free_lines(self):
@@ -372,23 +709,329 @@ class State(_State):
         else:
             return self.brown_max_line, self.white_max_line
 
-    def _encode_position(self, pos: Position):
-        x, y, z = pos
 
-        stone = self.stones[pos]
-        reachable = z == self.pin_height[Action(x, y)]
+NUMBER_OF_FEATURES = 13
+
+
+def _position_line_incidence():
+    incidence = np.zeros((FOUR ** 3, len(State.LINES)), dtype=np.float32)
+    for line_i, line in State.LINES.items():
+        for position in line:
+            incidence[position.to_int(), line_i] = 1
+    return incidence
+
+
+def _position_line_mask_table():
+    """Masks of the lines through each position, padded with a mask of the whole board that is never filled by one
+    color"""
+    max_lines = max(len(line_masks) for line_masks in State.POSITION_LINE_MASKS)
+    table = np.full((FOUR ** 3, max_lines), 2 ** 64 - 1, dtype=np.uint64)
+    for position_i, line_masks in enumerate(State.POSITION_LINE_MASKS):
+        table[position_i, :len(line_masks)] = line_masks
+    return table
+
+
+def _line_bit_counts():
+    """Number of stones of every subset of the positions of a line, which is faster to look up than to count"""
+    bit_counts = {}
+    for line_mask in State.LINE_MASKS:
+        bits = [1 << bit_i for bit_i in _bit_indices(line_mask)]
+        for subset_i in range(1 << FOUR):
+            subset = sum(bit for bit_j, bit in enumerate(bits) if subset_i >> bit_j & 1)
+            bit_counts[subset] = _count_bits(subset)
+    return bit_counts
+
 
+def _static_features():
+    """Corner, side, middle, bottom, top and middle_z planes for each position"""
+    features = np.zeros((FOUR ** 3, 6), dtype=bool)
+    for position in Position.iter_positions():
+        x, y, z = position
         corner = (x == 0 or x == 3) and (y == 0 or y == 3)
         side = (x == 0 or x == 3 or y == 0 or y == 3) and not corner
         middle = not (corner or side)
         bottom = (z == 0)
         top = (z == 3)
         middle_z = not (bottom or top)
+        features[position.to_int()] = (corner, side, middle, bottom, top, middle_z)
+    return features
+
+
+_POSITION_LINE_INCIDENCE = _position_line_incidence()
+_POSITION_LINE_MASK_TABLE = _position_line_mask_table()
+_LINE_BIT_COUNTS = _line_bit_counts()
+_POSITION_BITS = np.left_shift(np.uint64(1), np.arange(FOUR ** 3, dtype=np.uint64))
+_STATIC_FEATURES = _static_features()
+_HEIGHT_LEVELS = np.arange(FOUR)
+_LINE_LENGTHS = np.arange(1, FOUR + 1).reshape(FOUR, 1, 1, 1)
+
+
+def encode_batch(states: List[State], augmentations: List[Augmentation] = None, dtype=np.float32, out=None):
+    """Encode states as an array of shape (N, 4, 4, 4, 13) for the neural network
+
+    Features are indexed by x, y, z and are, from the perspective of the next player: own stone, other stone,
+    reachable, corner, side, middle, bottom, top, middle_z, own lines free, other lines free, own max line and other
+    max line. An augmentation per state can be given, the result is then the encoding of the augmented state.
+
+    :param out: optional preallocated contiguous array to fill, with shape (N, 4, 4, 4, 13)
+    """
+    n = len(states)
+    if out is None:
+        out = np.empty((n, FOUR, FOUR, FOUR, NUMBER_OF_FEATURES), dtype=dtype)
+
+    masks = np.array([(state.white, state.brown) if state.next_color is Color.WHITE else (state.brown, state.white)
+                      for state in states], dtype='<u8').reshape(n, 2)
+    stones = np.unpackbits(masks.view(np.uint8).reshape(n, 2, 8), axis=-1, bitorder='little')  # own, other
+
+    heights = np.array([state.heights for state in states], dtype='<u8').view(np.uint8).reshape(n, 8)
+    pin_heights = np.stack([heights & 0xF, heights >> 4], axis=-1).reshape(n, FOUR * FOUR)
+    reachable = (pin_heights[:, :, None] == _HEIGHT_LEVELS).reshape(n, FOUR ** 3)
+
+    # matrix products of small counts are exact in float32 and use blas, as long as the operands are 2d
+    line_counts = (stones.reshape(n * 2, FOUR ** 3).astype(np.float32) @ _POSITION_LINE_INCIDENCE).reshape(n, 2, -1)
+    lines_free = ((line_counts[:, ::-1] == 0).reshape(n * 2, -1).astype(np.float32) @ _POSITION_LINE_INCIDENCE.T)
+    # a position has a max line of at least k if any of its lines has at least k stones
+    at_least = (line_counts >= _LINE_LENGTHS).astype(np.float32)
+    max_lines = ((at_least.reshape(-1, len(State.LINES)) @ _POSITION_LINE_INCIDENCE.T) > 0).reshape(FOUR, n, 2, -1)
+    max_lines = max_lines.sum(axis=0)
+
+    features = np.empty((n, FOUR ** 3, NUMBER_OF_FEATURES), dtype=dtype)
+    features[:, :, 0:2] = stones.transpose(0, 2, 1)
+    features[:, :, 2] = reachable
+    features[:, :, 3:9] = _STATIC_FEATURES
+    features[:, :, 9:11] = lines_free.reshape(n, 2, -1).transpose(0, 2, 1)
+    features[:, :, 11:13] = max_lines.transpose(0, 2, 1)
+
+    flat_out = out.reshape(n, FOUR ** 3, NUMBER_OF_FEATURES)
+    if augmentations is None:
+        flat_out[...] = features
+    else:
+        flat_out[...] = features[np.arange(n)[:, None], POSITION_GATHERS[_augmentation_indices(augmentations)]]
+    return out
+
+
+def random_playouts(state: State, number_of_playouts: int) -> np.ndarray:
+    """Winners of random games from the state, as `Color` values with 0 for a draw
+
+    All games are played at once on arrays of pin heights and occupancy masks. A game is won when the mask of the
+    player that moved covers one of the line masks through the position of the move.
+    """
+    winners = np.zeros(number_of_playouts, dtype=np.int8)
+    if state.is_end_of_game():
+        winners[:] = 0 if state.winner is None else state.winner.value
+        return winners
+
+    height_bytes = np.array([state.heights], dtype='<u8').view(np.uint8)
+    heights = np.tile(np.stack([height_bytes & 0xF, height_bytes >> FOUR], axis=1).reshape(-1), (number_of_playouts, 1))
+    masks = np.array([np.full(number_of_playouts, state.brown, dtype=np.uint64),
+                      np.full(number_of_playouts, state.white, dtype=np.uint64)])
+
+    games = np.arange(number_of_playouts)
+    color = state.next_color
+    for _ in range(state.number_of_stones, FOUR ** 3):
+        game_heights = heights[games]
+        weights = np.random.random(game_heights.shape)
+        weights[game_heights >= FOUR] = -1.0
+        pins = weights.argmax(axis=1)
+        positions = pins * FOUR + game_heights[np.arange(len(games)), pins]
+        heights[games, pins] += 1
+
+        color_i = color.value - Color.BROWN.value
+        own = masks[color_i, games] | _POSITION_BITS[positions]
+        masks[color_i, games] = own
+        line_masks = _POSITION_LINE_MASK_TABLE[positions]
+        has_won = (own[:, None] & line_masks == line_masks).any(axis=1)
+        winners[games[has_won]] = color.value
+        games = games[~has_won]
+        if len(games) == 0:
+            break
+        color = color.other()
+    return winners
+
+
+class SearchBoard(object):
+    """Mutable board to walk through a game during a search
+
+    Moves are played with `push` and taken back with `pop`, without creating a `State` for each move. Take a `State`
+    snapshot with `to_state` only when it needs to be kept.
+
+    With `track_lines` the line counters, free line counts and max line tables of `State` are updated incrementally:
+    `brown_lines`/`white_lines` are indexed by line and `brown_lines_free`/`white_lines_free` by `Position.to_int()`.
+    Max lines are kept as a histogram of line lengths per position, such that a pop can undo a push exactly. The
+    `line_histogram` of open lines is updated as well.
+    """
+    LINE_POSITIONS = tuple(tuple(position.to_int() for position in line) for _, line in sorted(State.LINES.items()))
+    POSITION_LINES = tuple(tuple(line_i for line_i, _ in State.POSITION_TO_LINES[Position.from_int(i)])
+                           for i in range(FOUR ** 3))
+
+    def __init__(self, state: State, track_lines=False):
+        self.brown = state.brown
+        self.white = state.white
+        self.zobrist = state.zobrist
+        self.next_color = state.next_color
+        self.number_of_stones = state.number_of_stones
+        self.winner = state.winner
+        self.pin_height = [(state.heights >> (FOUR * i)) & 0xF for i in range(FOUR * FOUR)]
+
+        # allowed actions are swapped to the end of this list when a pin fills up, and swapped back on pop
+        self._actions = [action for action in Action.iter_actions() if action in state.allowed_actions] + \
+                        [action for action in Action.iter_actions() if action not in state.allowed_actions]
+        self.number_of_allowed_actions = len(state.allowed_actions)
+        self._pushed_positions = [0] * FOUR ** 3
+        self._removed_action_index = [0] * FOUR ** 3
+        self._winners = [None] * (FOUR ** 3 + 1)
+        self._winners[state.number_of_stones] = state.winner
+
+        self.track_lines = track_lines
+        if track_lines:
+            self.brown_lines = [state.brown_lines[line_i] for line_i in range(len(State.LINES))]
+            self.white_lines = [state.white_lines[line_i] for line_i in range(len(State.LINES))]
+            self.brown_lines_free = [state.brown_lines_free[Position.from_int(i)] for i in range(FOUR ** 3)]
+            self.white_lines_free = [state.white_lines_free[Position.from_int(i)] for i in range(FOUR ** 3)]
+            self._brown_line_lengths = self._line_length_histograms(self.brown_lines)
+            self._white_line_lengths = self._line_length_histograms(self.white_lines)
+            self._line_histogram = _pack_line_histogram(self.brown, self.white)
+
+    def _line_length_histograms(self, lines):
+        histograms = [[0] * (FOUR + 1) for _ in range(FOUR ** 3)]
+        for position_i, line_indices in enumerate(self.POSITION_LINES):
+            for line_i in line_indices:
+                histograms[position_i][lines[line_i]] += 1
+        return histograms
+
+    @property
+    def allowed_actions(self) -> List[Action]:
+        return self._actions[:self.number_of_allowed_actions]
+
+    @property
+    def line_histogram(self) -> Tuple[int, ...]:
+        """See `State.line_histogram`, which is counted from scratch without `track_lines`"""
+        return _unpack_line_histogram(self._packed_line_histogram())
+
+    def child_line_histograms(self) -> Tuple[List[Action], np.ndarray]:
+        """See `State.child_line_histograms`"""
+        own, other = (self.white, self.brown) if self.next_color is Color.WHITE else (self.brown, self.white)
+        action_positions = ((action, FOUR * action.to_int() + self.pin_height[action.to_int()])
+                            for action in self.allowed_actions)
+        return _child_line_histograms(self._packed_line_histogram(), own, other, self.next_color, action_positions)
+
+    def _packed_line_histogram(self) -> int:
+        if self.track_lines:
+            return self._line_histogram
+        return _pack_line_histogram(self.brown, self.white)
+
+    def random_action(self) -> Action:
+        return self._actions[random.randrange(self.number_of_allowed_actions)]
 
-        my_lines_free, other_lines_block = self.free_lines
-        my_max_line, other_max_line = self.max_lines
+    def is_end_of_game(self):
+        return self.winner is not None or self.number_of_stones == FOUR ** 3
+
+    def has_winner(self):
+        return self.winner is not None
 
-        return (stone == self.next_color, stone == self.next_color.other(),
-                reachable, corner, side, middle, bottom, top, middle_z,
-                my_lines_free[pos], other_lines_block[pos], my_max_line[pos],
-                other_max_line[pos])
+    def push(self, action: Action):
+        assert not self.has_winner()
+        x, y = action
+        action_i = x * FOUR + y
+        height = self.pin_height[action_i]
+        assert height < FOUR
+        position_i = action_i * FOUR + height
+        color = self.next_color
+
+        if color is Color.WHITE:
+            self.white |= 1 << position_i
+            self.zobrist ^= ZOBRIST_WHITE[position_i] ^ ZOBRIST_BROWN_NEXT
+            own = self.white
+            self.next_color = Color.BROWN
+        else:
+            self.brown |= 1 << position_i
+            self.zobrist ^= ZOBRIST_BROWN[position_i] ^ ZOBRIST_BROWN_NEXT
+            own = self.brown
+            self.next_color = Color.WHITE
+
+        for line_mask in State.POSITION_LINE_MASKS[position_i]:
+            if own & line_mask == line_mask:
+                self.winner = color
+                break
+
+        self.pin_height[action_i] = height + 1
+        if height + 1 == FOUR:
+            self._remove_action(action)
+        self._pushed_positions[self.number_of_stones] = position_i
+        self.number_of_stones += 1
+        self._winners[self.number_of_stones] = self.winner
+
+        if self.track_lines:
+            self._update_lines(position_i, color, 1)
+
+    def pop(self):
+        self.number_of_stones -= 1
+        position_i = self._pushed_positions[self.number_of_stones]
+        action_i, height = divmod(position_i, FOUR)
+        color = self.next_color.other()
+
+        if color is Color.WHITE:
+            self.white &= ~(1 << position_i)
+            self.zobrist ^= ZOBRIST_WHITE[position_i] ^ ZOBRIST_BROWN_NEXT
+        else:
+            self.brown &= ~(1 << position_i)
+            self.zobrist ^= ZOBRIST_BROWN[position_i] ^ ZOBRIST_BROWN_NEXT
+        self.next_color = color
+        self.winner = self._winners[self.number_of_stones]
+
+        if height + 1 == FOUR:
+            self._restore_action()
+        self.pin_height[action_i] = height
+
+        if self.track_lines:
+            self._update_lines(position_i, color, -1)
+
+    def _remove_action(self, action: Action):
+        i = self._actions.index(action)
+        last = self.number_of_allowed_actions - 1
+        self._actions[i], self._actions[last] = self._actions[last], self._actions[i]
+        self._removed_action_index[self.number_of_stones] = i
+        self.number_of_allowed_actions = last
+
+    def _restore_action(self):
+        i = self._removed_action_index[self.number_of_stones]
+        last = self.number_of_allowed_actions
+        self._actions[i], self._actions[last] = self._actions[last], self._actions[i]
+        self.number_of_allowed_actions = last + 1
+
+    def _update_lines(self, position_i: int, color: Color, step: int):
+        if color is Color.WHITE:
+            lines, other_lines, other_lines_free, line_lengths = \
+                self.white_lines, self.brown_lines, self.brown_lines_free, self._white_line_lengths
+        else:
+            lines, other_lines, other_lines_free, line_lengths = \
+                self.brown_lines, self.white_lines, self.white_lines_free, self._brown_line_lengths
+        contributions = _LINE_CONTRIBUTIONS[color]
+
+        for line_i in self.POSITION_LINES[position_i]:
+            old_count = lines[line_i]
+            new_count = old_count + step
+            lines[line_i] = new_count
+            other_count = other_lines[line_i]
+            self._line_histogram += contributions[new_count][other_count] - contributions[old_count][other_count]
+            for line_position_i in self.LINE_POSITIONS[line_i]:
+                line_lengths[line_position_i][old_count] -= 1
+                line_lengths[line_position_i][new_count] += 1
+                if old_count == 0:
+                    other_lines_free[line_position_i] -= 1
+                elif new_count == 0:
+                    other_lines_free[line_position_i] += 1
+
+    def max_line(self, color: Color, position: Position) -> int:
+        line_lengths = self._white_line_lengths if color is Color.WHITE else self._brown_line_lengths
+        histogram = line_lengths[position.to_int()]
+        for length in range(FOUR, 0, -1):
+            if histogram[length] > 0:
+                return length
+        return 0
+
+    def to_state(self) -> State:
+        heights = sum(height << (FOUR * i) for i, height in enumerate(self.pin_height))
+        return State(self.brown, self.white, heights, self.next_color, self.number_of_stones,
+                     frozenset(self.allowed_actions), self.winner, self.zobrist,
+                     self._line_histogram if self.track_lines else None)
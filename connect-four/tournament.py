@@ -8,6 +8,7 @@ from random import choice
 import numpy as np
 from pystan import StanModel
 
+import inference
 from game import TwoPlayerGame
 from observer import GameWinnerSerializer
 from player import RandomPlayer, GreedyPlayer, MiniMaxPlayer, MonteCarloPlayer, AlphaConnectPlayer, Player
@@ -16,14 +17,23 @@ from util import list_files
 
 
 def tournament_continuously(tournament_dir, model_dir, processes, first_player_name_filter, first_player_kwargs_filter,
-                            second_player_name_filter, second_player_kwargs_filter):
+                            second_player_name_filter, second_player_kwargs_filter, inference_server=False,
+                            max_latency=0.005):
     os.makedirs(tournament_dir, exist_ok=True)
-
-    with Pool(processes, maxtasksperchild=10) as p:
-        for _ in p.imap_unordered(play_random_opponenents_game_once, cycle([(
-                tournament_dir, model_dir, first_player_name_filter, first_player_kwargs_filter,
-                second_player_name_filter, second_player_kwargs_filter)])):
-            pass
+    initializer, initargs, server = None, (), None
+    if inference_server:
+        channels, server = inference.start_server(processes, max_latency=max_latency)
+        initializer, initargs = inference.connect_worker, (channels,)
+
+    with Pool(processes, initializer, initargs, maxtasksperchild=10) as p:
+        try:
+            for _ in p.imap_unordered(play_random_opponenents_game_once, cycle([(
+                    tournament_dir, model_dir, first_player_name_filter, first_player_kwargs_filter,
+                    second_player_name_filter, second_player_kwargs_filter)])):
+                pass
+        finally:
+            if server is not None:
+                inference.stop_server(channels, server)
 
 
 def play_random_opponenents_game_once(args):
@@ -56,6 +66,8 @@ def list_players(model_dir):
         (MiniMaxPlayer, {'depth': 1}),
         (MiniMaxPlayer, {'depth': 2}),
         (MiniMaxPlayer, {'depth': 3}),
+        (MiniMaxPlayer, {'depth': 4}),
+        (MiniMaxPlayer, {'depth': 5}),
         (MonteCarloPlayer, {'budget': 400}),
         (MonteCarloPlayer, {'budget': 800}),
         (MonteCarloPlayer, {'budget': 1600}),
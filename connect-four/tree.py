@@ -1,54 +1,226 @@
+import heapq
 import math
 import random
+import sys
+import time
+import weakref
+from collections import OrderedDict
 from operator import itemgetter
-from typing import Dict, Union, List
+from typing import Dict, Union, List, Tuple
 
 import numpy as np
 
-from analyzer import player_value
-from state import Action, State, Color
+from analyzer import child_values, player_value
+from state import Action, State, Color, SearchBoard, encode_batch, FOUR, ACTION_GATHERS, ACTION_SCATTERS, \
+    random_playouts
 from util import winner_value
 
 
-class MiniMaxNode(object):
-    def __init__(self, state, player_color, state_color=None, parent=None):
-        self.state = state  # type: State
-        self.player_color = player_color  # type: Color
-        if state_color is None:
-            self.state_color = player_color
-        else:
-            self.state_color = state_color
-        self.parent = parent
-        self.children = None
-        self.value = player_value(self.state, self.player_color)
+class SearchTimeout(Exception):
+    pass
 
-    def expand(self):
-        if not self.state.is_end_of_game():
-            self.children = {
-                action: MiniMaxNode(self.state.take_action(action), self.player_color, self.state_color.other(), self)
-                for action in self.state.allowed_actions}
+
+class AlphaBetaSearch(object):
+    """Minimax search of `player_value` with alpha-beta pruning, iterative deepening and a transposition table
+
+    Values are tuples for the player at the root, compared lexicographically. Cutoffs are strict, such that the values
+    of the root actions that are at least as good as the best action are exact, and ties between them are found. The
+    transposition table stores values with their bound by Zobrist key and remaining depth. Each node first searches the
+    best action of the previous iteration. Nodes one move before the leaves score all their children at once with
+    `child_values`, without playing the moves on the board.
+    """
+    EXACT, LOWER, UPPER = 0, 1, 2
+    MIN_VALUE, MAX_VALUE = (-math.inf,), (math.inf,)
+
+    def __init__(self, state: State, time_budget=None):
+        """
+        :param time_budget: milliseconds after which a deeper iteration is abandoned, the first iteration always
+            completes
+        """
+        self.state = state
+        self.color = state.next_color
+        self.board = SearchBoard(state, track_lines=True)
+        self.table = {}  # type: Dict[Tuple[int, int], Tuple[Tuple, int]]
+        self.best_actions = {}  # type: Dict[int, Action]
+        self.deadline = None if time_budget is None else time.time() + time_budget / 1000
+        self.number_of_nodes = 0
+        self.depth = 0
+
+    def search(self, depth: int) -> Dict[Action, Tuple]:
+        """Values of the root actions after iteratively deepening up to `depth` moves, or as deep as the time budget
+        allows
+
+        Values of actions that are worse than the best action are upper bounds.
+        """
+        action_values = {}
+        for iteration_depth in range(1, depth + 1):
+            try:
+                action_values = self.search_root(iteration_depth, action_values)
+            except SearchTimeout:
+                break
+            self.depth = iteration_depth
+        return action_values
+
+    def search_root(self, depth: int, previous_values: Dict[Action, Tuple]) -> Dict[Action, Tuple]:
+        actions = sorted(self.board.allowed_actions, key=lambda action: previous_values.get(action, self.MIN_VALUE),
+                         reverse=True)
+        action_values = {}
+        best_value = self.MIN_VALUE
+        for action in actions:
+            self.board.push(action)
+            value = self.search_node(depth - 1, best_value, self.MAX_VALUE, False)
+            self.board.pop()
+            action_values[action] = value
+            best_value = max(best_value, value)
+        return action_values
+
+    def search_node(self, depth: int, alpha: Tuple, beta: Tuple, is_maximizing: bool) -> Tuple:
+        """Exact value if it is within the closed window, otherwise a bound outside of the window"""
+        board = self.board
+        self.number_of_nodes += 1
+        if self.deadline is not None and self.depth > 0 and self.number_of_nodes % 256 == 0 and \
+                time.time() > self.deadline:
+            raise SearchTimeout()
+        if depth == 0 or board.is_end_of_game():
+            return player_value(board, self.color)
+
+        key = (board.zobrist, depth)
+        entry = self.table.get(key)
+        if entry is not None:
+            value, bound = entry
+            if bound == self.EXACT or (bound == self.LOWER and value > beta) or (bound == self.UPPER and value < alpha):
+                return value
+
+        actions = board.allowed_actions
+        best_action = self.best_actions.get(board.zobrist)
+        if best_action is not None:
+            actions.remove(best_action)
+            actions.insert(0, best_action)
+
+        leaf_values = child_values(board, self.color) if depth == 1 else None
+        window = alpha, beta
+        best_value = self.MIN_VALUE if is_maximizing else self.MAX_VALUE
+        for action in actions:
+            if leaf_values is not None:
+                self.number_of_nodes += 1
+                value = leaf_values[action]
+            else:
+                board.push(action)
+                value = self.search_node(depth - 1, alpha, beta, not is_maximizing)
+                board.pop()
+            if is_maximizing:
+                if value > best_value:
+                    best_value, best_action = value, action
+                if best_value > beta:
+                    break
+                alpha = max(alpha, best_value)
+            else:
+                if value < best_value:
+                    best_value, best_action = value, action
+                if best_value < alpha:
+                    break
+                beta = min(beta, best_value)
+
+        if best_value > window[1]:
+            bound = self.LOWER
+        elif best_value < window[0]:
+            bound = self.UPPER
         else:
-            self.children = {}
-        self.propagate_value()
-        return self.children.values()
+            bound = self.EXACT
+        self.table[key] = best_value, bound
+        self.best_actions[board.zobrist] = best_action
+        return best_value
 
-    def propagate_value(self):
-        if not self.state.is_end_of_game():
-            if self.player_color is self.state_color:
-                self.value = max([child.value for child in self.children.values()])
+
+class TreeNode(object):
+    """Node that only weakly references its parent
+
+    Without reference cycles between parents and children, the discarded part of a tree is freed as soon as the
+    previous root is no longer referenced.
+    """
+
+    def __init__(self, parent=None):
+        self._parent = None if parent is None else weakref.ref(parent)
+        self.children = {}
+
+    @property
+    def parent(self):
+        return None if self._parent is None else self._parent()
+
+    @parent.setter
+    def parent(self, parent):
+        self._parent = None if parent is None else weakref.ref(parent)
+
+    def follow(self, actions: List[Action]):
+        """Expanded node that is reached by taking the actions, or None"""
+        node = self
+        for action in actions:
+            node = node.children.get(action)
+            if node is None:
+                return None
+        return node
+
+    def number_of_nodes(self) -> int:
+        """Number of nodes in the subtree of this node"""
+        number_of_nodes, queue = 0, [self]
+        while queue:
+            number_of_nodes += 1
+            queue.extend(queue.pop().children.values())
+        return number_of_nodes
+
+    def approximate_bytes(self) -> int:
+        """Approximate memory of the subtree of this node, see `node_bytes`"""
+        number_of_bytes, queue = 0, [self]
+        while queue:
+            node = queue.pop()
+            number_of_bytes += node_bytes(node)
+            queue.extend(node.children.values())
+        return number_of_bytes
+
+    def prune(self, max_nodes: int) -> int:
+        """Remove the children of the least visited nodes until the subtree has at most `max_nodes` nodes, and return
+        the number of removed nodes
+
+        The children of this node are kept. Pruned nodes keep their visit count and value, such that the statistics of
+        their parents are unchanged, and they are expanded again when a search reaches them. Nodes should not wait for
+        evaluation while pruning.
+        """
+        # walk down from this node in order of visit count, the subtrees of pruned nodes are never reached
+        heap = [(-node.visit_count, i, node) for i, node in enumerate(self.children.values()) if len(node.children) > 0]
+        heapq.heapify(heap)
+        counter = len(heap)
+        number_of_nodes = 1 + len(self.children)
+        number_of_removed = 0
+        while heap:
+            _, _, node = heapq.heappop(heap)
+            if number_of_nodes + len(node.children) <= max_nodes:
+                number_of_nodes += len(node.children)
+                for child in node.children.values():
+                    if len(child.children) > 0:
+                        heapq.heappush(heap, (-child.visit_count, counter, child))
+                        counter += 1
             else:
-                self.value = min([child.value for child in self.children.values()])
-        if self.parent is not None:
-            self.parent.propagate_value()
+                number_of_removed += node.number_of_nodes() - 1
+                node.children = {}
+                node.is_played = False
+        return number_of_removed
+
 
-    def __lt__(self, other):
-        return self.value < other.value
+def node_bytes(node) -> int:
+    """Approximate memory of a node, with its attributes, children dict, parent reference and state, if it is built"""
+    number_of_bytes = sys.getsizeof(node) + sys.getsizeof(node.__dict__) + sys.getsizeof(node.children) + \
+        sys.getsizeof(node._parent)
+    state = node.__dict__.get('state', node.__dict__.get('_state'))
+    if state is not None:
+        number_of_bytes += sys.getsizeof(state) + sys.getsizeof(state.brown) + sys.getsizeof(state.white) + \
+            sys.getsizeof(state.heights) + sys.getsizeof(state.zobrist)
+    return number_of_bytes
 
 
-class MonteCarloNode(object):
+class MonteCarloNode(TreeNode):
     def __init__(self, state: State, parent=None, exploration=1.0):
+        super().__init__(parent)
         self.state = state
-        self.parent = parent  # type: Union['MonteCarloNode', None]
         self.exploration = exploration
         self.children = {}  # type: Dict[Action, MonteCarloNode]
         self.is_played = False
@@ -63,11 +235,21 @@ class MonteCarloNode(object):
         action, _ = max(self.children.items(), key=lambda x: x[1].visit_count)
         return action
 
-    def search(self):
+    def search(self, rollouts=1):
+        """Do a single MCTS search, with a select, expand, simulate and propagate phase
+
+        :param rollouts: number of random games played from the expanded node, more than one are played at once with
+            `random_playouts`
+        """
         selected_node = self.select()
         expanded_node = selected_node.expand()
-        final_state = expanded_node.simulate()
-        expanded_node.propagate(final_state)
+        if rollouts == 1:
+            winner = expanded_node.simulate()
+            expanded_node.propagate(winner)
+        else:
+            winners = random_playouts(expanded_node.state, rollouts)
+            expanded_node.propagate_playouts(rollouts, int((winners == Color.WHITE.value).sum()),
+                                             int((winners == Color.BROWN.value).sum()))
 
     def select(self) -> 'MonteCarloNode':
         if self.is_played and not self.state.is_end_of_game():
@@ -102,19 +284,23 @@ class MonteCarloNode(object):
     def unvisited_children(self) -> 'List[MonteCarloNode]':
         return [child for child in self.children.values() if child.visit_count == 0]
 
-    def simulate(self) -> 'State':
-        state = self.state
-        while not state.is_end_of_game():
-            action = random.choice(list(state.allowed_actions))
-            state = state.take_action(action)
-        return state
+    def simulate(self) -> Union[Color, None]:
+        """Play random actions until the end of the game and return the winner"""
+        board = SearchBoard(self.state)
+        while not board.is_end_of_game():
+            board.push(board.random_action())
+        return board.winner
 
-    def propagate(self, final_state: State):
-        self.visit_count += 1
-        self.white_wins += final_state.winner == Color.WHITE
-        self.brown_wins += final_state.winner == Color.BROWN
-        if self.parent is not None:
-            self.parent.propagate(final_state)
+    def propagate(self, winner: Union[Color, None]):
+        self.propagate_playouts(1, int(winner == Color.WHITE), int(winner == Color.BROWN))
+
+    def propagate_playouts(self, number_of_playouts: int, white_wins: int, brown_wins: int):
+        self.visit_count += number_of_playouts
+        self.white_wins += white_wins
+        self.brown_wins += brown_wins
+        parent = self.parent
+        if parent is not None:
+            parent.propagate_playouts(number_of_playouts, white_wins, brown_wins)
 
     def find_state(self, state: State):
         if self.state.number_of_stones < state.number_of_stones:
@@ -129,10 +315,22 @@ class MonteCarloNode(object):
         return None
 
 
-class AlphaConnectNode(object):
-    def __init__(self, state: State, action_prob, parent=None, add_dirichlet_noise=False):
-        self.state = state
-        self.parent = parent  # type: Union[AlphaConnectNode, None]
+class AlphaConnectNode(TreeNode):
+    """Node of an MCTS tree guided by a model
+
+    Children are created without a state, which is built from the state of the parent when a search first selects the
+    child. Most children are never selected before a move is made.
+    """
+
+    def __init__(self, state: Union[None, State], action_prob, parent=None, add_dirichlet_noise=False,
+                 action: Action = None):
+        """
+        :param state: state of the node, or None for a child of which the state is built from the state of the parent
+            and the action when it is first needed
+        """
+        super().__init__(parent)
+        self._state = state
+        self.action = action
         self.children = {}  # type: Dict[Action, AlphaConnectNode]
         self.is_played = False
         self.add_dirichlet_noise = add_dirichlet_noise
@@ -145,18 +343,35 @@ class AlphaConnectNode(object):
         return 'Node(prior=%.2f, value=%.2f/%d=%.2f)' % \
                (self.action_prob, self.total_value, self.visit_count, self.average_value)
 
+    @property
+    def state(self) -> State:
+        if self._state is None:
+            self._state = self.parent.state.take_action(self.action)
+        return self._state
+
+    def number_of_states(self) -> int:
+        """Number of nodes in the subtree of this node of which the state is built"""
+        number_of_states, queue = 0, [self]
+        while queue:
+            node = queue.pop()
+            number_of_states += node._state is not None
+            queue.extend(node.children.values())
+        return number_of_states
+
     @property
     def average_value(self):
         return self.total_value / self.visit_count
 
-    def search(self, model: 'BatchEvaluator', c_puct: float):
+    def search(self, model: 'BatchEvaluator', c_puct: float, virtual_loss: float = 0.0):
         """Do a single MCTS search, with a select, expand, simulate and backup phase
 
         :param c_puct: exploration constant, higher is more exploration
+        :param virtual_loss: loss added to the searched path until the model has evaluated the selected node, such that
+            other searches in the same batch select different nodes
         """
         selected_node = self.select(c_puct)
         selected_node.expand()
-        selected_node.lazy_evaluate_and_backup(model)
+        selected_node.lazy_evaluate_and_backup(model, virtual_loss)
 
     def select(self, c_puct: float) -> 'AlphaConnectNode':
         if self.is_played and not self.state.is_end_of_game():
@@ -175,30 +390,33 @@ class AlphaConnectNode(object):
     def expand(self):
         if not self.state.is_end_of_game():
             for action in self.state.allowed_actions:
-                state = self.state.take_action(action)
-                self.children[action] = AlphaConnectNode(state, action_prob=1 / len(self.state.allowed_actions),
-                                                         parent=self)
+                self.children[action] = AlphaConnectNode(None, action_prob=1 / len(self.state.allowed_actions),
+                                                         parent=self, action=action)
         self.is_played = True
 
-    def lazy_evaluate_and_backup(self, model: 'BatchEvaluator'):
-        self.backup_visit_count()
-        model.simulate(self, callback=self.backup_value)
+    def lazy_evaluate_and_backup(self, model: 'BatchEvaluator', virtual_loss: float = 0.0):
+        self.backup_visit_count(virtual_loss)
+        model.simulate(self, callback=lambda value, action_probs: self.backup_value(value, action_probs, virtual_loss))
 
-    def backup_visit_count(self):
+    def backup_visit_count(self, virtual_loss: float = 0.0):
+        """Count the visit, and let each node on the path look like a loss for the player choosing it"""
         self.visit_count += 1
-        if self.parent is not None:
-            self.parent.backup_visit_count()
+        self.total_value += virtual_loss
+        parent = self.parent
+        if parent is not None:
+            parent.backup_visit_count(virtual_loss)
 
-    def backup_value(self, value: float, action_probs: Union[None, Dict[Action, float]]):
+    def backup_value(self, value: float, action_probs: Union[None, Dict[Action, float]], virtual_loss: float = 0.0):
         if not self.state.is_end_of_game() and action_probs is not None:
             for action in self.state.allowed_actions:
                 self.children[action].action_prob = action_probs[action]
             if self.add_dirichlet_noise:
                 self.add_dirichlet_noise_to_action_probs()
 
-        self.total_value += value
-        if self.parent is not None:
-            self.parent.backup_value(-value, None)
+        self.total_value += value - virtual_loss
+        parent = self.parent
+        if parent is not None:
+            parent.backup_value(-value, None, virtual_loss)
 
     def add_dirichlet_noise_to_action_probs(self):
         """Additional dirichlet noise is added to empty state for additional exploration
@@ -221,6 +439,11 @@ class AlphaConnectNode(object):
         else:
             return None
 
+    def make_root(self):
+        # the state is built from the parent, which is no longer referenced by a root
+        self.state
+        self.parent = None
+
     def sample_action(self, temperature: Union[None, float]):
         if temperature is None:
             return max(self.children.items(), key=lambda action_state: action_state[1].visit_count)[0]
@@ -237,35 +460,731 @@ class AlphaConnectNode(object):
     def exponentiated_visit_count(self, temperature: float) -> float:
         return self.visit_count ** (1.0 / temperature)
 
+    def action_statistics(self) -> Dict[Action, Tuple[int, float]]:
+        """Visit count and average value of each action, for the player choosing it"""
+        return {action: (child.visit_count, -child.average_value) for action, child in self.children.items()}
+
+
+class AlphaConnectSolverNode(AlphaConnectNode):
+    """Node that proves wins and losses, with MCTS-solver semantics
+
+    `proven` is the exact value of a solved state for the player to move: 1 for a win, -1 for a loss and 0 for a draw.
+    A state is won when the player to move can complete a line, and lost when the opponent can complete lines at two
+    pins. When the opponent can complete a line at one pin, the only child is the move that blocks it, and searches
+    pass through such forced moves without evaluating them. Proofs propagate to the parents, and searches that reach a
+    solved state back up its exact value without evaluation by the model.
+    """
+
+    def __init__(self, state: Union[None, State], action_prob, parent=None, add_dirichlet_noise=False,
+                 action: Action = None, proven: int = None):
+        """
+        :param proven: value of a child without a state, as its parent knows whether the action ends the game
+        """
+        super().__init__(state, action_prob, parent, add_dirichlet_noise, action)
+        self.proven = proven  # type: Union[None, int]
+        if state is not None and state.has_winner():
+            self.proven = -1
+        elif state is not None and state.is_end_of_game():
+            self.proven = 0
+
+    def __str__(self):
+        if self.proven is None:
+            return super().__str__()
+        return 'Node(prior=%.2f, proven=%d, n=%d)' % (self.action_prob, self.proven, self.visit_count)
+
+    def search(self, model: 'BatchEvaluator', c_puct: float, virtual_loss: float = 0.0):
+        selected_node = self.select(c_puct)
+        selected_node.expand()
+        while selected_node.proven is None and len(selected_node.children) == 1:
+            selected_node = next(iter(selected_node.children.values()))
+            selected_node.expand()
+
+        if selected_node.proven is None:
+            selected_node.lazy_evaluate_and_backup(model, virtual_loss)
+        else:
+            selected_node.backup_visit_count(virtual_loss)
+            selected_node.backup_value(selected_node.proven, None, virtual_loss)
+
+    def select(self, c_puct: float) -> 'AlphaConnectSolverNode':
+        if self.proven is None and self.is_played:
+            puct_policy = self.puct_weights(c_puct)
+            child = max(puct_policy.items(), key=itemgetter(1))[0]
+            return child.select(c_puct)
+        else:
+            return self
+
+    def puct_weights(self, c_puct: float) -> Dict[State, float]:
+        """Weights of the children that are not proven wins for the opponent"""
+        return {child: weight for child, weight in super().puct_weights(c_puct).items() if child.proven != 1}
+
+    def expand(self):
+        if self.is_played or self.proven is not None:
+            self.is_played = True
+            return
+
+        winning_actions = self.state.winning_actions(self.state.next_color)
+        losing_actions = self.state.winning_actions(self.state.next_color.other())
+        if len(winning_actions) > 0:
+            actions = winning_actions[:1]
+        elif len(losing_actions) == 1:
+            actions = losing_actions
+        else:
+            actions = self.state.allowed_actions
+        is_last_stone = self.state.number_of_stones + 1 == FOUR ** 3
+        for action in actions:
+            proven = -1 if action in winning_actions else 0 if is_last_stone else None
+            self.children[action] = AlphaConnectSolverNode(None, action_prob=1 / len(actions), parent=self,
+                                                           action=action, proven=proven)
+        self.is_played = True
+
+        if len(winning_actions) == 0 and len(losing_actions) > 1:
+            self.prove(-1)
+        else:
+            self.update_proof()
+
+    def update_proof(self):
+        """Prove this node from its children, and its parents from this node"""
+        child_proofs = [child.proven for child in self.children.values()]
+        if -1 in child_proofs:
+            self.prove(1)
+        elif None not in child_proofs:
+            self.prove(-max(child_proofs))
+
+    def prove(self, value: int):
+        self.proven = value
+        parent = self.parent
+        if parent is not None and parent.proven is None:
+            parent.update_proof()
+
+    def backup_value(self, value: float, action_probs: Union[None, Dict[Action, float]], virtual_loss: float = 0.0):
+        if action_probs is not None:
+            for action, child in self.children.items():
+                child.action_prob = action_probs[action]
+            if self.add_dirichlet_noise:
+                self.add_dirichlet_noise_to_action_probs()
+        super().backup_value(value, None, virtual_loss)
+
+    def proven_action(self) -> Union[None, Action]:
+        """Action that keeps a proven win or draw, or the only action of a forced move"""
+        if self.proven is not None and self.proven >= 0:
+            return next(action for action, child in self.children.items() if child.proven == -self.proven)
+        if len(self.children) == 1:
+            return next(iter(self.children))
+        return None
+
+
+class TranspositionTable(object):
+    """Nodes of a search graph by state, such that move orders that transpose into the same state share a node"""
+
+    def __init__(self):
+        self.nodes = {}  # type: Dict[State, AlphaConnectGraphNode]
+        self.number_of_transpositions = 0
+        self.saved_visits = 0
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def node(self, state: State) -> 'AlphaConnectGraphNode':
+        """Existing node of a state, or a new node if the state was not seen before"""
+        node = self.nodes.get(state)
+        if node is None:
+            node = AlphaConnectGraphNode(state, self)
+            self.nodes[state] = node
+        else:
+            self.number_of_transpositions += 1
+            self.saved_visits += node.visit_count - 1
+        return node
+
+    def retain(self, root: 'AlphaConnectGraphNode'):
+        """Forget all nodes that are not reachable from the root"""
+        self.nodes = {root.state: root}
+        queue = [root]
+        while queue:
+            for child in queue.pop().children.values():
+                if child.state not in self.nodes:
+                    self.nodes[child.state] = child
+                    queue.append(child)
+
+    def stats(self) -> Dict[str, int]:
+        return {'nodes': len(self.nodes), 'transpositions': self.number_of_transpositions,
+                'saved_visits': self.saved_visits}
+
+
+class AlphaConnectGraphNode(AlphaConnectNode):
+    """Node in a search graph where transposed states share a node
+
+    Values and visit counts of a node are aggregated over all paths to it. Action probabilities and visit counts of the
+    actions are kept per node, and values are backed up along the searched path instead of to a single parent.
+    """
+
+    def __init__(self, state: State, table: TranspositionTable, add_dirichlet_noise=False):
+        super().__init__(state, action_prob=1.0, add_dirichlet_noise=add_dirichlet_noise)
+        self.table = table
+        self.action_probs = {}  # type: Dict[Action, float]
+        self.action_visit_counts = {}  # type: Dict[Action, int]
+
+    @classmethod
+    def new_root(cls, state: State) -> 'AlphaConnectGraphNode':
+        return TranspositionTable().node(state)
+
+    def search(self, model: 'BatchEvaluator', c_puct: float, virtual_loss: float = 0.0):
+        path, actions = self.select_path(c_puct)
+        leaf = path[-1]
+        leaf.expand()
+        for node, action in zip(path, actions):
+            node.action_visit_counts[action] += 1
+        for node in path:
+            node.visit_count += 1
+            node.total_value += virtual_loss
+        model.simulate(leaf, callback=lambda value, action_probs:
+                       leaf.backup_path_value(path, value, action_probs, virtual_loss))
+
+    def select_path(self, c_puct: float):
+        path, actions = [self], []
+        node = self
+        while node.is_played and not node.state.is_end_of_game():
+            action = max(node.puct_weights(c_puct).items(), key=itemgetter(1))[0]
+            node = node.children[action]
+            path.append(node)
+            actions.append(action)
+        return path, actions
+
+    def puct_weights(self, c_puct: float) -> Dict[Action, float]:
+        sqrt_visit_count = math.sqrt(self.visit_count)
+        return {action: -child.average_value
+                + c_puct * (self.action_probs[action] * sqrt_visit_count / self.action_visit_counts[action])
+                for action, child in self.children.items()}
+
+    def expand(self):
+        if not self.is_played and not self.state.is_end_of_game():
+            for action in self.state.allowed_actions:
+                self.children[action] = self.table.node(self.state.take_action(action))
+                self.action_probs[action] = 1 / len(self.state.allowed_actions)
+                self.action_visit_counts[action] = 1
+        self.is_played = True
+
+    def backup_path_value(self, path: List['AlphaConnectGraphNode'], value: float,
+                          action_probs: Union[None, Dict[Action, float]], virtual_loss: float = 0.0):
+        if not self.state.is_end_of_game() and action_probs is not None:
+            for action in self.state.allowed_actions:
+                self.action_probs[action] = action_probs[action]
+            if self.add_dirichlet_noise:
+                self.add_dirichlet_noise_to_action_probs()
+
+        for node in reversed(path):
+            node.total_value += value - virtual_loss
+            value = -value
+
+    def add_dirichlet_noise_to_action_probs(self):
+        dirichlet_noise = np.random.dirichlet([0.03 for _ in range(len(self.children))])
+        for action, noise in zip(self.children, dirichlet_noise.tolist()):
+            self.action_probs[action] = self.action_probs[action] * .75 + noise * .25
+
+    def find_state(self, state: State) -> Union[None, 'AlphaConnectGraphNode']:
+        return self.table.nodes.get(state)
+
+    def make_root(self):
+        self.table.retain(self)
+
+    def number_of_nodes(self) -> int:
+        """Number of nodes in the graph, which only contains the nodes reachable from the root"""
+        return len(self.table)
+
+    def number_of_states(self) -> int:
+        """Number of nodes, states are built when the node is created to look it up in the table"""
+        return self.number_of_nodes()
+
+    def approximate_bytes(self) -> int:
+        return sys.getsizeof(self.table.nodes) + sum(sys.getsizeof(node.action_probs) +
+                                                     sys.getsizeof(node.action_visit_counts) + node_bytes(node)
+                                                     for node in self.table.nodes.values())
+
+    def sample_action(self, temperature: Union[None, float]):
+        if temperature is None:
+            return max(self.action_visit_counts.items(), key=itemgetter(1))[0]
+        return super().sample_action(temperature)
+
+    def policy(self, temperature: float) -> Dict[Action, float]:
+        raw_policy = {action: visit_count ** (1.0 / temperature)
+                      for action, visit_count in self.action_visit_counts.items()}
+        sum_policy = sum(raw_policy.values())
+        return {action: policy_value / sum_policy for action, policy_value in raw_policy.items()}
+
+    def action_statistics(self) -> Dict[Action, Tuple[int, float]]:
+        return {action: (self.action_visit_counts[action], -child.average_value)
+                for action, child in self.children.items()}
+
+
+class AlphaConnectArrayTree(object):
+    """Search tree of `AlphaConnectNode` searches stored as a struct of numpy arrays
+
+    Nodes are allocated in blocks with a slot for each of the 16 actions. The children of a node are one block, such
+    that PUCT selection is vectorized over the 16 slots of a block. Slots of actions that are not allowed have action
+    -1. Blocks of discarded subtrees are recycled through a free list, and the arrays grow when no block is free.
+
+    Searches follow the same steps, and use random numbers in the same order, as `AlphaConnectNode`. Values are backed
+    up along the parent pointers at the time of evaluation. Evaluations of nodes in recycled blocks are ignored, which
+    is detected by a generation counter per block.
+    """
+    BLOCK_SIZE = FOUR * FOUR
+    _SLOTS = np.arange(FOUR * FOUR)
+    _ALTERNATING_SIGNS = np.array([1.0, -1.0] * (FOUR ** 3 + 1))
+
+    def __init__(self, number_of_blocks=256):
+        size = number_of_blocks * self.BLOCK_SIZE
+        self.visit_count = np.zeros(size, dtype=np.int64)
+        self.total_value = np.zeros(size)
+        self.action_prob = np.zeros(size)
+        self.first_child = np.full(size, -1, dtype=np.int64)
+        self.parent = np.full(size, -1, dtype=np.int64)
+        self.action = np.full(size, -1, dtype=np.int8)
+        self.is_played = np.zeros(size, dtype=bool)
+        self.is_end_of_game = np.zeros(size, dtype=bool)
+        self.add_dirichlet_noise = np.zeros(size, dtype=bool)
+        self.states = [None] * size  # type: List[Union[State, None]]
+        self.is_allocated = np.zeros(number_of_blocks, dtype=bool)
+        self.generation = np.zeros(number_of_blocks, dtype=np.int64)
+        self.free_blocks = list(range(number_of_blocks - 1, -1, -1))
+
+    def __len__(self):
+        """Number of allocated node slots"""
+        return int(self.is_allocated.sum()) * self.BLOCK_SIZE
+
+    def new_root(self, state: State) -> 'AlphaConnectArrayNode':
+        node = self._allocate_block()
+        self._init_node(node, state, -1, -1, action_prob=1.0)
+        return AlphaConnectArrayNode(self, node)
+
+    def _grow(self):
+        size = len(self.states)
+        self.visit_count = np.concatenate([self.visit_count, np.zeros(size, dtype=np.int64)])
+        self.total_value = np.concatenate([self.total_value, np.zeros(size)])
+        self.action_prob = np.concatenate([self.action_prob, np.zeros(size)])
+        self.first_child = np.concatenate([self.first_child, np.full(size, -1, dtype=np.int64)])
+        self.parent = np.concatenate([self.parent, np.full(size, -1, dtype=np.int64)])
+        self.action = np.concatenate([self.action, np.full(size, -1, dtype=np.int8)])
+        self.is_played = np.concatenate([self.is_played, np.zeros(size, dtype=bool)])
+        self.is_end_of_game = np.concatenate([self.is_end_of_game, np.zeros(size, dtype=bool)])
+        self.add_dirichlet_noise = np.concatenate([self.add_dirichlet_noise, np.zeros(size, dtype=bool)])
+        self.states.extend([None] * size)
+        number_of_blocks = len(self.is_allocated)
+        self.is_allocated = np.concatenate([self.is_allocated, np.zeros(number_of_blocks, dtype=bool)])
+        self.generation = np.concatenate([self.generation, np.zeros(number_of_blocks, dtype=np.int64)])
+        self.free_blocks.extend(range(2 * number_of_blocks - 1, number_of_blocks - 1, -1))
+
+    def _allocate_block(self) -> int:
+        if len(self.free_blocks) == 0:
+            self._grow()
+        block = self.free_blocks.pop()
+        self.is_allocated[block] = True
+        first = block * self.BLOCK_SIZE
+        self.action[first:first + self.BLOCK_SIZE] = -1
+        self.visit_count[first:first + self.BLOCK_SIZE] = 1
+        return first
+
+    def _init_node(self, node: int, state: State, parent: int, action: int, action_prob: float):
+        self.states[node] = state
+        self.parent[node] = parent
+        self.action[node] = action
+        self.first_child[node] = -1
+        self.is_played[node] = False
+        self.is_end_of_game[node] = state.is_end_of_game()
+        self.add_dirichlet_noise[node] = False
+        self.visit_count[node] = 1
+        self.total_value[node] = random.normalvariate(0, .01)  # random first move before nn evaluation
+        self.action_prob[node] = action_prob
+
+    def children(self, node: int) -> List[int]:
+        """Child slots in the order in which they were expanded"""
+        first = self.first_child[node]
+        if first < 0:
+            return []
+        return [first + action.to_int() for action in self.states[node].allowed_actions]
+
+    def path(self, node: int) -> np.ndarray:
+        """Nodes from the root to node"""
+        path = [node]
+        while self.parent[node] >= 0:
+            node = int(self.parent[node])
+            path.append(node)
+        return np.array(path[::-1])
+
+    def search(self, root: int, model: 'BatchEvaluator', c_puct: float, virtual_loss: float = 0.0):
+        path = self.select(root, c_puct)
+        leaf = int(path[-1])
+        self.expand(leaf)
+        self.visit_count[path] += 1
+        self.total_value[path] += virtual_loss
+        generation = self.generation[leaf // self.BLOCK_SIZE]
+        model.simulate(AlphaConnectArrayNode(self, leaf), callback=lambda value, action_probs:
+                       self.backup_value(leaf, generation, value, action_probs, virtual_loss))
+
+    def select(self, node: int, c_puct: float) -> np.ndarray:
+        path = [node]
+        while self.is_played[node] and not self.is_end_of_game[node]:
+            slots = self.first_child[node] + self._SLOTS
+            visit_count = self.visit_count[slots]
+            puct = -(self.total_value[slots] / visit_count) + \
+                c_puct * (self.action_prob[slots] * math.sqrt(self.visit_count[node]) / visit_count)
+            puct[self.action[slots] < 0] = -np.inf
+            node = int(slots[np.argmax(puct)])
+            path.append(node)
+        return np.array(path)
+
+    def expand(self, node: int):
+        if not self.is_end_of_game[node]:
+            state = self.states[node]
+            first = self._allocate_block()
+            self.first_child[node] = first
+            for action in state.allowed_actions:
+                action_i = action.to_int()
+                self._init_node(first + action_i, state.take_action(action), node, action_i,
+                                action_prob=1 / len(state.allowed_actions))
+        self.is_played[node] = True
+
+    def backup_value(self, leaf: int, generation: int, value: float, action_probs: Union[None, Dict[Action, float]],
+                     virtual_loss: float = 0.0):
+        if self.generation[leaf // self.BLOCK_SIZE] != generation or self.states[leaf] is None:
+            return  # node was discarded
+
+        path = self.path(leaf)
+        if not self.is_end_of_game[leaf] and action_probs is not None:
+            first = self.first_child[leaf]
+            for action in self.states[leaf].allowed_actions:
+                self.action_prob[first + action.to_int()] = action_probs[action]
+            if self.add_dirichlet_noise[leaf]:
+                self.add_dirichlet_noise_to_action_probs(leaf)
+
+        self.total_value[path] += value * self._ALTERNATING_SIGNS[len(path) - 1::-1] - virtual_loss
+
+    def add_dirichlet_noise_to_action_probs(self, node: int):
+        children = self.children(node)
+        dirichlet_noise = np.random.dirichlet([0.03 for _ in range(len(children))])
+        for child, noise in zip(children, dirichlet_noise.tolist()):
+            self.action_prob[child] = self.action_prob[child] * .75 + noise * .25
+
+    def set_root(self, node: int):
+        """Make node the root and recycle the blocks of all nodes that are not in its subtree"""
+        block = node // self.BLOCK_SIZE
+        for sibling in range(block * self.BLOCK_SIZE, (block + 1) * self.BLOCK_SIZE):
+            if sibling != node:
+                self.action[sibling] = -1
+                self.parent[sibling] = -1
+                self.states[sibling] = None
+
+        keep = np.zeros_like(self.is_allocated)
+        keep[block] = True
+        frontier = np.array([node])
+        while len(frontier) > 0:
+            first = self.first_child[frontier]
+            first = first[first >= 0]
+            keep[first // self.BLOCK_SIZE] = True
+            slots = (first[:, None] + self._SLOTS).ravel()
+            frontier = slots[(self.action[slots] >= 0) & self.is_played[slots]]
+
+        for block in np.flatnonzero(self.is_allocated & ~keep).tolist():
+            self.states[block * self.BLOCK_SIZE:(block + 1) * self.BLOCK_SIZE] = [None] * self.BLOCK_SIZE
+            self.is_allocated[block] = False
+            self.generation[block] += 1
+            self.free_blocks.append(block)
+        self.parent[node] = -1
+
+
+class AlphaConnectArrayNode(object):
+    """View on a node of an `AlphaConnectArrayTree` with the interface of `AlphaConnectNode`"""
+    __slots__ = ('tree', 'index', 'state')
+
+    def __init__(self, tree: AlphaConnectArrayTree, index: int):
+        self.tree = tree
+        self.index = index
+        self.state = tree.states[index]  # type: State
+
+    def __str__(self):
+        return 'Node(prior=%.2f, value=%.2f/%d=%.2f)' % \
+               (self.action_prob, self.total_value, self.visit_count, self.average_value)
+
+    @property
+    def parent(self) -> Union['AlphaConnectArrayNode', None]:
+        parent = self.tree.parent[self.index]
+        return None if parent < 0 else AlphaConnectArrayNode(self.tree, int(parent))
+
+    @property
+    def children(self) -> Dict[Action, 'AlphaConnectArrayNode']:
+        return {Action.from_int(int(self.tree.action[child])): AlphaConnectArrayNode(self.tree, child)
+                for child in self.tree.children(self.index)}
+
+    @property
+    def visit_count(self) -> int:
+        return int(self.tree.visit_count[self.index])
+
+    @property
+    def total_value(self) -> float:
+        return float(self.tree.total_value[self.index])
+
+    @property
+    def average_value(self):
+        return self.total_value / self.visit_count
+
+    @property
+    def action_prob(self) -> float:
+        return float(self.tree.action_prob[self.index])
+
+    @property
+    def is_played(self) -> bool:
+        return bool(self.tree.is_played[self.index])
+
+    @property
+    def add_dirichlet_noise(self) -> bool:
+        return bool(self.tree.add_dirichlet_noise[self.index])
+
+    @add_dirichlet_noise.setter
+    def add_dirichlet_noise(self, value: bool):
+        self.tree.add_dirichlet_noise[self.index] = value
+
+    def search(self, model: 'BatchEvaluator', c_puct: float, virtual_loss: float = 0.0):
+        self.tree.search(self.index, model, c_puct, virtual_loss)
+
+    def add_dirichlet_noise_to_action_probs(self):
+        self.tree.add_dirichlet_noise_to_action_probs(self.index)
+
+    def make_root(self):
+        self.tree.set_root(self.index)
+
+    def follow(self, actions: List[Action]) -> Union[None, 'AlphaConnectArrayNode']:
+        """Expanded node that is reached by taking the actions, or None"""
+        node = self.index
+        for action in actions:
+            children = [child for child in self.tree.children(node) if self.tree.action[child] == action.to_int()]
+            if len(children) == 0:
+                return None
+            node = children[0]
+        return AlphaConnectArrayNode(self.tree, node)
+
+    def number_of_nodes(self) -> int:
+        number_of_nodes, queue = 0, [self.index]
+        while queue:
+            number_of_nodes += 1
+            queue.extend(self.tree.children(queue.pop()))
+        return number_of_nodes
+
+    def number_of_states(self) -> int:
+        return self.number_of_nodes()
+
+    def approximate_bytes(self) -> int:
+        """Memory of the whole array tree, including free blocks"""
+        tree = self.tree
+        arrays = [tree.visit_count, tree.total_value, tree.action_prob, tree.first_child, tree.parent, tree.action,
+                  tree.is_played, tree.is_end_of_game, tree.add_dirichlet_noise, tree.is_allocated, tree.generation]
+        states = [state for state in tree.states if state is not None]
+        return sum(array.nbytes for array in arrays) + sys.getsizeof(tree.states) + \
+            len(states) * (sys.getsizeof(State.empty()) + 4 * sys.getsizeof(1 << 63))
+
+    def find_state(self, state: State) -> Union[None, 'AlphaConnectArrayNode']:
+        if self.state.number_of_stones < state.number_of_stones:
+            for child in self.tree.children(self.index):
+                new_state = AlphaConnectArrayNode(self.tree, child).find_state(state)
+                if new_state is not None:
+                    return new_state
+        elif self.state.number_of_stones == state.number_of_stones:
+            if self.state == state:
+                return self
+        return None
+
+    def sample_action(self, temperature: Union[None, float]):
+        if temperature is None:
+            return max(self.children.items(), key=lambda action_node: action_node[1].visit_count)[0]
+        else:
+            actions, probabilities = zip(*self.policy(temperature).items())
+            action = random.choices(list(actions), list(probabilities))[0]
+            return action
+
+    def policy(self, temperature: float) -> Dict[Action, float]:
+        raw_policy = {action: node.visit_count ** (1.0 / temperature) for action, node in self.children.items()}
+        sum_policy = sum(raw_policy.values())
+        return {action: policy_value / sum_policy for action, policy_value in raw_policy.items()}
+
+    def action_statistics(self) -> Dict[Action, Tuple[int, float]]:
+        return {action: (node.visit_count, -node.average_value) for action, node in self.children.items()}
+
+
+def is_decided(statistics: Dict[Action, Tuple[int, float]], remaining_searches: float, value_gap: float = None) -> bool:
+    """Whether more searches cannot change the most visited action, given the `action_statistics` of the root
+
+    Strictly the other actions cannot catch up with its visit count in the remaining searches. Leniently, with a value
+    gap, it has at least half of the visits and its value exceeds the values of the other actions by the gap.
+    """
+    if len(statistics) < 2:
+        return len(statistics) == 1
+    best_action, (best_visit_count, best_value) = max(statistics.items(), key=lambda item: item[1][0])
+    others = [action_statistics for action, action_statistics in statistics.items() if action != best_action]
+    if all(visit_count + remaining_searches < best_visit_count for visit_count, _ in others):
+        return True
+    if value_gap is not None and 2 * best_visit_count >= sum(visit_count for visit_count, _ in statistics.values()):
+        return all(value + value_gap <= best_value for _, value in others)
+    return False
+
+
+class EvaluationCache(object):
+    """Least recently used cache of model evaluations
+
+    Evaluations are stored under the canonical key of a state, with the policy in the canonical augmentation, such that
+    the eight symmetric states share an entry.
+    """
+
+    def __init__(self, max_size=2 ** 16):
+        self.max_size = max_size
+        self.model_key = None
+        self.entries = OrderedDict()  # type: OrderedDict[int, Tuple[float, np.ndarray]]
+        self.number_of_hits = 0
+        self.number_of_misses = 0
+        self.number_of_evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, state: State) -> Union[None, Tuple[float, Dict[Action, float]]]:
+        """Cached value and action probabilities of a state, or None"""
+        key, augmentation = state.canonical_key()
+        entry = self.entries.get(key)
+        if entry is None:
+            self.number_of_misses += 1
+            return None
+
+        self.number_of_hits += 1
+        self.entries.move_to_end(key)
+        value, canonical_policy = entry
+        return value, dict(zip(Action.iter_actions(), canonical_policy[ACTION_SCATTERS[augmentation.to_int()]]))
+
+    def put(self, state: State, value: float, policy: np.ndarray):
+        key, augmentation = state.canonical_key()
+        self.entries[key] = value, policy[ACTION_GATHERS[augmentation.to_int()]]
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.number_of_evictions += 1
+
+    def set_model(self, model_key):
+        """Clear the cache if the evaluations are from a different model"""
+        if model_key != self.model_key:
+            self.entries.clear()
+            self.model_key = model_key
+
+    def stats(self) -> Dict[str, float]:
+        hit_rate = self.number_of_hits / max(1, self.number_of_hits + self.number_of_misses)
+        return {'size': len(self.entries), 'hits': self.number_of_hits, 'misses': self.number_of_misses,
+                'hit_rate': hit_rate, 'evictions': self.number_of_evictions}
+
 
 class BatchEvaluator(object):
-    """Evaluate multiple states in batches"""
+    """Evaluate multiple states in batches
 
-    def __init__(self, model, batch_size):
+    Nodes with the same state in a batch are evaluated once, as duplicates. Call `flush` to evaluate the nodes of a
+    partly filled batch, e.g. at the end of a search. With a cache, evaluations of previously seen and symmetric states
+    are reused without calling the model.
+    """
+
+    def __init__(self, model, batch_size, cache: EvaluationCache = None):
         self.model = model
         self.batch_size = batch_size
-        self.queue = []
+        self.cache = cache
+        self.queue = {}  # type: Dict[State, List]
+        self.number_of_predictions = 0
+        self.number_of_evaluations = 0
+        self.number_of_duplicates = 0
+        self.number_of_flushes = 0
 
     def simulate(self, node: 'AlphaConnectNode', callback):
         if node.state.is_end_of_game():
             state_value = self.evaluate_final_state(node)
             callback(state_value, None)
-        else:
-            self.queue.append((node, callback))
+            return
+
+        if node.state in self.queue:
+            self.number_of_duplicates += 1
+            self.queue[node.state].append(callback)
+            return
+
+        evaluation = self.cache.get(node.state) if self.cache is not None else None
+        if evaluation is not None:
+            callback(*evaluation)
+            return
 
+        self.queue[node.state] = [callback]
         if len(self.queue) >= self.batch_size:
-            nodes, callbacks = zip(*self.queue)
-            array = np.concatenate(list(map(lambda node: node.state.to_numpy(batch=True), nodes))).astype(float)
-            pred_actions, pred_value = self.model.predict(array)
+            self.evaluate_queue()
+
+    @property
+    def number_of_pending(self) -> int:
+        """Number of queued nodes that wait for evaluation"""
+        return sum(len(callbacks) for callbacks in self.queue.values())
+
+    def flush(self):
+        """Evaluate all queued nodes, even if the batch is not full"""
+        if len(self.queue) > 0:
+            self.number_of_flushes += 1
+            self.evaluate_queue()
 
-            for i, callback in enumerate(callbacks):
-                state_value = pred_value[i].item()
-                action_probs = dict(zip(Action.iter_actions(), pred_actions[i]))
+    def evaluate_queue(self):
+        queue = self.take_queue()
+        self.backup_queue(queue, self.predict_queue(queue))
+
+    def take_queue(self) -> Dict[State, List]:
+        queue, self.queue = self.queue, {}
+        return queue
+
+    def predict_queue(self, queue: Dict[State, List]):
+        # models that take small counts as uint8, such as the NumPy engine, declare an `input_dtype`
+        array = encode_batch(list(queue.keys()), dtype=getattr(self.model, 'input_dtype', np.float32))
+        predictions = self.model.predict(array)
+        self.number_of_predictions += 1
+        self.number_of_evaluations += len(queue)
+        return predictions
+
+    def backup_queue(self, queue: Dict[State, List], predictions):
+        pred_actions, pred_value = predictions
+        for i, (state, callbacks) in enumerate(queue.items()):
+            state_value = pred_value[i].item()
+            if self.cache is not None:
+                self.cache.put(state, state_value, pred_actions[i])
+            action_probs = dict(zip(Action.iter_actions(), pred_actions[i]))
+            for callback in callbacks:
                 callback(state_value, action_probs)
 
-            self.queue = []
+    def stats(self) -> Dict[str, float]:
+        """Number of predictions, average fill rate of their batches, and number of duplicate and flushed nodes"""
+        fill_rate = self.number_of_evaluations / max(1, self.number_of_predictions * self.batch_size)
+        return {'predictions': self.number_of_predictions, 'evaluations': self.number_of_evaluations,
+                'fill_rate': fill_rate, 'duplicates': self.number_of_duplicates, 'flushes': self.number_of_flushes}
 
     @staticmethod
     def evaluate_final_state(node):
         """Value of the game state for the next player"""
         return winner_value(node.state.winner, node.state)
+
+
+class EvaluatorClient(object):
+    """Queues the nodes of one player on a shared `BatchEvaluator`, such that the searches of multiple games are
+    evaluated in the same batches"""
+
+    def __init__(self, evaluator: BatchEvaluator):
+        self.evaluator = evaluator
+        self.number_of_pending = 0
+
+    @property
+    def batch_size(self):
+        return self.evaluator.batch_size
+
+    def simulate(self, node: 'AlphaConnectNode', callback):
+        self.number_of_pending += 1
+
+        def evaluated_callback(value, action_probs):
+            self.number_of_pending -= 1
+            callback(value, action_probs)
+
+        self.evaluator.simulate(node, evaluated_callback)
+
+    def flush(self):
+        self.evaluator.flush()
+
+    def stats(self) -> Dict[str, float]:
+        return self.evaluator.stats()
@@ -0,0 +1,73 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+from engine import NumpyModel, agreement, export_model, sample_states
+from player import load_model
+from state import State, encode_batch
+
+MODEL_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'models', '000170.h5')
+
+
+@pytest.fixture
+def array():
+    states = []
+    for _ in range(20):
+        state = State.empty()
+        for _ in range(random.randint(0, 20)):
+            if not state.is_end_of_game():
+                state = state.take_action(random.choice(list(state.allowed_actions)))
+        states.append(state)
+    return encode_batch(states)
+
+
+def test_numpy_model_matches_keras_model(array):
+    expected_policy, expected_value = load_model(MODEL_PATH).predict(array)
+    policy, value = NumpyModel.from_h5(MODEL_PATH).predict(array)
+
+    assert np.allclose(policy, expected_policy, atol=1e-5)
+    assert np.allclose(value, expected_value, atol=1e-5)
+
+
+def test_numpy_model_evaluates_each_state_separately(array):
+    model = load_model(MODEL_PATH, backend='numpy')
+    policy, value = model.predict(array)
+    single_policy, single_value = model.predict(array[3:4])
+
+    assert policy.shape == (len(array), 16) and value.shape == (len(array), 1)
+    assert np.allclose(policy.sum(axis=1), 1.0)
+    assert np.all(np.abs(value) <= 1.0)
+    assert np.allclose(single_policy, policy[3:4], atol=1e-6) and np.allclose(single_value, value[3:4], atol=1e-6)
+
+
+def test_exported_model_matches_h5_model(array, tmpdir):
+    export_path = str(tmpdir.join('000170.npmodel'))
+    export_model(MODEL_PATH, export_path)
+    expected_policy, expected_value = NumpyModel.from_h5(MODEL_PATH).predict(array)
+    policy, value = load_model(export_path).predict(array)
+
+    assert np.array_equal(policy, expected_policy) and np.array_equal(value, expected_value)
+
+
+def test_float16_exported_model_agrees_with_float32_model(tmpdir):
+    random.seed(0)
+    export_path = str(tmpdir.join('000170.npmodel'))
+    float32_path = str(tmpdir.join('000170_float32.npmodel'))
+    export_model(MODEL_PATH, export_path, 'float16')
+    export_model(MODEL_PATH, float32_path)
+    report = agreement(load_model(export_path), NumpyModel.from_h5(MODEL_PATH), sample_states(str(tmpdir), 500))
+
+    assert os.path.getsize(export_path) < os.path.getsize(float32_path)
+    assert report['top1_agreement'] > 0.95 and report['value_mae'] < 0.01
+
+
+def test_numpy_model_takes_uint8_planes(array):
+    model = NumpyModel.from_h5(MODEL_PATH)
+    planes = array.astype(np.uint8)
+    policy, value = model.predict(planes)
+    expected_policy, expected_value = model.predict(array)
+
+    assert np.array_equal(planes, array) and model.input_dtype == np.uint8
+    assert np.array_equal(policy, expected_policy) and np.array_equal(value, expected_value)
@@ -47,3 +47,12 @@ def test_no_errors_when_playing_and_printing_games():
         observers = [GameStatePrinter(show_action_history=True)]
         game = TwoPlayerGame(State.empty(), player1, player2, observers)
         game.play()
+
+
+def test_play_iter_plays_complete_game():
+    game = TwoPlayerGame(State.empty(), RandomPlayer(), GreedyPlayer())
+    for _ in game.play_iter():
+        pass
+
+    assert game.current_state.is_end_of_game()
+    assert len(game.action_history) == game.current_state.number_of_stones
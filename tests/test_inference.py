@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from inference import InferenceClient, start_server, stop_server
+from state import State, Action, encode_batch
+
+
+class SumModel(object):
+    def __init__(self, model_path):
+        self.offset = len(model_path)
+
+    def predict(self, array):
+        flat = array.reshape((len(array), -1))
+        policy = np.repeat(flat.sum(axis=1, keepdims=True), 16, axis=1) / 16
+        return policy, flat[:, :1] + self.offset
+
+
+@pytest.fixture
+def server():
+    channels, process = start_server(2, max_batch_size=8, max_latency=0.001, load_model=SumModel)
+    yield channels
+    stop_server(channels, process)
+
+
+def test_inference_server_answers_each_request(server):
+    client = InferenceClient(server, server.free_workers.get())
+    states = [State.empty(), State.empty().take_actions([Action(0, 0), Action(1, 2)])] * 10
+    array = encode_batch(states)
+
+    policy, value = client.model('a.h5').predict(array)
+    expected_policy, expected_value = SumModel('a.h5').predict(array)
+
+    assert np.allclose(policy, expected_policy)
+    assert np.allclose(value, expected_value)
+    assert client.model('other.h5').predict(array[:3])[1][0, 0] == pytest.approx(expected_value[0, 0] + 4)
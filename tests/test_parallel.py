@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pytest
+
+from parallel import RootParallelSearch, tree_parallel_search
+from state import Action, State
+from tree import AlphaConnectNode, BatchEvaluator, EvaluatorClient
+
+
+class UniformModel(object):
+    def predict(self, array):
+        n = len(array)
+        return np.full((n, 16), 1 / 16), array[:, 0, 0, 0, 2:3] - .5
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_tree_parallel_search_uses_search_budget(workers):
+    model = BatchEvaluator(UniformModel(), batch_size=4)
+    root = AlphaConnectNode(State.empty(), action_prob=1.0)
+
+    searches = tree_parallel_search(root, model, 1.0, 1.0, workers, 'search', 50)
+
+    assert searches == 50
+    assert root.visit_count == 51
+    assert model.number_of_pending == 0
+
+
+def test_tree_parallel_search_uses_the_evaluator_of_a_client():
+    model = EvaluatorClient(BatchEvaluator(UniformModel(), batch_size=4))
+    root = AlphaConnectNode(State.empty(), action_prob=1.0)
+
+    assert tree_parallel_search(root, model, 1.0, 1.0, 2, 'search', 20) == 20
+    assert root.visit_count == 21
+
+
+def test_root_parallel_search_counts_the_visits_of_each_call():
+    model_path = os.path.join(os.path.dirname(__file__), os.pardir, 'models', '000170.h5')
+    search = RootParallelSearch(2, dict(model_path=model_path, start_temperature=None, search_budget=20,
+                                        early_stop=False, backend='numpy'))
+    try:
+        for _ in range(3):
+            root, searches, proven_action = search.search(State.empty())
+            # each new child starts with one visit, reused children do not
+            assert searches == root.visit_count - 1 == 40
+            assert searches <= sum(child.visit_count for child in root.children.values()) <= searches + 2 * 16
+            assert set(root.children) <= State.empty().allowed_actions
+            assert all(child.visit_count > 0 for child in root.children.values())
+            root.action_statistics()
+            assert proven_action is None
+    finally:
+        search.close()
+
+
+def test_root_parallel_search_returns_the_proven_action_of_a_solved_root():
+    model_path = os.path.join(os.path.dirname(__file__), os.pardir, 'models', '000170.h5')
+    search = RootParallelSearch(2, dict(model_path=model_path, start_temperature=None, search_budget=20,
+                                        early_stop=False, solver=True, backend='numpy'))
+    state = State.empty().take_actions([Action(0, 0), Action(3, 3), Action(0, 0), Action(3, 2), Action(0, 0),
+                                        Action(3, 1)])
+    try:
+        # the second call finds the root already solved in the trees of the workers and does not search
+        for _ in range(2):
+            root, searches, proven_action = search.search(state)
+            assert proven_action == Action(0, 0)
+            assert all(child.visit_count > 0 for child in root.children.values())
+    finally:
+        search.close()
@@ -1,4 +1,5 @@
 import os
+import time
 from typing import List
 
 import pytest
@@ -77,3 +78,28 @@ def test_player_prevents_other_from_winning(players: List[Player], other_win_in_
     for player in players:
         action = player.decide(other_win_in_one_move)
         assert Action(3, 0) == action, '%s does not prevent other from winning' % player
+
+
+def test_alpha_connect_player_reuses_pondered_visits(test_model_path):
+    player = AlphaConnectPlayer(test_model_path, start_temperature=None, search_budget=16)
+    state = State.empty().take_action(Action(0, 0))
+
+    player.ponder(state)
+    while player.ponder_stats['searches'] < 100:
+        time.sleep(.01)
+    player.decide(state.take_action(Action(1, 1)))
+
+    assert player._ponder_thread is None
+    assert player.ponder_stats['reused_visits'] > 0
+    assert player.model.number_of_pending == 0
+
+
+def test_alpha_connect_player_stops_pondering_at_node_cap(test_model_path):
+    player = AlphaConnectPlayer(test_model_path, start_temperature=None, search_budget=16, max_ponder_nodes=500)
+
+    player.ponder(State.empty())
+    player._ponder_thread.join(timeout=60)
+
+    assert not player._ponder_thread.is_alive()
+    assert 500 < player.root.number_of_nodes() <= 500 + FOUR ** 2
+    player.stop_pondering()
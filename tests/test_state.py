@@ -5,7 +5,8 @@ import numpy as np
 import pytest
 
 from state import State, Color, FOUR, _lines_on_one_axis, _lines_on_one_diagonal, \
-    _lines_on_two_diagonals, Action, _lines, Augmentation, Rotation, Position
+    _lines_on_two_diagonals, Action, _lines, Augmentation, Rotation, Position, SearchBoard, encode_batch, \
+    augment_policy, augment_features, zobrist_hash, random_playouts
 
 
 @pytest.fixture
@@ -213,3 +214,196 @@ def test_regression_str_with_top_plane_stones():
     actions_history = [Action.from_hex(i) for i in '0cf35aa55ae9699663cb8c7447f8ec']
     state = State.empty().take_actions(actions_history)
     str(state)
+
+
+def test_position_to_int():
+    position = Position(1, 2, 3)
+    assert position == Position.from_int(position.to_int())
+
+
+def test_76_line_masks_with_four_positions_each():
+    assert 76 == len(State.LINE_MASKS)
+    assert all(bin(line_mask).count('1') == FOUR for line_mask in State.LINE_MASKS)
+
+
+def test_state_from_board_equals_played_state():
+    state = State.empty().take_actions([Action(0, 0), Action(0, 0), Action(2, 1)])
+    board = [[[] for _ in range(FOUR)] for _ in range(FOUR)]
+    board[0][0] = [0, 1]
+    board[2][1] = [0]
+
+    assert state == State.from_board(board, 1)
+    assert state.pin_height == State.from_board(board, 1).pin_height
+
+
+def test_search_board_push_and_pop_match_state():
+    start_state = State.empty().take_actions([Action.from_hex(i) for i in '0cf35aa55ae9'])
+    board = SearchBoard(start_state, track_lines=True)
+    actions = [Action(0, 0), Action(0, 0), Action(1, 2)]
+    for action in actions:
+        board.push(action)
+
+    state = start_state.take_actions(actions)
+    assert state == board.to_state()
+    assert [state.white_lines[line_i] for line_i in range(len(State.LINES))] == board.white_lines
+    assert [state.brown_lines_free[Position.from_int(i)] for i in range(FOUR ** 3)] == board.brown_lines_free
+
+    for _ in actions:
+        board.pop()
+    assert start_state == board.to_state()
+    assert [start_state.brown_lines[line_i] for line_i in range(len(State.LINES))] == board.brown_lines
+    assert start_state.allowed_actions == set(board.allowed_actions)
+
+
+def test_incremental_line_histogram_equals_counted_line_histogram(random_state):
+    state = random_state.take_actions([Action(0, 0), Action(0, 0), Action(1, 2)])
+    counted_state = State(state.brown, state.white, state.heights, state.next_color, state.number_of_stones,
+                          state.allowed_actions, state.winner)
+    board = SearchBoard(random_state, track_lines=True)
+    for action in [Action(0, 0), Action(0, 0), Action(1, 2)]:
+        board.push(action)
+
+    assert counted_state.line_histogram == state.line_histogram
+    assert counted_state.line_histogram == board.line_histogram
+    assert sum(state.line_histogram) == sum(1 for line_mask in State.LINE_MASKS
+                                            if (state.brown | state.white) & line_mask
+                                            and not (state.brown & line_mask and state.white & line_mask))
+
+    board.pop()
+    assert random_state.take_actions([Action(0, 0), Action(0, 0)]).line_histogram == board.line_histogram
+
+    # actions only update the histogram of states that have one
+    assert State.empty().take_action(Action(1, 1))._line_histogram is None
+
+
+def test_incremental_line_histogram_equals_counted_line_histogram_over_random_games():
+    random.seed(4)
+    for _ in range(20):
+        state, lazy_state = State.empty(), State.empty()
+        state.line_histogram
+        while not state.is_end_of_game():
+            action = random.choice(list(state.allowed_actions))
+            state, lazy_state = state.take_action(action), lazy_state.take_action(action)
+            assert state._line_histogram is not None and lazy_state._line_histogram is None
+            assert state.winner == lazy_state.winner
+            counted_state = State(state.brown, state.white, state.heights, state.next_color, state.number_of_stones,
+                                  state.allowed_actions, state.winner)
+            assert state.line_histogram == counted_state.line_histogram
+
+
+def test_child_line_histograms_equal_line_histograms_of_children(random_state):
+    actions, line_histograms = random_state.child_line_histograms()
+    board_actions, board_line_histograms = SearchBoard(random_state, track_lines=True).child_line_histograms()
+
+    assert set(actions) == random_state.allowed_actions
+    assert line_histograms.tolist() == [list(random_state.take_action(action).line_histogram) for action in actions]
+    assert dict(zip(board_actions, board_line_histograms.tolist())) == dict(zip(actions, line_histograms.tolist()))
+
+
+def _encode_position(state: State, position: Position):
+    """Features of a position, from the stones and the per position line tables of the state"""
+    x, y, z = position
+    stone = state.stones[position]
+    corner = x in (0, 3) and y in (0, 3)
+    side = (x in (0, 3) or y in (0, 3)) and not corner
+    own_lines_free, other_lines_free = state.free_lines
+    own_max_line, other_max_line = state.max_lines
+    return [stone == state.next_color, stone == state.next_color.other(), z == state.pin_height[Action(x, y)],
+            corner, side, not (corner or side), z == 0, z == 3, 0 < z < 3, own_lines_free[position],
+            other_lines_free[position], own_max_line[position], other_max_line[position]]
+
+
+def test_encode_batch_fills_preallocated_buffer():
+    random.seed(3)
+    actions = []
+    state = State.empty()
+    for _ in range(12):
+        actions.append(random.choice(list(state.allowed_actions)))
+        state = state.take_action(actions[-1])
+    augmentations = list(Augmentation.iter_augmentations())
+    out = np.zeros((len(augmentations), FOUR, FOUR, FOUR, 13), dtype=np.uint8)
+
+    encode_batch([state] * len(augmentations), augmentations, out=out)
+
+    for arr, augmentation in zip(out, augmentations):
+        # the encoding of an augmented state is that of the game played with the augmented actions
+        augmented_state = State.empty().take_actions([action.augment(augmentation) for action in actions])
+        expected = [[[_encode_position(augmented_state, Position(x, y, z)) for z in range(FOUR)]
+                     for y in range(FOUR)] for x in range(FOUR)]
+        assert arr.tolist() == np.array(expected, dtype=np.uint8).tolist()
+
+
+def test_augment_policy_matches_augmented_actions():
+    policy = np.arange(FOUR * FOUR)
+    for augmentation in Augmentation.iter_augmentations():
+        augmented_policy = augment_policy(policy, augmentation)
+        for action in Action.iter_actions():
+            assert policy[action.to_int()] == augmented_policy[action.augment(augmentation).to_int()]
+
+
+def test_augment_features_batch_matches_augmented_encoding(random_state):
+    augmentations = list(Augmentation.iter_augmentations())
+    features = encode_batch([random_state] * len(augmentations))
+
+    augmented_features = augment_features(features, augmentations)
+
+    assert encode_batch([random_state] * len(augmentations), augmentations).tolist() == augmented_features.tolist()
+    assert augmented_features[3].tolist() == augment_features(features[3], augmentations[3]).tolist()
+
+
+def test_incremental_hash_equals_hash_of_board(random_state):
+    state = random_state.take_action(Action(3, 3))
+    board = SearchBoard(random_state)
+    board.push(Action(3, 3))
+
+    assert zobrist_hash(state.brown, state.white, state.next_color) == state.key()
+    assert state.key() == board.zobrist
+    assert state.key() != random_state.key()
+
+
+def test_transposed_states_are_equal_and_usable_as_dict_key():
+    state = State.empty().take_actions([Action(0, 0), Action(1, 1), Action(2, 2)])
+    transposed_state = State.empty().take_actions([Action(2, 2), Action(1, 1), Action(0, 0)])
+
+    assert state == transposed_state
+    assert {state: 1}[transposed_state] == 1
+    assert State.empty().take_actions([Action(0, 0), Action(1, 1)]) != state
+
+
+def test_symmetric_states_have_same_canonical_key(random_state):
+    key, augmentation = random_state.canonical_key()
+    brown = sum(1 << position.augment(augmentation).to_int()
+                for position, color in random_state.stones.items() if color is Color.BROWN)
+    white = sum(1 << position.augment(augmentation).to_int()
+                for position, color in random_state.stones.items() if color is Color.WHITE)
+
+    assert zobrist_hash(brown, white, random_state.next_color) == key
+    assert State.empty().take_action(Action(0, 1)).canonical_key()[0] == \
+        State.empty().take_action(Action(2, 3)).canonical_key()[0]
+
+
+def test_actions_since_earlier_state():
+    state = State.empty().take_action(Action(1, 2))
+    later_state = state.take_actions([Action(3, 0), Action(1, 2)])
+
+    assert later_state.actions_since(state) == [Action(3, 0), Action(1, 2)]
+    assert state.take_actions(later_state.actions_since(state)) == later_state
+    assert state.actions_since(later_state) is None
+    assert State.empty().take_action(Action(0, 0)).actions_since(state) is None
+
+
+def test_winning_actions_complete_a_line(random_state):
+    state = State.empty().take_actions([Action(0, 0), Action(3, 3), Action(0, 0), Action(3, 2), Action(0, 0)])
+
+    assert state.winning_actions(Color.WHITE) == [Action(0, 0)]
+    assert state.winning_actions(Color.BROWN) == []
+    winning_actions = random_state.winning_actions(random_state.next_color)
+    for action in random_state.allowed_actions:
+        assert random_state.take_action(action).has_winner() == (action in winning_actions)
+
+
+def test_random_playouts_end_in_win_or_draw(random_state):
+    won_state = State.empty().take_actions([Action(0, 0), Action(3, 3)] * 3 + [Action(0, 0)])
+
+    assert set(random_playouts(random_state, 100).tolist()) <= {0, Color.BROWN.value, Color.WHITE.value}
+    assert random_playouts(won_state, 3).tolist() == [Color.WHITE.value] * 3
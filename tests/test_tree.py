@@ -0,0 +1,298 @@
+import random
+import weakref
+
+import numpy as np
+import pytest
+
+from analyzer import player_value
+from state import State, Action, Augmentation, Color, SearchBoard, augment_policy
+from tree import AlphaConnectNode, AlphaConnectArrayTree, BatchEvaluator, EvaluationCache, AlphaConnectGraphNode, \
+    EvaluatorClient, AlphaConnectSolverNode, AlphaBetaSearch, is_decided
+
+
+class UniformModel(object):
+    def predict(self, array):
+        n = len(array)
+        return np.full((n, 16), 1 / 16), array[:, 0, 0, 0, 2:3] - .5
+
+
+@pytest.fixture
+def model():
+    return BatchEvaluator(UniformModel(), batch_size=4)
+
+
+def search(root, model, n, virtual_loss=1.0):
+    for _ in range(n):
+        root.search(model, 1.0, virtual_loss)
+    model.flush()
+    return root
+
+
+def test_array_tree_searches_same_as_object_tree(model):
+    state = State.empty().take_actions([Action(0, 0), Action(1, 1)])
+
+    random.seed(1)
+    node_root = search(AlphaConnectNode(state, action_prob=1.0), model, 200)
+    random.seed(1)
+    array_root = search(AlphaConnectArrayTree(number_of_blocks=2).new_root(state), model, 200)
+
+    assert node_root.policy(1.0) == array_root.policy(1.0)
+    assert node_root.sample_action(None) == array_root.sample_action(None)
+    assert node_root.total_value == pytest.approx(array_root.total_value)
+
+
+def test_array_tree_recycles_discarded_subtrees(model):
+    tree = AlphaConnectArrayTree(number_of_blocks=4)
+    root = search(tree.new_root(State.empty()), model, 100)
+    number_of_nodes = len(tree)
+
+    new_root = root.children[Action(0, 0)]
+    visit_count = new_root.visit_count
+    new_root.make_root()
+
+    assert len(tree) < number_of_nodes
+    assert new_root.parent is None
+    assert visit_count + 10 == search(new_root, model, 10).visit_count
+
+
+@pytest.mark.parametrize('virtual_loss', [0.0, 1.0])
+def test_virtual_loss_is_reverted_after_flush(model, virtual_loss):
+    state = State.empty().take_actions([Action(0, 0), Action(1, 1)])
+    root = search(AlphaConnectNode(state, action_prob=1.0), model, 10, virtual_loss)
+    expected = search(AlphaConnectNode(state, action_prob=1.0), BatchEvaluator(UniformModel(), batch_size=1), 1, 0.0)
+
+    assert len(model.queue) == 0
+    assert model.number_of_flushes == 1
+    assert all(abs(child.total_value) <= child.visit_count for child in root.children.values())
+    assert root.children[Action(2, 2)].action_prob == expected.children[Action(2, 2)].action_prob
+
+
+def test_batch_evaluator_evaluates_duplicate_states_once(model):
+    node = AlphaConnectNode(State.empty(), action_prob=1.0)
+    values = []
+    model.simulate(node, lambda value, action_probs: values.append(value))
+    model.simulate(node, lambda value, action_probs: values.append(value))
+    assert values == []
+
+    model.flush()
+
+    assert values == [.5, .5]
+    assert model.stats() == {'predictions': 1, 'evaluations': 1, 'fill_rate': .25, 'duplicates': 1, 'flushes': 1}
+
+
+def test_evaluation_cache_shares_symmetric_states():
+    cache = EvaluationCache(max_size=2)
+    state = State.empty().take_actions([Action(0, 1), Action(2, 3)])
+    augmentation = Augmentation.from_int(5)
+    symmetric_state = State.empty().take_actions([Action(0, 1).augment(augmentation),
+                                                  Action(2, 3).augment(augmentation)])
+    policy = np.arange(16) / 120
+
+    assert cache.get(state) is None
+    cache.put(state, .25, policy)
+    value, action_probs = cache.get(symmetric_state)
+
+    assert value == .25
+    assert [action_probs[action] for action in Action.iter_actions()] == list(augment_policy(policy, augmentation))
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 1, 'hit_rate': .5, 'evictions': 0}
+
+
+def test_evaluation_cache_evicts_least_recently_used():
+    cache = EvaluationCache(max_size=2)
+    states = [State.empty().take_action(action) for action in [Action(0, 0), Action(0, 1), Action(1, 1)]]
+    cache.put(states[0], 0., np.zeros(16))
+    cache.put(states[1], 1., np.zeros(16))
+    cache.get(states[0])
+    cache.put(states[2], 2., np.zeros(16))
+
+    assert cache.get(states[1]) is None
+    assert cache.get(states[0]) is not None
+    assert cache.number_of_evictions == 1
+
+    cache.set_model('other model')
+    assert len(cache) == 0
+
+
+def test_batch_evaluator_uses_cache():
+    model = BatchEvaluator(UniformModel(), batch_size=1, cache=EvaluationCache())
+    state = State.empty().take_actions([Action(0, 0), Action(1, 1)])
+    random.seed(1)
+    search(AlphaConnectNode(state, action_prob=1.0), model, 50)
+    number_of_predictions = model.number_of_predictions
+
+    random.seed(1)
+    search(AlphaConnectNode(state, action_prob=1.0), model, 50)
+
+    assert model.number_of_predictions == number_of_predictions
+    assert model.cache.number_of_hits >= 50
+
+
+def test_graph_search_shares_transposed_states(model):
+    root = search(AlphaConnectGraphNode.new_root(State.empty()), model, 300)
+    number_of_parents = {}
+    for node in root.table.nodes.values():
+        for child in node.children.values():
+            number_of_parents[child.state] = number_of_parents.get(child.state, 0) + 1
+
+    assert max(number_of_parents.values()) > 1
+    assert root.table.number_of_transpositions > 0
+    assert root.visit_count == 301
+    assert sum(root.action_visit_counts.values()) == 299 + len(root.children)
+    assert sum(root.policy(1.0).values()) == pytest.approx(1.0)
+
+
+def test_graph_search_forgets_unreachable_states(model):
+    root = search(AlphaConnectGraphNode.new_root(State.empty()), model, 100)
+    number_of_nodes = len(root.table)
+    new_root = root.children[Action(0, 0)]
+    new_root.make_root()
+
+    assert new_root.find_state(State.empty()) is None
+    assert new_root.find_state(new_root.state) is new_root
+    assert len(new_root.table) < number_of_nodes
+    assert all(node.state.number_of_stones >= 1 for node in new_root.table.nodes.values())
+
+
+def test_follow_actions_and_free_discarded_tree(model):
+    root = search(AlphaConnectNode(State.empty(), action_prob=1.0), model, 100)
+    old_root = weakref.ref(root)
+    node = root.follow([Action(0, 0), Action(1, 1)])
+    assert node is root.children[Action(0, 0)].children[Action(1, 1)]
+    assert root.follow([Action(0, 0), Action(0, 0), Action(0, 0), Action(0, 0), Action(0, 0)]) is None
+
+    del root
+    assert old_root() is None
+    assert node.parent is None
+    assert node.number_of_nodes() == 1 + sum(child.number_of_nodes() for child in node.children.values())
+
+
+def test_evaluator_clients_share_batches():
+    evaluator = BatchEvaluator(UniformModel(), batch_size=8)
+    clients = [EvaluatorClient(evaluator), EvaluatorClient(evaluator)]
+    roots = [AlphaConnectNode(State.empty().take_action(Action(x, x)), action_prob=1.0) for x in range(2)]
+    for _ in range(3):
+        for root, client in zip(roots, clients):
+            root.search(client, 1.0, 1.0)
+
+    assert [client.number_of_pending for client in clients] == [3, 3]
+    assert evaluator.number_of_pending == 6
+
+    clients[0].flush()
+
+    assert [client.number_of_pending for client in clients] == [0, 0]
+    assert evaluator.stats()['predictions'] == 1
+
+
+def test_is_decided_when_other_actions_cannot_catch_up():
+    statistics = {Action(0, 0): (10, .1), Action(0, 1): (4, .3), Action(1, 1): (2, .0)}
+
+    assert is_decided(statistics, remaining_searches=5)
+    assert not is_decided(statistics, remaining_searches=6)
+    assert not is_decided({}, remaining_searches=0)
+
+
+def test_is_decided_leniently_by_value_gap():
+    statistics = {Action(0, 0): (10, .5), Action(0, 1): (8, .1), Action(1, 1): (2, .0)}
+
+    assert is_decided(statistics, remaining_searches=100, value_gap=.4)
+    assert not is_decided(statistics, remaining_searches=100, value_gap=.5)
+
+
+def test_solver_plays_win_in_one_without_evaluation(model):
+    state = State.empty().take_actions([Action(0, 0), Action(3, 3), Action(0, 0), Action(3, 2), Action(0, 0),
+                                        Action(3, 1)])
+    root = search(AlphaConnectSolverNode(state, action_prob=1.0), model, 10)
+
+    assert root.proven == 1
+    assert root.proven_action() == Action(0, 0)
+    assert model.stats()['predictions'] == 0
+
+
+def test_solver_blocks_one_threat_and_proves_loss_against_two_threats(model):
+    state = State.empty().take_actions([Action(0, 0), Action(3, 3), Action(0, 0), Action(3, 3), Action(0, 0),
+                                        Action(2, 3), Action(1, 1)])
+    root = search(AlphaConnectSolverNode(state, action_prob=1.0), model, 10)
+    assert root.proven is None
+    assert root.proven_action() == Action(0, 0)
+
+    state = state.take_actions([Action(3, 2), Action(2, 0), Action(1, 2), Action(1, 0)])
+    root = search(AlphaConnectSolverNode(state, action_prob=1.0), model, 10)
+    assert root.proven == -1
+
+
+def test_states_of_children_are_built_when_selected(model):
+    root = search(AlphaConnectNode(State.empty(), action_prob=1.0), model, 10)
+    action, child = next((action, child) for action, child in root.children.items() if child.visit_count == 1)
+
+    assert root.number_of_states() == 10 < root.number_of_nodes()
+    assert child.number_of_states() == 0
+    assert child.state == State.empty().take_action(action)
+    assert child.number_of_states() == 1
+
+
+def test_prune_least_visited_subtrees_and_keep_statistics(model):
+    root = search(AlphaConnectNode(State.empty(), action_prob=1.0), model, 300)
+    visit_counts = {action: child.visit_count for action, child in root.children.items()}
+    number_of_nodes = root.number_of_nodes()
+    number_of_bytes = root.approximate_bytes()
+
+    number_of_removed = root.prune(100)
+
+    assert root.number_of_nodes() == number_of_nodes - number_of_removed <= 100
+    assert root.approximate_bytes() < number_of_bytes
+    assert visit_counts == {action: child.visit_count for action, child in root.children.items()}
+    assert search(root, model, 100).visit_count == 401
+
+
+def test_prune_does_not_count_the_subtrees_of_pruned_nodes():
+    def add_children(node, number_of_children, visit_count):
+        node.children = {Action.from_int(i): AlphaConnectNode(None, 1.0, parent=node, action=Action.from_int(i))
+                         for i in range(number_of_children)}
+        for child in node.children.values():
+            child.visit_count = visit_count
+        return list(node.children.values())
+
+    root = AlphaConnectNode(State.empty(), action_prob=1.0)
+    most_visited, least_visited = add_children(root, 2, 1)
+    most_visited.visit_count, least_visited.visit_count = 100, 10
+    add_children(most_visited, 10, 1)[0].visit_count = 50
+    add_children(most_visited.children[Action.from_int(0)], 2, 1)
+    add_children(least_visited, 3, 1)
+
+    # the most visited child does not fit, its deep child would, but it is removed with its parent
+    assert root.prune(6) == 12
+    assert len(most_visited.children) == 0 and len(least_visited.children) == 3
+    assert root.number_of_nodes() == 6
+
+
+def minimax_value(board: SearchBoard, depth: int, color: Color):
+    if depth == 0 or board.is_end_of_game():
+        return player_value(board, color)
+    values = []
+    for action in board.allowed_actions:
+        board.push(action)
+        values.append(minimax_value(board, depth - 1, color))
+        board.pop()
+    return max(values) if board.next_color is color else min(values)
+
+
+def test_alpha_beta_search_finds_minimax_best_actions():
+    random.seed(2)
+    state = State.empty()
+    for _ in range(8):
+        state = state.take_action(random.choice(sorted(state.allowed_actions)))
+    board = SearchBoard(state, track_lines=True)
+    expected_values = {}
+    for action in state.allowed_actions:
+        board.push(action)
+        expected_values[action] = minimax_value(board, 2, state.next_color)
+        board.pop()
+
+    search = AlphaBetaSearch(state)
+    action_values = search.search(3)
+
+    best_value = max(expected_values.values())
+    assert max(action_values.values()) == best_value
+    assert {action for action, value in action_values.items() if value == best_value} == \
+        {action for action, value in expected_values.items() if value == best_value}
+    assert search.depth == 3